@@ -13,6 +13,11 @@ from matplotlib import pyplot as plt
 import csv
 import os 
 
+from charger_index import nearest_active_charger, build_time_to_charge
+from charger_model import charge_added
+from charger_occupancy import ChargerTimeline
+from energy_model import charge_required
+
 # create Bus class
 class Bus: 
     """
@@ -28,16 +33,11 @@ class Bus:
         self.block_id = None
         
     #Charges bus, takes in charger type of 'Faster' or 'Slower' for the 450kW or 150kW charger
+    #or any charger type registered in charger_model.py, raises ValueError for unknown types
     def chargeBus(self, chargeTime, start_charge_pct, charge=True, chargerType = 'Faster'):
         
-        if(chargerType == 'Faster'):
-            AddedCharge = chargeTime*60/35
-        elif(chargerType == 'Slower'):
-            AddedCharge = chargeTime*60/130
-        else:
-            print("charger type not charicterized in model")
-        if(self.current_charge_pct + AddedCharge > start_charge_pct):
-            AddedCharge = start_charge_pct - self.current_charge_pct
+        # charging curve lookup and clamp at start_charge_pct, see charger_model.py
+        AddedCharge = charge_added(self.current_charge_pct, chargeTime, start_charge_pct, chargerType)
         if(charge):
             self.current_charge_pct = self.current_charge_pct + AddedCharge
         return AddedCharge
@@ -68,9 +68,11 @@ def get_charge_required(distance_traveled, durationMinutes, time_of_year, bus_ty
     '''
     Parameters
     ----------
-    distance_traveled : float
+    distance_traveled : float or np.array
+    durationMinutes : float or np.array
     time_of_year: str, takes values ("Winter", or "Summer")
-    eval_type: 'reg' for regression or 'wc' for worst case scenario
+    eval_type: 'reg' for regression or 'wc' for worst case scenario, or a model
+    name from BusMileageRegressionParams.txt ('distance', 'time', 'distance+time')
     
     See file readme for different model parameter settings. 
     
@@ -81,31 +83,10 @@ def get_charge_required(distance_traveled, durationMinutes, time_of_year, bus_ty
 
     Returns
     -------
-    float: battery percentage required to complete the specified route
+    float or np.array: battery percentage required to complete the specified route(s)
     '''
-    if time_of_year == 'Summer':
-        if eval_type == 'reg':
-            Distancebeta = 0.1799
-            timeBeta = 0.0565
-            const = 1.2035
-        else: 
-           beta = 0.8156
-           const = 0
-        
-    else:
-        if eval_type == 'reg':
-            Distancebeta =0.3257
-            timeBeta = 0.0701
-            const = -0.0178 
-        else: 
-            beta = .92
-            const = 0
-            
-            
-    batteryChange = abs((Distancebeta*distance_traveled)+(timeBeta*durationMinutes)+const)
-    if bus_type[0:5] == 'jumbo':
-        batteryChange = batteryChange*1.58
-    return(batteryChange)
+    # coefficients from BusMileageRegressionParams.txt, see energy_model.py
+    return(charge_required(distance_traveled, durationMinutes, time_of_year, bus_type, eval_type))
     
     
 
@@ -246,7 +227,8 @@ def failed_block_loop(df, blockID, start_charge_pct, min_charge_threshold,
         Dictates whether to adjust the charge depletion rate if it is 40 ft vs 60 ft
     min_charge_time: int
         minimum number of minutes required for charge to happen. Usually flags a layover period
-    numberOchargers : object to track charger count/placement
+    numberOchargers : dataframe to track charger count/placement, the charger column
+        holds a ChargerTimeline of charge sessions per stop (see charger_occupancy.py)
     
     Purpose
     -------
@@ -302,9 +284,7 @@ def failed_block_loop(df, blockID, start_charge_pct, min_charge_threshold,
                  #will fail if running on new dataset where triplocations and numberOchargers hasn't been setup yet
                 if numberOchargers is not None:
                     s = time_to_charge['stop'].loc[t]
-                    for j in range(int(charge_time)):
-                        l = int(last_end_time+commute+j)
-                        numberOchargers.loc[s][1][l] += 1
+                    numberOchargers['charger'].loc[s].add_session(last_end_time+commute, charge_time, blockID)
                     if charge_options == {}:
                         numberOchargers['num_blocks'].loc[s] += 1
                     if(time_to_charge['location'].loc[trip.trip_id] in charge_options):
@@ -331,167 +311,280 @@ def failed_block_loop(df, blockID, start_charge_pct, min_charge_threshold,
     return [chargeNeeded, charge_options, ChargePoints, numberOchargers]
 
 
+# failed_block_loop for every failed block in one scan of the block kernel
+def failed_blocks_scan(block_table, blocks, charge_required, start_charge_pct, min_charge_threshold,
+                       time_to_charge, min_charge_time, numberOchargers):
+    '''
+    Parameters
+    ----------
+    block_table : BlockTable
+        trips as arrays, see block_simulation.py and trips_cache.py
+    blocks : list
+        block ids to assess, e.g. blockID_needing_charge
+    charge_required : np.array
+        charge used by each trip, see block_charge_required in block_simulation.py
+    start_charge_pct : float
+        charging pct of bus at "full charge"
+    min_charge_threshold : float
+        min allowed charge for bus to take a trip.
+    time_to_charge : dataframe or None
+        output of build_time_to_charge. If None every layover longer than
+        min_charge_time charges, with no travel to a charger
+    min_charge_time: int
+        minimum number of minutes required for charge to happen. Usually flags a layover period
+    numberOchargers : dataframe or None
+        charger count/placement, charge sessions are added to its ChargerTimelines
+        as in failed_block_loop
+    
+    Purpose
+    -------
+    Same checks and outputs as failed_block_loop for each block in blocks, with
+    the charge levels from one scan_blocks pass over the trip arrays (see
+    block_kernel.py) instead of filtering df per trip.
 
+    Returns
+    -------
+    list
+        [block, chargeNeeded] and [block, charge_options] per block, index into
+        the trip arrays of the ChargePoints (trips charging in the layover before
+        them), and numberOchargers
 
+    '''
+    from block_kernel import scan_blocks, commute_from_time_to_charge
+    
+    if time_to_charge is None:
+        commute = np.zeros(len(block_table))
+    else:
+        commute = commute_from_time_to_charge(block_table, time_to_charge)
+    charge_level, added, charged, _ = scan_blocks(block_table, charge_required, commute, start_charge_pct,
+                                                  min_charge_threshold, min_charge_time,
+                                                  last_end_time = 60*24, stop_at_failure = False)
+    charge_needed_list = []
+    block_charge_options = []
+    ChargePoints = []
+    for block, b in zip(blocks, np.searchsorted(block_table.block_ids, blocks)):
+        first, last = block_table.offsets[b], block_table.offsets[b+1]
+        charge_options = {}
+        for i in first + np.where(charged[first:last])[0]:
+            if numberOchargers is not None:
+                t = block_table.trip_id[i]
+                last_end_time = 60*24 if i == first else block_table.end_min[i-1]
+                charge_time = block_table.start_min[i] - last_end_time - 2*commute[i]
+                s = time_to_charge['stop'].loc[t]
+                numberOchargers['charger'].loc[s].add_session(last_end_time+commute[i], charge_time, block)
+                if charge_options == {}:
+                    numberOchargers.loc[s, 'num_blocks'] += 1
+                location = time_to_charge['location'].loc[t]
+                charge_options[location] = charge_options.get(location, 0) + added[i]
+                numberOchargers['routes'].loc[s].append('' if i == first else block_table.route_id[i-1])
+            ChargePoints.append(i)
+        charge_needed_list.append([block, max(min_charge_threshold - charge_level[last-1], 0)])
+        block_charge_options.append([block, charge_options])
+    return [charge_needed_list, block_charge_options, ChargePoints, numberOchargers]
 
 
+# loads stop_to_layover_travelTime.csv, rows are layover locations after the transpose
+def load_travel_time_matrix(path):
+    '''
+    Parameters
+    ----------
+    path : str
+        path to stop_to_layover_travelTime.csv (output of endStop_layover_distances.py)
+    
+    Returns
+    -------
+    dataframe: travel time in minutes from each end stop (columns) to each layover (rows). 
+        Column 0 flags the layovers with an active charger.
+    '''
+    travel_time_matrix = pd.read_csv(path)
+    travel_time_matrix = travel_time_matrix.set_index('index')
+    travel_time_matrix = travel_time_matrix.transpose()
+    return travel_time_matrix
 
-### Run program
 
-if __name__ == '__main__':
+# runs the full charger assessment for one scenario
+def run_charging_assessment(df, start_charge_pct, min_charge_threshold, min_charge_time,
+                            time_of_year, eval_type, bus_type, travel_time_matrix, datafilepath = None,
+                            block_table = None):
+    '''
+    Parameters
+    ----------
+    df : dataframe or None
+        output of the create_trips_flattened.py file, block-trip level dataset on the drive.
+        Only needed to write blocks_needing_charge.csv, or without block_table.
+    start_charge_pct : float
+        charging pct of bus at "full charge"
+    min_charge_threshold : float
+        min allowed charge for bus to take a trip.
+    min_charge_time: int
+        minimum number of minutes required for charge to happen. Usually flags a layover period
+    time_of_year: str, takes values ("Winter", or "Summer")
+    eval_type: str, 'reg' or 'wc'
+    bus_type: str, 'jumbo' for 60ft, anything else means 40'
+    travel_time_matrix : dataframe
+        output of load_travel_time_matrix
+    datafilepath : str, optional
+        folder to write blocks_needing_charge.csv, StopLocNeedCharge.csv, 
+        time_to_charge.csv and number_of_chargers.csv to. Nothing is written if None.
+    block_table : BlockTable, optional
+        df as arrays (see block_simulation.py and trips_cache.py), built from df if None
     
-    ### global vars
-    start_charge_pct = 90 # max charge at start 
-    min_charge_threshold = 30 # minimum allowed charge remaining
-    min_charge_time = 5 #minimum charging time in minutes
-    time_of_year = 'Winter' # seasonality var
-    eval_type = 'reg' # whether to eval charging profile by regression or worst case scenario
-    #set bus type to 'jumbo' for 60ft, anything else means 40'
-    bus_type = 'jumbo'
-    datafilepath = r'C:\cmu\Spring2023\System Synthesis\Github\PRT_Synthesis'
-    #choose 'eastLib' or 'brt' or 'allRoutes'
-    data = 'brt'
-    datafilepath = os.path.join(datafilepath, data) + '\\'
-    df = pd.read_csv(datafilepath+'trips_flattened_'+data+'.csv')
+    Purpose
+    -------
+    Identifies failed blocks, assesses charging options for the failed blocks 
+    (failed_block_loop, run as failed_blocks_scan), and re-checks every block with
+    layover charging allowed. 
 
+    Returns
+    -------
+    dict
+        tripFails, blockID_needing_charge, charge_needed_list, block_charge_options,
+        tripLocations, time_to_charge, numberOchargers, final_tripFails, 
+        final_blockID_needing_charge
+    '''
+    from block_simulation import build_block_table, find_failed_blocks, block_charge_required
+    from block_kernel import scan_blocks, commute_from_time_to_charge
+    
     ### Identifying failed blocks
     
-    allBlocks = np.unique(df.block_id)
-    tripFails = []
     #time_to_charge = pd.read_csv(datafilepath+'time_to_charge.csv')
     #time_to_charge = time_to_charge.set_index('trip')
     print('Before any charging\n')
-    blockID_needing_charge = []
     block_charge_options = []
-    for block in allBlocks:
-        blockCheck = charge_status_via_trip_completion(df, block, start_charge_pct, 
-                                      min_charge_threshold, time_of_year, eval_type,bus_type, 
-                                      min_charge_time)
-        
-        if blockCheck != None:
-            tripFails.append(blockCheck[0])
-            blockID_needing_charge.append(blockCheck[1])
-            
-    tripFails = [i for i in tripFails if i != None]
-    blockID_needing_charge = [i for i in blockID_needing_charge if i != None]
+    # vectorized over all blocks, see block_simulation.py
+    if block_table is None:
+        block_table = build_block_table(df)
+    blockFails = find_failed_blocks(block_table, start_charge_pct, min_charge_threshold,
+                                    time_of_year, eval_type, bus_type)
+    tripFails = [i[0] for i in blockFails]
+    blockID_needing_charge = [i[1] for i in blockFails]
+    for t, block in blockFails:
+        print('Trip ', t, ' in block ', block, ' incomplete due to insufficient charge level. Charge battery.')
     
-    df[df.block_id.apply(lambda x: x in blockID_needing_charge)].to_csv(datafilepath+'blocks_needing_charge.csv')
+    if datafilepath is not None:
+        if df is None:
+            raise ValueError('df is needed to write blocks_needing_charge.csv')
+        df[df.block_id.apply(lambda x: x in blockID_needing_charge)].to_csv(datafilepath+'blocks_needing_charge.csv')
     print('\nNumber of failed blocks: ', len(blockID_needing_charge))
     
     ### Assessing charger placement 
     
     #First loop through failed blocks to find when charge is needed etc.
-    charge_needed_list = []
-    ChargePoints = ''
-    time_to_charge = None
-    numberOchargers = None
-    for block in blockID_needing_charge:
-        FailedBlockCheck = failed_block_loop(df, block, start_charge_pct,
-                                               min_charge_threshold, time_of_year, eval_type, bus_type,
-                                               time_to_charge, min_charge_time, numberOchargers)
-        charge_needed_list.append([block, FailedBlockCheck[0]])
-        block_charge_options.append([block, FailedBlockCheck[1]])
-        ChargePoints = ChargePoints + ',' + FailedBlockCheck[2]
-        numberOchargers = FailedBlockCheck[3]
-    
-    
-    tempdf = df.copy().set_index('trip_id')
-    ChargePoints = ChargePoints.split(',')
+    # failed_block_loop over the trip arrays, see failed_blocks_scan
+    charge_required = block_charge_required(block_table, time_of_year, bus_type, eval_type)
+    FailedBlockCheck = failed_blocks_scan(block_table, blockID_needing_charge, charge_required, start_charge_pct,
+                                          min_charge_threshold, None, min_charge_time, None)
+    charge_needed_list = FailedBlockCheck[0]
+    block_charge_options.extend(FailedBlockCheck[1])
+    ChargePoints = FailedBlockCheck[2]
+    
+    
     tripLocations = pd.Series(dtype=float, name='trips')
     end_tripLocations = []
     for i in ChargePoints:
-        if i != '':
-            i = int(i)
-            stop = tempdf['start_stop_id'].loc[i]
-            index = tempdf.index.get_loc(i)
-            end_stop = tempdf['end_stop_id'].iloc[index-1]
-            if stop in tripLocations:
-                tripLocations.loc[stop].append(i)
-            else:
-                tripLocations.loc[stop] = [i]
-                end_tripLocations.append(end_stop)
+        stop = block_table.start_stop_id[i]
+        # end stop of the trip before it in the dataset
+        end_stop = block_table.end_stop_id[i-1]
+        if stop in tripLocations:
+            tripLocations.loc[stop].append(int(block_table.trip_id[i]))
+        else:
+            tripLocations.loc[stop] = [int(block_table.trip_id[i])]
+            end_tripLocations.append(end_stop)
     
     tripLocations.index.name = 'stop'
-    tripLocations.to_csv(datafilepath+'StopLocNeedCharge.csv')
+    if datafilepath is not None:
+        tripLocations.to_csv(datafilepath+'StopLocNeedCharge.csv')
     
     num_blocks = []
-    zeros = []
+    timelines = []
     routes = []
     for i in range(len(tripLocations)):
         routes.append([])
         num_blocks.append(0)
-        zeros.append(np.zeros(3600*24))
+        timelines.append(ChargerTimeline())
     numberOchargers = pd.DataFrame({'stop_id': tripLocations.index.values,
                                     'last_end_id': end_tripLocations,
-                                    'charger': zeros,
+                                    'charger': timelines,
                                     'num_blocks': num_blocks,
                                     'routes': routes
                                     })
     numberOchargers = numberOchargers.set_index('stop_id')
                       
     
-    travel_time_matrix = pd.read_csv('stop_to_layover_travelTime.csv')
-    travel_time_matrix = travel_time_matrix.set_index('index')
-    travel_time_matrix = travel_time_matrix.transpose()
     #convert the above three data structures to list of route number and time it takes to get to active charger
-    time_to_charge = []
-    for k in range(len(tripLocations)):
-        item = tripLocations.iloc[k]
-        stop = tripLocations.index.values[k]
-        for i in item:
-            best_time = 60
-            best_location = stop
-            for j in range(len(travel_time_matrix)):
-                if(travel_time_matrix[0].iloc[j] == 1):
-                    try:
-                        if((travel_time_matrix[stop].iloc[j]) < best_time):
-                            best_time = travel_time_matrix[stop].iloc[j]
-                            best_location = travel_time_matrix.index.values[j]
-                    except:
-                        #print('stop ID ', stop, ' not in time matrix')
-                        pass
-            time_to_charge.append([i, stop, best_location, best_time])
-    time_to_charge = pd.DataFrame(time_to_charge, columns=['trip','stop', 'location', 'time'])
-    time_to_charge.set_index('trip', inplace=True)
+    # closest active charger is found once per stop, see charger_index.py
+    charger_index = nearest_active_charger(travel_time_matrix, tripLocations.index.values)
+    time_to_charge = build_time_to_charge(tripLocations, charger_index)
     
     
     #second loop through failed blocks to find how much you can charge at each point
-    charge_needed_list = []
-    ChargePoints = ''
-    for block in blockID_needing_charge:
-        FailedBlockCheck = failed_block_loop(df, block, start_charge_pct,
-                                               min_charge_threshold, time_of_year, eval_type, bus_type,
-                                               time_to_charge, min_charge_time, numberOchargers)
-        charge_needed_list.append([block, FailedBlockCheck[0]])
-        block_charge_options.append([block, FailedBlockCheck[1]])
-        ChargePoints = ChargePoints + ',' + FailedBlockCheck[2]
-        numberOchargers = FailedBlockCheck[3]
+    FailedBlockCheck = failed_blocks_scan(block_table, blockID_needing_charge, charge_required, start_charge_pct,
+                                          min_charge_threshold, time_to_charge, min_charge_time, numberOchargers)
+    charge_needed_list = FailedBlockCheck[0]
+    block_charge_options.extend(FailedBlockCheck[1])
+    numberOchargers = FailedBlockCheck[3]
     
     #uncomment to create tripLocations dataframe for new regression or subset of blocks 
     
-    time_to_charge.to_csv(datafilepath+'time_to_charge.csv')
-    temp = []
-    for i in range(len(numberOchargers)):
-        temp.append(max(numberOchargers['charger'].iloc[i]))
-        
-    numberOchargers['# needed'] = temp
-    numberOchargers.to_csv(datafilepath+'number_of_chargers.csv')
+    if datafilepath is not None:
+        time_to_charge.to_csv(datafilepath+'time_to_charge.csv')
+    # peak number of buses charging at once, see charger_occupancy.py
+    numberOchargers['# needed'] = [c.peak() for c in numberOchargers['charger']]
+    if datafilepath is not None:
+        numberOchargers.to_csv(datafilepath+'number_of_chargers.csv')
     
     #final loop through original loop to see how many failed blocks we have after charging
     print('\n\n##############################################################')
     print('Final Loop through with charging')
+    # every block in one scan, same checks as charge_status_via_trip_completion, see block_kernel.py
+    commute = commute_from_time_to_charge(block_table, time_to_charge)
+    _, _, _, failure = scan_blocks(block_table, charge_required, commute, start_charge_pct,
+                                   min_charge_threshold, min_charge_time, last_end_time = 60*27)
     final_tripFails = []
     final_blockID_needing_charge = []
-    for block in allBlocks:
-        blockCheck = charge_status_via_trip_completion(df, block, start_charge_pct, 
-                                      min_charge_threshold, time_of_year, eval_type,bus_type, 
-                                      min_charge_time, time_to_charge)
-    
-        if blockCheck != None:
-            final_tripFails.append(blockCheck[0])
-            final_blockID_needing_charge.append(blockCheck[1])
-            
-    final_tripFails = [i for i in final_tripFails if i != None]
-    final_blockID_needing_charge = [i for i in final_blockID_needing_charge if i != None]
+    for b in np.where(failure >= 0)[0]:
+        print('Trip ', block_table.trip_id[failure[b]], ' in block ', block_table.block_ids[b], ' incomplete due to insufficient charge level. Charge battery.')
+        final_tripFails.append(block_table.trip_id[failure[b]].item())
+        final_blockID_needing_charge.append(block_table.block_ids[b])
     print('\nNumber of failed blocks with charging: ', len(final_blockID_needing_charge))
+    
+    return {'tripFails': tripFails,
+            'blockID_needing_charge': blockID_needing_charge,
+            'charge_needed_list': charge_needed_list,
+            'block_charge_options': block_charge_options,
+            'tripLocations': tripLocations,
+            'time_to_charge': time_to_charge,
+            'numberOchargers': numberOchargers,
+            'final_tripFails': final_tripFails,
+            'final_blockID_needing_charge': final_blockID_needing_charge}
+
+
+
+
 
+### Run program
+
+if __name__ == '__main__':
+    
+    ### global vars
+    start_charge_pct = 90 # max charge at start 
+    min_charge_threshold = 30 # minimum allowed charge remaining
+    min_charge_time = 5 #minimum charging time in minutes
+    time_of_year = 'Winter' # seasonality var
+    eval_type = 'reg' # whether to eval charging profile by regression or worst case scenario
+    #set bus type to 'jumbo' for 60ft, anything else means 40'
+    bus_type = 'jumbo'
+    datafilepath = r'C:\cmu\Spring2023\System Synthesis\Github\PRT_Synthesis'
+    #choose 'eastLib' or 'brt' or 'allRoutes'
+    data = 'brt'
+    datafilepath = os.path.join(datafilepath, data) + '\\'
+    df = pd.read_csv(datafilepath+'trips_flattened_'+data+'.csv')
+    # typed arrays for the simulation, cached next to the csv (see trips_cache.py)
+    from trips_cache import load_block_table
+    block_table = load_block_table(datafilepath+'trips_flattened_'+data+'.csv')
+    travel_time_matrix = load_travel_time_matrix('stop_to_layover_travelTime.csv')
+    
+    # see scenario_sweep.py to run a grid of these settings
+    results = run_charging_assessment(df, start_charge_pct, min_charge_threshold, min_charge_time,
+                                      time_of_year, eval_type, bus_type, travel_time_matrix, datafilepath,
+                                      block_table)
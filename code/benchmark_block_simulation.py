@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark for the block simulation engine
+
+Times the vectorized failed block detection in block_simulation.py against
+looping charge_status_via_trip_completion over every block, and checks both
+return the same (trip_id, block_id) failures.
+
+Usage: python benchmark_block_simulation.py [eastLib|brt|allRoutes]
+
+"""
+
+import contextlib
+import io
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from BusMileage import charge_status_via_trip_completion
+from block_simulation import build_block_table, find_failed_blocks
+
+
+### global vars
+start_charge_pct = 90 # max charge at start
+min_charge_threshold = 30 # minimum allowed charge remaining
+min_charge_time = 5 #minimum charging time in minutes
+time_of_year = 'Winter' # seasonality var
+eval_type = 'reg' # whether to eval charging profile by regression or worst case scenario
+bus_type = 'jumbo'
+repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def run_original(df):
+    tripFails = []
+    # charge_status_via_trip_completion prints every failure
+    with contextlib.redirect_stdout(io.StringIO()):
+        for block in np.unique(df.block_id):
+            blockCheck = charge_status_via_trip_completion(df, block, start_charge_pct,
+                                          min_charge_threshold, time_of_year, eval_type, bus_type,
+                                          min_charge_time)
+            if blockCheck != None:
+                tripFails.append(blockCheck)
+    return tripFails
+
+
+def run_vectorized(df):
+    block_table = build_block_table(df)
+    return find_failed_blocks(block_table, start_charge_pct, min_charge_threshold,
+                              time_of_year, eval_type, bus_type)
+
+
+if __name__ == '__main__':
+
+    data = sys.argv[1] if len(sys.argv) > 1 else 'allRoutes'
+    df = pd.read_csv(os.path.join(repo_path, data, 'trips_flattened_'+data+'.csv'))
+    print('Trips: ', len(df), ' Blocks: ', len(np.unique(df.block_id)))
+
+    t0 = time.perf_counter()
+    original = run_original(df)
+    original_time = time.perf_counter() - t0
+
+    # best of several runs, the vectorized engine runs in milliseconds
+    vectorized_times = []
+    for i in range(5):
+        t0 = time.perf_counter()
+        vectorized = run_vectorized(df)
+        vectorized_times.append(time.perf_counter() - t0)
+    vectorized_time = min(vectorized_times)
+
+    original = [(int(t), b) for t, b in original]
+    assert original == vectorized, 'vectorized engine does not match charge_status_via_trip_completion'
+
+    print('Failed blocks: ', len(vectorized))
+    print('charge_status_via_trip_completion loop: %.3f s' % original_time)
+    print('block_simulation.find_failed_blocks:    %.4f s' % vectorized_time)
+    print('Speedup: %.0fx' % (original_time / vectorized_time))
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Block Kernel
+
+Compiled sequential scan for block simulation with layover charging. Charging
+stops at start_charge_pct, so each trip's state of charge depends on the one
+before it and can't be written as a cumulative sum. The scan runs over the trip
+arrays of all blocks laid end to end (block offsets as in BlockTable) in one
+call, with the same checks as charge_status_via_trip_completion (with
+time_to_charge) and failed_block_loop in BusMileage.py, trip for trip.
+
+Chargers with a taper are read off their compiled state of charge vs time
+lookup table (see charger_model.py), linear chargers use the rate directly.
+
+The scan is compiled with numba when it is installed, and runs as plain Python
+otherwise (same results, slower).
+
+Usage: python block_kernel.py [eastLib|brt|allRoutes]
+
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from block_simulation import build_block_table, block_charge_required
+from charger_model import get_charger_type
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def _scan(offsets, start_min, end_min, charge_required, commute, pct_gain, minutes, curve, grid_offsets,
+          time_grid, soc_grid, start_charge_pct, min_charge_threshold, min_charge_time, last_end_time,
+          stop_at_failure):
+    n_blocks = len(offsets) - 1
+    charge_level = np.full(len(start_min), np.nan)
+    added = np.zeros(len(start_min))
+    charged = np.zeros(len(start_min), dtype=np.bool_)
+    failure = np.full(n_blocks, -1, dtype=np.int64)
+    for b in range(n_blocks):
+        current = start_charge_pct[b]
+        last_end = last_end_time
+        for i in range(offsets[b], offsets[b+1]):
+            start_time = start_min[i]
+            if start_time - last_end > min_charge_time and not np.isnan(commute[i]):
+                charge_time = start_time - last_end - 2*commute[i]
+                if charge_time > min_charge_time:
+                    # Bus.chargeBus, clamped at start_charge_pct
+                    c = curve[i]
+                    if c < 0:
+                        added_charge = charge_time*pct_gain[i]/minutes[i]
+                    else:
+                        # ChargerType.added, on the curve's lookup table
+                        times = time_grid[grid_offsets[c]:grid_offsets[c+1]]
+                        socs = soc_grid[grid_offsets[c]:grid_offsets[c+1]]
+                        # constant current up to 0% from a negative state of charge
+                        end_time = np.interp(max(current, 0.0), socs, times) - max(-current, 0.0)/(pct_gain[i]/minutes[i]) \
+                            + charge_time
+                        if end_time < 0:
+                            soc = end_time*(pct_gain[i]/minutes[i])
+                        else:
+                            soc = np.interp(end_time, times, socs)
+                        added_charge = max(soc - current, 0.0)
+                    if current + added_charge > start_charge_pct[b]:
+                        added_charge = start_charge_pct[b] - current
+                    if added_charge < 0:
+                        added_charge = 0.0
+                    current = current + added_charge
+                    added[i] = added_charge
+                    charged[i] = True
+            last_end = end_min[i]
+            charge_depletion = current - charge_required[i]
+            charge_level[i] = charge_depletion
+            if charge_depletion < min_charge_threshold and failure[b] < 0:
+                failure[b] = i
+                if stop_at_failure:
+                    break
+            current = charge_depletion
+    return charge_level, added, charged, failure
+
+
+_compiled_scan = None if njit is None else njit(cache=True)(_scan)
+
+
+# charging curve of each trip's charger
+def charger_curves(chargerType, n):
+    '''
+    Parameters
+    ----------
+    chargerType : str, ChargerType or array like
+        one charger type for every trip, or one per trip
+    n : int
+        number of trips
+
+    Returns
+    -------
+    list: pct_gain and minutes per trip (see ChargerType), index of each trip's
+    lookup table (-1 for linear chargers), and the lookup tables of the tapered
+    types laid end to end: table offsets, time_grid and soc_grid
+    '''
+    single = isinstance(chargerType, str) or not hasattr(chargerType, '__len__')
+    names = pd.Series([chargerType] if single else list(chargerType), dtype=object)
+    names = names.map(lambda c: c if isinstance(c, str) else c.name)
+    types = {name: get_charger_type(c) for name, c in zip(names, [chargerType] if single else chargerType)}
+    tapered = [name for name, t in types.items() if t.soc_grid is not None]
+    grid_offsets = np.cumsum([0] + [len(types[name].soc_grid) for name in tapered]).astype(np.int64)
+    time_grid = np.concatenate([np.zeros(0)] + [types[name].time_grid for name in tapered]).astype(float)
+    soc_grid = np.concatenate([np.zeros(0)] + [types[name].soc_grid for name in tapered]).astype(float)
+    pct_gain = names.map({name: float(t.pct_gain) for name, t in types.items()}).values.astype(float)
+    minutes = names.map({name: float(t.minutes) for name, t in types.items()}).values.astype(float)
+    curve = names.map({name: (tapered.index(name) if name in tapered else -1) for name in types}).values.astype(np.int64)
+    if single:
+        pct_gain, minutes, curve = np.full(n, pct_gain[0]), np.full(n, minutes[0]), np.full(n, curve[0])
+    return [pct_gain, minutes, curve, grid_offsets, time_grid, soc_grid]
+
+
+# layover charging simulation of every block in one call
+def scan_blocks(block_table, charge_required, commute, start_charge_pct, min_charge_threshold, min_charge_time,
+                last_end_time=60*27, stop_at_failure=True, chargerType='Faster'):
+    '''
+    Parameters
+    ----------
+    block_table : BlockTable
+    charge_required : np.array
+        charge used by each trip, see block_charge_required
+    commute : np.array
+        travel time (minutes) from the start stop of each trip to its charger,
+        np.nan when the trip can't charge (not in time_to_charge)
+    start_charge_pct : float or np.array
+        charging pct of bus at "full charge", for every block or one per block
+    min_charge_threshold : float
+        min allowed charge for bus to take a trip.
+    min_charge_time: int
+        minimum number of minutes required for charge to happen.
+    last_end_time : float
+        end time used for the layover before the first trip, 60*27 in
+        charge_status_via_trip_completion and 60*24 in failed_block_loop
+    stop_at_failure : bool
+        stop each block at its first trip finishing below min_charge_threshold
+        (charge_status_via_trip_completion), or run every block to the end (failed_block_loop)
+    chargerType : str or array like
+        charger type for every trip or per trip (see charger_model.py)
+
+    Returns
+    -------
+    list
+        state of charge after each trip (nan after a block stops), charge added
+        in the layover before each trip, whether the bus charged before each
+        trip, and index into the trip arrays of each block's first failing
+        trip (-1 if the block completes)
+    '''
+    curves = charger_curves(chargerType, len(block_table))
+    start_charge_pct = np.broadcast_to(np.asarray(start_charge_pct, dtype=float),
+                                       block_table.block_ids.shape).copy()
+    scan = _scan if _compiled_scan is None else _compiled_scan
+    charge_level, added, charged, failure = scan(np.asarray(block_table.offsets, dtype=np.int64),
+                                                 np.asarray(block_table.start_min, dtype=float),
+                                                 np.asarray(block_table.end_min, dtype=float),
+                                                 np.asarray(charge_required, dtype=float),
+                                                 np.asarray(commute, dtype=float), *curves,
+                                                 start_charge_pct, float(min_charge_threshold),
+                                                 float(min_charge_time), float(last_end_time),
+                                                 bool(stop_at_failure))
+    return [charge_level, added, charged, failure]
+
+
+# travel time to the charger of each trip, from time_to_charge in BusMileage.py
+def commute_from_time_to_charge(block_table, time_to_charge):
+    '''
+    Returns
+    -------
+    np.array: time_to_charge['time'] per trip, np.nan for trips not in it
+    '''
+    if time_to_charge is None:
+        return np.full(len(block_table), np.nan)
+    return pd.Series(block_table.trip_id).map(time_to_charge['time']).values.astype(float)
+
+
+if __name__ == '__main__':
+
+    from BusMileage import load_travel_time_matrix
+    from contention_simulation import trip_chargers
+
+    ### global vars
+    start_charge_pct = 90 # max charge at start
+    min_charge_threshold = 30 # minimum allowed charge remaining
+    min_charge_time = 5 #minimum charging time in minutes
+    time_of_year = 'Winter' # seasonality var
+    eval_type = 'reg' # whether to eval charging profile by regression or worst case scenario
+    bus_type = 'jumbo'
+    data = sys.argv[1] if len(sys.argv) > 1 else 'allRoutes'
+
+    df = pd.read_csv(os.path.join(repo_path, data, 'trips_flattened_'+data+'.csv'))
+    block_table = build_block_table(df)
+    charge_required = block_charge_required(block_table, time_of_year, bus_type, eval_type)
+    travel_time_matrix = load_travel_time_matrix(os.path.join(repo_path, 'dataGenerated', 'stop_to_layover_travelTime.csv'))
+    _, commute = trip_chargers(block_table, travel_time_matrix)
+
+    print('Compiled with numba: ', _compiled_scan is not None)
+    # first call compiles
+    scan_blocks(block_table, charge_required, commute, start_charge_pct, min_charge_threshold, min_charge_time)
+    t0 = time.perf_counter()
+    charge_level, added, charged, failure = scan_blocks(block_table, charge_required, commute, start_charge_pct,
+                                                        min_charge_threshold, min_charge_time)
+    print('Blocks: ', len(block_table.block_ids), ' failed with charging: ', (failure >= 0).sum(),
+          ' charge sessions: ', charged.sum(), ' scan: %.4f s' % (time.perf_counter() - t0))
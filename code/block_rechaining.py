@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Block Rechaining
+
+Reassembles the trips of each service day (GTFS service_id) into new blocks
+that an electric bus can complete on one charge, instead of keeping the GTFS
+block_id chains and adding chargers where they fail. Trips are the nodes of a
+time ordered compatibility graph: a bus can run trip j after trip i of the same
+service when it can deadhead from i's end stop to j's start stop and still make
+j's start time.
+
+The energy constraint (charge after every trip and deadhead stays at or above
+min_charge_threshold, using get_charge_required) depends on the whole chain
+before a trip, so it can't be an arc cost of a min-cost flow. Trips are instead
+assigned in order of start time, every start minute is one min-cost assignment
+(scipy linear_sum_assignment) of its trips to the buses that can reach them
+with enough charge, or to new buses. Graph edges are only built for the buses
+and trips of the current minute, so the full allRoutes day runs in seconds.
+
+Deadhead times are from a stop to stop matrix laid out like
+stop_to_layover_travelTime.csv (minutes), or estimated from the stop
+coordinates with the straight-line screening estimate of travel_time_engine.py.
+No layover charging is assumed, see BusMileage.py for adding chargers.
+
+Usage: python block_rechaining.py [eastLib|brt|allRoutes]
+
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import linear_sum_assignment
+
+from block_simulation import (block_charge_required, block_table_from_columns, build_block_table, charge_trajectory,
+                              first_failure)
+from energy_model import charge_required
+from travel_time_engine import DETOUR_FACTOR, SCREENING_SPEED_MPH, haversine_travel_matrices
+
+
+repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# minimum minutes between arriving at a trip's start stop and its start
+MIN_LAYOVER_MINUTES = 0
+# longest deadhead allowed between two trips of a block
+MAX_DEADHEAD_MINUTES = 30
+# assignment costs, in minutes: a new bus, each deadhead minute and each idle minute
+VEHICLE_COST = 24*60
+DEADHEAD_WEIGHT = 1
+IDLE_WEIGHT = 0.1
+# cost of pairs that aren't allowed, never chosen since every trip can take a new bus
+INFEASIBLE_COST = 1e12
+
+
+# coordinates of the start and end stops in trips_flattened_w_geo.csv
+def stops_from_trips_geo(trips_geo):
+    '''
+    Returns
+    -------
+    dataframe: stop_id, stop_lat, stop_lon, one row per stop
+    '''
+    start = trips_geo[['start_stop_id', 'start_stop_lat', 'start_stop_lon']]
+    end = trips_geo[['end_stop_id', 'end_stop_lat', 'end_stop_lon']]
+    start.columns = end.columns = ['stop_id', 'stop_lat', 'stop_lon']
+    return pd.concat([start, end]).drop_duplicates('stop_id').reset_index(drop = True)
+
+
+# deadhead time and distance between every pair of stops
+def deadhead_matrix(stop_ids, stops=None, travel_minutes=None, detour_factor=DETOUR_FACTOR,
+                    speed_mph=SCREENING_SPEED_MPH):
+    '''
+    Parameters
+    ----------
+    stop_ids : np.array
+        stops of the matrix, origins and destinations in the same order
+    stops : dataframe, optional
+        stop_id, stop_lat and stop_lon, for the straight-line estimate
+    travel_minutes : dataframe, optional
+        minutes from the index stops to the column stops (stop_to_layover_travelTime.csv
+        layout), used instead of the estimate where given
+    detour_factor, speed_mph :
+        straight-line estimate settings, see haversine_travel_matrices
+
+    Returns
+    -------
+    list: minutes and miles, stop_ids x stop_ids, 0 from a stop to itself and
+    inf (minutes) where there is no time. Miles from travel_minutes are at speed_mph.
+    '''
+    n = len(stop_ids)
+    minutes = np.full((n, n), np.inf)
+    miles = np.full((n, n), np.nan)
+    if stops is not None:
+        coordinates = stops.assign(stop_id = stops.stop_id.astype(str)).drop_duplicates('stop_id')
+        coordinates = coordinates.set_index('stop_id').reindex(pd.Index(stop_ids).astype(str))
+        distance, seconds = haversine_travel_matrices(coordinates.stop_lat.values, coordinates.stop_lon.values,
+                                                      coordinates.stop_lat.values, coordinates.stop_lon.values,
+                                                      detour_factor, speed_mph)
+        known = ~np.isnan(seconds)
+        minutes[known] = seconds[known]/60
+        miles[known] = distance[known]
+    if travel_minutes is not None:
+        given = travel_minutes.copy()
+        given.index = given.index.astype(str)
+        given.columns = given.columns.astype(str)
+        given = given.loc[~given.index.duplicated(), ~given.columns.duplicated()]
+        given = given.reindex(index=pd.Index(stop_ids).astype(str), columns=pd.Index(stop_ids).astype(str)).values
+        known = ~np.isnan(given)
+        minutes[known] = given[known]
+        miles[known] = given[known]/60*speed_mph
+    np.fill_diagonal(minutes, 0)
+    np.fill_diagonal(miles, 0)
+    return [minutes, miles]
+
+
+# assigns every trip to a bus, one min-cost assignment per start minute
+def rechain_blocks(block_table, trip_charge, deadhead_minutes, deadhead_charge, stop_ids, start_charge_pct,
+                   min_charge_threshold, service_id=None, min_layover=MIN_LAYOVER_MINUTES,
+                   max_deadhead=MAX_DEADHEAD_MINUTES, vehicle_cost=VEHICLE_COST, deadhead_weight=DEADHEAD_WEIGHT,
+                   idle_weight=IDLE_WEIGHT):
+    '''
+    Parameters
+    ----------
+    block_table : BlockTable
+    trip_charge : np.array
+        charge used by each trip, see block_charge_required
+    deadhead_minutes, deadhead_charge : np.array
+        stop_ids x stop_ids deadhead time (see deadhead_matrix) and charge used
+        on the deadhead (see deadhead_charge_matrix)
+    stop_ids : np.array
+        stops of the deadhead matrices
+    start_charge_pct : float
+        charging pct of bus at "full charge"
+    min_charge_threshold : float
+        min allowed charge for bus to take a trip.
+    service_id : np.array, optional
+        service (day type) of each trip, see trip_services. Trips of different
+        services run on different days and never share a bus. All trips are one
+        service day if None.
+    min_layover : float
+        minutes between arriving at a trip's start stop and its start
+    max_deadhead : float
+        longest deadhead (minutes) between two trips of a block
+    vehicle_cost, deadhead_weight, idle_weight :
+        assignment costs (minutes) of a new bus, a deadhead minute and an idle minute
+
+    Purpose
+    --------
+    Trips starting at the same minute are assigned together. A bus can take a
+    trip when it reaches the trip's start stop in time and its charge after the
+    deadhead and the trip stays at or above min_charge_threshold. Otherwise the
+    trip starts a new bus at start_charge_pct (a trip that can't be run from
+    start_charge_pct still gets its own bus, and fails).
+
+    Returns
+    -------
+    dataframe: one row per trip of block_table (same order) with trip_id,
+    block_id (GTFS), service_id, new_block_id (bus number, in order of first trip),
+    deadhead_minutes and deadhead_charge before the trip, and charge_level
+    after the trip
+    '''
+    n = len(block_table)
+    stop_index = pd.Index(stop_ids).astype(str)
+    start_stop = stop_index.get_indexer(pd.Index(block_table.start_stop_id).astype(str))
+    end_stop = stop_index.get_indexer(pd.Index(block_table.end_stop_id).astype(str))
+    if (start_stop < 0).any() or (end_stop < 0).any():
+        raise ValueError('trip stops missing from stop_ids')
+    service_id = np.zeros(n, dtype=np.int64) if service_id is None else np.asarray(service_id)
+
+    # bus state, at most one bus per trip
+    bus_end = np.zeros(n)
+    bus_stop = np.zeros(n, dtype=np.int64)
+    bus_charge = np.zeros(n)
+    bus_service = np.empty(n, dtype=service_id.dtype)
+    n_buses = 0
+    new_block = np.full(n, -1, dtype=np.int64)
+    trip_deadhead = np.zeros(n)
+    trip_deadhead_charge = np.zeros(n)
+    charge_level = np.zeros(n)
+
+    order = np.argsort(block_table.start_min, kind='stable')
+    minutes, first = np.unique(block_table.start_min[order], return_index=True)
+    for start, trips in zip(minutes, np.split(order, first[1:])):
+        # buses that are free in time, with their deadhead to each trip of the minute
+        free = np.flatnonzero(bus_end[:n_buses] + min_layover <= start)
+        deadhead = deadhead_minutes[bus_stop[free][:, None], start_stop[trips][None, :]]
+        used = deadhead_charge[bus_stop[free][:, None], start_stop[trips][None, :]] + trip_charge[trips][None, :]
+        feasible = ((bus_end[free][:, None] + deadhead + min_layover <= start) & (deadhead <= max_deadhead)
+                    & (bus_charge[free][:, None] - used >= min_charge_threshold)
+                    & (bus_service[free][:, None] == service_id[trips][None, :]))
+        idle = start - bus_end[free][:, None] - deadhead
+        cost = np.where(feasible, deadhead_weight*deadhead + idle_weight*idle, INFEASIBLE_COST)
+        # one new bus column per trip
+        new_bus = np.full((len(trips), len(trips)), INFEASIBLE_COST)
+        np.fill_diagonal(new_bus, vehicle_cost)
+        rows, columns = linear_sum_assignment(np.hstack([cost.T, new_bus]))
+
+        for row, column in zip(rows, columns):
+            t = trips[row]
+            if column < len(free):
+                b = free[column]
+                trip_deadhead[t] = deadhead[column, row]
+                trip_deadhead_charge[t] = used[column, row] - trip_charge[t]
+            else:
+                b = n_buses
+                n_buses += 1
+                bus_charge[b] = start_charge_pct
+                bus_service[b] = service_id[t]
+            bus_charge[b] = bus_charge[b] - trip_deadhead_charge[t] - trip_charge[t]
+            bus_end[b] = block_table.end_min[t]
+            bus_stop[b] = end_stop[t]
+            new_block[t] = b
+            charge_level[t] = bus_charge[b]
+
+    # buses numbered in order of their first trip
+    return pd.DataFrame({'trip_id': block_table.trip_id,
+                         'block_id': np.repeat(block_table.block_ids, np.diff(block_table.offsets)),
+                         'service_id': service_id,
+                         'new_block_id': new_block,
+                         'deadhead_minutes': trip_deadhead,
+                         'deadhead_charge': trip_deadhead_charge,
+                         'charge_level': charge_level})
+
+
+# service (day type) of every trip in the block table
+def trip_services(block_table, trips_flattened_df):
+    '''
+    Returns
+    -------
+    np.array: service_id_start of each trip of block_table, from the flattened
+    trips dataset. Each GTFS calendar service is its own service day.
+    '''
+    service = pd.Series(trips_flattened_df.service_id_start.values, index=trips_flattened_df.trip_id.values)
+    return service.reindex(block_table.trip_id).values
+
+
+# charge used on the deadhead between every pair of stops
+def deadhead_charge_matrix(deadhead_minutes, deadhead_miles, time_of_year, bus_type, eval_type, coefficients=None):
+    '''
+    Returns
+    -------
+    np.array: battery percentage used (energy_model.charge_required on the
+    deadhead distance and time), 0 from a stop to itself and where there is no deadhead time
+    '''
+    known = np.isfinite(deadhead_minutes) & (deadhead_minutes > 0)
+    charge = np.zeros(deadhead_minutes.shape)
+    charge[known] = charge_required(np.nan_to_num(deadhead_miles[known]), deadhead_minutes[known],
+                                    time_of_year, bus_type, eval_type, coefficients)
+    return charge
+
+
+# block table of the new blocks, trips in order of start time within a block
+def rechained_block_table(block_table, rechained):
+    '''
+    Parameters
+    ----------
+    rechained : dataframe
+        output of rechain_blocks
+
+    Returns
+    -------
+    BlockTable: same trips with new_block_id as the block id, e.g. for find_failed_blocks
+    '''
+    order = np.lexsort((block_table.start_min, rechained.new_block_id.values))
+    columns = {'block_id': rechained.new_block_id.values[order]}
+    for column in ['trip_id', 'route_id', 'start_stop_id', 'end_stop_id', 'start_min', 'end_min',
+                   'distance', 'duration']:
+        columns[column] = getattr(block_table, column)[order]
+    return block_table_from_columns(columns)
+
+
+# buses, failed blocks and deadhead of the GTFS blocks and the new blocks
+def rechaining_summary(block_table, trip_charge, rechained, start_charge_pct, min_charge_threshold):
+    '''
+    Returns
+    -------
+    dataframe: one row each for the GTFS blocks and the new blocks, with blocks,
+    failed_blocks (a trip finishing below min_charge_threshold, no layover
+    charging), deadhead_minutes and trips_per_block
+    '''
+    gtfs_level = charge_trajectory(block_table, start_charge_pct, trip_charge)
+    gtfs_failed = (first_failure(block_table, gtfs_level, min_charge_threshold) >= 0).sum()
+    new_failed = rechained[rechained.charge_level < min_charge_threshold].new_block_id.nunique()
+    blocks = [len(block_table.block_ids), rechained.new_block_id.nunique()]
+    return pd.DataFrame({'blocks': blocks,
+                         'failed_blocks': [gtfs_failed, new_failed],
+                         'deadhead_minutes': [np.nan, rechained.deadhead_minutes.sum()],
+                         'trips_per_block': [len(block_table)/b for b in blocks]},
+                        index=['gtfs', 'rechained'])
+
+
+if __name__ == '__main__':
+
+    ### global vars
+    start_charge_pct = 90 # max charge at start
+    min_charge_threshold = 30 # minimum allowed charge remaining
+    time_of_year = 'Winter' # seasonality var
+    eval_type = 'reg' # whether to eval charging profile by regression or worst case scenario
+    bus_type = 'jumbo'
+    data = sys.argv[1] if len(sys.argv) > 1 else 'allRoutes'
+
+    df = pd.read_csv(os.path.join(repo_path, data, 'trips_flattened_'+data+'.csv'))
+    block_table = build_block_table(df)
+    stops = stops_from_trips_geo(pd.read_csv(os.path.join(repo_path, 'dataGenerated', 'trips_flattened_w_geo.csv')))
+    stop_ids = np.unique(np.concatenate([block_table.start_stop_id, block_table.end_stop_id]).astype(str))
+
+    t0 = time.perf_counter()
+    trip_charge = block_charge_required(block_table, time_of_year, bus_type, eval_type)
+    deadhead_minutes, deadhead_miles = deadhead_matrix(stop_ids, stops)
+    deadhead_charge = deadhead_charge_matrix(deadhead_minutes, deadhead_miles, time_of_year, bus_type, eval_type)
+    rechained = rechain_blocks(block_table, trip_charge, deadhead_minutes, deadhead_charge, stop_ids,
+                               start_charge_pct, min_charge_threshold, trip_services(block_table, df))
+    print('Trips: ', len(block_table), ' rechained in %.1f s' % (time.perf_counter() - t0))
+    print(rechaining_summary(block_table, trip_charge, rechained, start_charge_pct, min_charge_threshold))
+    print(rechained.groupby('service_id').agg(gtfs_blocks = ('block_id', 'nunique'),
+                                              rechained_blocks = ('new_block_id', 'nunique')))
+    rechained.to_csv('rechained_blocks_'+data+'.csv', index = False)
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Block Simulation Engine
+
+Vectorized version of the block checks in BusMileage.py. Trips are grouped by
+block_id once, and every block's charge trajectory is computed from NumPy arrays
+instead of re-filtering the flattened trips dataframe for every trip.
+
+"""
+
+import numpy as np
+
+from BusMileage import Bus, get_charge_required
+from charger_model import charge_added
+from energy_model import charge_required
+
+
+# create BlockTable class
+class BlockTable:
+    """
+    BlockTable holds the flattened trips dataset as arrays, with the trips of
+    each block stored contiguously (same order as the dataset within a block).
+
+    Attributes of the class include:
+        - block_ids: unique block ids, sorted (same order as np.unique)
+        - offsets: start index of each block in the trip arrays, plus the total length
+        - trip_id, route_id, start_stop_id, end_stop_id
+        - start_min, end_min: trip start/end times in minutes after midnight
+        - distance: total distance traveled (miles)
+        - duration: trip duration (minutes)
+        - pattern_table: PatternTable the table was expanded from (see
+          pattern_table.py), None if it was built trip by trip
+    """
+
+    def __init__(self):
+        self.block_ids = None
+        self.pattern_table = None
+        self.offsets = None
+        self.trip_id = None
+        self.route_id = None
+        self.start_stop_id = None
+        self.end_stop_id = None
+        self.start_min = None
+        self.end_min = None
+        self.distance = None
+        self.duration = None
+
+    def __len__(self):
+        return len(self.trip_id)
+
+    @property
+    def block_index(self):
+        '''
+        Returns
+        -------
+        np.array: position in block_ids of the block each trip belongs to
+        '''
+        return np.repeat(np.arange(len(self.block_ids)), np.diff(self.offsets))
+
+    @property
+    def is_first_trip(self):
+        '''
+        Returns
+        -------
+        np.array of bool: True for the first trip of each block
+        '''
+        first = np.zeros(len(self), dtype=bool)
+        first[self.offsets[:-1]] = True
+        return first
+
+    def block_slice(self, blockID):
+        '''
+        Returns
+        -------
+        slice: position of the trips of blockID in the trip arrays
+        '''
+        b = np.searchsorted(self.block_ids, blockID)
+        if b == len(self.block_ids) or self.block_ids[b] != blockID:
+            raise KeyError('block ' + str(blockID) + ' not in block table')
+        return slice(self.offsets[b], self.offsets[b+1])
+
+
+# convert 'H:MM:SS' time strings (hours can be >= 24) to minutes after midnight
+def time_to_minutes(times):
+    '''
+    Parameters
+    ----------
+    times : pd.Series of str
+        GTFS style times, e.g. '5:37:00' or '25:10:00'
+
+    Returns
+    -------
+    np.array: float minutes after midnight, same as int(h)*60 + int(m) + int(s)/60
+    '''
+    hms = times.astype(str).str.split(':', expand=True).astype(int).values.reshape(-1, 3)
+    return hms[:, 0]*60 + hms[:, 1] + hms[:, 2]/60
+
+
+# build the block table from the output of create_trips_flattened.py
+def build_block_table(trips_flattened_df):
+    '''
+    Parameters
+    ----------
+    trips_flattened_df : dataframe
+        output of the create_trips_flattened.py file, block-trip level dataset on the drive.
+
+    Purpose
+    --------
+    Groups trips by block once and stores the trip attributes used by the
+    simulation as arrays, so that no dataframe filtering is needed per trip.
+
+    Returns
+    -------
+    BlockTable
+    '''
+    df = trips_flattened_df
+    return block_table_from_columns({'trip_id': df.trip_id.values,
+                                     'block_id': df.block_id.values,
+                                     'route_id': df.route_id.values,
+                                     'start_stop_id': df.start_stop_id.values,
+                                     'end_stop_id': df.end_stop_id.values,
+                                     'start_min': time_to_minutes(df.trip_start_time),
+                                     'end_min': time_to_minutes(df.trip_end_time),
+                                     'distance': df.total_distance_traveled.values.astype(float),
+                                     'duration': df.timeDelta_minutes.values.astype(float)})
+
+
+# build the block table from trip level arrays (see build_block_table and trips_cache.py)
+def block_table_from_columns(columns):
+    '''
+    Parameters
+    ----------
+    columns : dict
+        trip level arrays for trip_id, block_id, route_id, start_stop_id,
+        end_stop_id, start_min, end_min, distance and duration
+
+    Returns
+    -------
+    BlockTable
+    '''
+    # stable sort keeps the dataset order of the trips within a block
+    order = np.argsort(columns['block_id'], kind='stable')
+
+    table = BlockTable()
+    table.block_ids, starts = np.unique(columns['block_id'][order], return_index=True)
+    table.offsets = np.append(starts, len(order))
+    for column in ['trip_id', 'route_id', 'start_stop_id', 'end_stop_id',
+                   'start_min', 'end_min', 'distance', 'duration']:
+        setattr(table, column, np.asarray(columns[column])[order])
+    return table
+
+
+# charge used by every trip in the table
+def block_charge_required(block_table, time_of_year, bus_type, eval_type, grades=None, coefficients=None):
+    '''
+    Parameters
+    ----------
+    grades : dataframe, optional
+        climb_m and descent_m per trip, see grade_energy.trip_grades
+    coefficients : dataframe, optional
+        coefficient table, see energy_model.load_coefficients. Grades only count
+        with ClimbBeta/DescentBeta terms, e.g. from grade_energy.grade_coefficients
+
+    Purpose
+    --------
+    Tables expanded from a PatternTable (e.g. trips_cache.load_block_table) are
+    evaluated once per pattern and trip duration, unless per trip grades are given.
+
+    Returns
+    -------
+    np.array: battery percentage required to complete each trip, see get_charge_required
+    '''
+    if block_table.pattern_table is not None and grades is None:
+        return block_table.pattern_table.charge_required(time_of_year, bus_type, eval_type, coefficients)
+    if grades is None and coefficients is None:
+        return get_charge_required(block_table.distance, block_table.duration,
+                                   time_of_year, bus_type, eval_type)
+    return charge_required(block_table.distance, block_table.duration, time_of_year, bus_type, eval_type,
+                           coefficients, climb=None if grades is None else grades.climb_m.values,
+                           descent=None if grades is None else grades.descent_m.values)
+
+
+# charge remaining at the end of every trip when no layover charging is allowed
+def charge_trajectory(block_table, start_charge_pct, charge_required):
+    '''
+    Parameters
+    ----------
+    block_table : BlockTable
+    start_charge_pct : float
+        charging pct of bus at "full charge"
+    charge_required : np.array
+        charge used by each trip, see block_charge_required
+
+    Returns
+    -------
+    np.array: state of charge after each trip, the running charge is reset to
+    start_charge_pct at the start of every block
+    '''
+    used = np.cumsum(charge_required)
+    # cumulative charge used before the first trip of each block
+    before_block = np.append(0, used)[block_table.offsets[:-1]]
+    return start_charge_pct - (used - np.repeat(before_block, np.diff(block_table.offsets)))
+
+
+# charge remaining at the end of every trip with layover charging, all blocks at once
+def charging_trajectory(block_table, start_charge_pct, charge_required, commute, min_charge_time,
+                        last_end_time=60*27):
+    '''
+    Parameters
+    ----------
+    block_table : BlockTable
+    start_charge_pct : float or np.array
+        charging pct of bus at "full charge", for every block or one per block
+    charge_required : np.array
+        charge used by each trip, see block_charge_required
+    commute : np.array
+        travel time (minutes) from the start stop of each trip to its charger,
+        np.nan when the trip can't charge
+    min_charge_time: int
+        minimum number of minutes required for charge to happen.
+    last_end_time : float
+        end time used for the layover before the first trip, see simulate_block
+
+    Purpose
+    --------
+    Same layover charging as simulate_block(..., stop_at_failure=False), stepping
+    through the n-th trip of every block at once instead of one block at a time.
+
+    Returns
+    -------
+    list: state of charge after each trip and charge added in the layover before each trip
+    '''
+    first = block_table.offsets[:-1]
+    lengths = np.diff(block_table.offsets)
+    start_charge_pct = np.broadcast_to(np.asarray(start_charge_pct, dtype=float), first.shape)
+    current = start_charge_pct.copy()
+    last_end = np.full(len(first), float(last_end_time))
+    charge_level = np.zeros(len(block_table))
+    added = np.zeros(len(block_table))
+    for n in range(lengths.max() if len(lengths) > 0 else 0):
+        blocks = np.where(lengths > n)[0]
+        i = first[blocks] + n
+        start_time = block_table.start_min[i]
+        charge_time = start_time - last_end[blocks] - 2*commute[i]
+        charging = ((start_time - last_end[blocks] > min_charge_time) & ~np.isnan(commute[i])
+                    & (charge_time > min_charge_time))
+        added_charge = charge_added(current[blocks[charging]], charge_time[charging],
+                                    start_charge_pct[blocks[charging]], 'Faster')
+        current[blocks[charging]] = current[blocks[charging]] + added_charge
+        added[i[charging]] = added_charge
+        current[blocks] = current[blocks] - charge_required[i]
+        charge_level[i] = current[blocks]
+        last_end[blocks] = block_table.end_min[i]
+    return [charge_level, added]
+
+
+# index of the first failing trip of each block
+def first_failure(block_table, charge_level, min_charge_threshold):
+    '''
+    Returns
+    -------
+    np.array: for each block, index into the trip arrays of the first trip
+    finishing below min_charge_threshold, or -1 when the block completes
+    '''
+    n = len(block_table)
+    idx = np.where(charge_level < min_charge_threshold, np.arange(n), n)
+    first = np.minimum.reduceat(idx, block_table.offsets[:-1])
+    first[first == n] = -1
+    return first
+
+
+# vectorized equivalent of looping charge_status_via_trip_completion over every block
+def find_failed_blocks(block_table, start_charge_pct, min_charge_threshold,
+                       time_of_year, eval_type, bus_type):
+    '''
+    Parameters
+    ----------
+    block_table : BlockTable
+        output of build_block_table
+    start_charge_pct : float
+        charging pct of bus at "full charge"
+    min_charge_threshold : float
+        min allowed charge for bus to take a trip.
+    time_of_year: str, takes values ("Winter", or "Summer")
+    eval_type: str, 'reg' or 'wc'
+    bus_type: str, 'jumbo' for 60 ft buses
+
+    Purpose
+    --------
+    For every block at once, find the first trip that can't be completed before
+    hitting the minimum charge threshold. Layover charging is not allowed.
+
+    Returns
+    -------
+    list of (trip_id, block_id) for each failed block, same as collecting the
+    returns of charge_status_via_trip_completion in block order
+    '''
+    charge_required = block_charge_required(block_table, time_of_year, bus_type, eval_type)
+    charge_level = charge_trajectory(block_table, start_charge_pct, charge_required)
+    first = first_failure(block_table, charge_level, min_charge_threshold)
+    failed = first >= 0
+    return list(zip(block_table.trip_id[first[failed]].tolist(),
+                    block_table.block_ids[failed].tolist()))
+
+
+# sequential simulation of one block with layover charging, array version of
+# charge_status_via_trip_completion (with time_to_charge) and failed_block_loop
+def simulate_block(block_table, b, charge_required, commute, start_charge_pct, min_charge_threshold,
+                   min_charge_time, last_end_time=60*27, stop_at_failure=True):
+    '''
+    Parameters
+    ----------
+    block_table : BlockTable
+    b : int
+        position of the block in block_table.block_ids
+    charge_required : np.array
+        charge used by each trip, see block_charge_required
+    commute : np.array
+        travel time (minutes) from the start stop of each trip to its charger,
+        np.nan when the trip can't charge (not in time_to_charge)
+    start_charge_pct : float
+        charging pct of bus at "full charge"
+    min_charge_threshold : float
+        min allowed charge for bus to take a trip.
+    min_charge_time: int
+        minimum number of minutes required for charge to happen.
+    last_end_time : float
+        end time used for the layover before the first trip, 60*27 in
+        charge_status_via_trip_completion and 60*24 in failed_block_loop
+    stop_at_failure : bool
+        stop at the first trip finishing below min_charge_threshold
+        (charge_status_via_trip_completion), or run the whole block (failed_block_loop)
+
+    Returns
+    -------
+    list
+        failed trip index into the trip arrays (-1 if the block completes), charge
+        remaining at the end, and the charge sessions as (trip index, start minute
+        of charging, charge time, added charge)
+    '''
+    bus = Bus()
+    bus.current_charge_pct = start_charge_pct
+    bus.block_id = block_table.block_ids[b]
+    sessions = []
+    for i in range(block_table.offsets[b], block_table.offsets[b+1]):
+        start_time = block_table.start_min[i]
+        if(start_time - last_end_time > min_charge_time and not np.isnan(commute[i])):
+            charge_time = start_time - last_end_time - 2*commute[i]
+            if(charge_time > min_charge_time):
+                added_charge = bus.chargeBus(charge_time, start_charge_pct, charge=True, chargerType='Faster')
+                sessions.append((i, last_end_time + commute[i], charge_time, added_charge))
+        last_end_time = block_table.end_min[i]
+        charge_depletion = bus.current_charge_pct - charge_required[i]
+        if stop_at_failure and charge_depletion < min_charge_threshold:
+            return [i, charge_depletion, sessions]
+        bus.current_charge_pct = charge_depletion
+    return [-1, bus.current_charge_pct, sessions]
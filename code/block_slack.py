@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Block Slack
+
+For every block at once: the minimum starting charge needed to finish the
+block, the trip where the margin is tightest, and the slack (charge left above
+min_charge_threshold at the tightest trip) for a given start charge. Replaces
+re-running the block checks over a sweep of start_charge_pct and
+min_charge_threshold values, and ranks the blocks most at risk of failing.
+
+Without layover charging the state of charge after trip k is start_charge_pct
+minus the charge used up to trip k, so the critical start charge is
+min_charge_threshold plus the most charge used at any point of the block. With
+layover charging the bus charges up to start_charge_pct, so every trip's
+state of charge only goes up with the start charge, and the critical start
+charge is found by bisection for all blocks together.
+
+Usage: python block_slack.py [eastLib|brt|allRoutes] [charging]
+
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from block_simulation import build_block_table, block_charge_required, charge_trajectory, charging_trajectory
+
+
+repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+# lowest value of each block and the first trip where it's reached
+def block_minimum(block_table, values):
+    '''
+    Returns
+    -------
+    list: minimum per block, and index into the trip arrays of the first trip at the minimum
+    '''
+    first = block_table.offsets[:-1]
+    minimum = np.minimum.reduceat(values, first)
+    lengths = np.diff(block_table.offsets)
+    at_minimum = values == np.repeat(minimum, lengths)
+    n = len(block_table)
+    idx = np.minimum.reduceat(np.where(at_minimum, np.arange(n), n), first)
+    return [minimum, idx]
+
+
+# critical start charge when no layover charging is allowed
+def critical_start_charge(block_table, charge_required, min_charge_threshold):
+    '''
+    Parameters
+    ----------
+    block_table : BlockTable
+    charge_required : np.array
+        charge used by each trip, see block_charge_required
+    min_charge_threshold : float
+        min allowed charge for bus to take a trip.
+
+    Returns
+    -------
+    list: minimum start charge to finish each block (can be over 100), and index
+    into the trip arrays of the trip where the margin is tightest
+    '''
+    # state of charge from a start of 0 is minus the charge used so far
+    used, tightest = block_minimum(block_table, charge_trajectory(block_table, 0, charge_required))
+    return [min_charge_threshold - used, tightest]
+
+
+# critical start charge with layover charging, bisection over all blocks together
+def critical_start_charge_charging(block_table, charge_required, commute, min_charge_threshold,
+                                   min_charge_time, last_end_time=60*27, tolerance=1e-3):
+    '''
+    Parameters
+    ----------
+    commute : np.array
+        travel time (minutes) from the start stop of each trip to its charger,
+        np.nan when the trip can't charge, see charging_trajectory
+    min_charge_time: int
+        minimum number of minutes required for charge to happen.
+    last_end_time : float
+        end time used for the layover before the first trip, see simulate_block
+    tolerance : float
+        width (pct) of the final bisection interval
+
+    Purpose
+    --------
+    The start charge is also where layover charging stops, as in
+    simulate_block. Charging only adds charge, so the no-charging critical start
+    charge always finishes the block and bounds the search.
+
+    Returns
+    -------
+    list: minimum start charge to finish each block, within tolerance (from
+    above), and index into the trip arrays of the trip where the margin is
+    tightest at that start charge
+    '''
+    critical, _ = critical_start_charge(block_table, charge_required, min_charge_threshold)
+    # one tolerance above, so rounding in the sequential charge levels can't fail the upper bound
+    hi = critical + tolerance
+    lo = np.minimum(np.full(len(hi), float(min_charge_threshold)), critical)
+    while np.any(hi - lo > tolerance):
+        mid = (lo + hi)/2
+        charge_level, _ = charging_trajectory(block_table, mid, charge_required, commute,
+                                              min_charge_time, last_end_time)
+        lowest, _ = block_minimum(block_table, charge_level)
+        completes = lowest >= min_charge_threshold
+        hi = np.where(completes, mid, hi)
+        lo = np.where(completes, lo, mid)
+    charge_level, _ = charging_trajectory(block_table, hi, charge_required, commute, min_charge_time, last_end_time)
+    _, tightest = block_minimum(block_table, charge_level)
+    return [hi, tightest]
+
+
+# blocks ranked by their slack, most at risk first
+def block_slack(block_table, charge_required, start_charge_pct, min_charge_threshold, commute=None,
+                min_charge_time=5, last_end_time=60*27, tolerance=1e-3):
+    '''
+    Parameters
+    ----------
+    block_table : BlockTable
+    charge_required : np.array
+        charge used by each trip, see block_charge_required
+    start_charge_pct : float
+        charging pct of bus at "full charge"
+    min_charge_threshold : float
+        min allowed charge for bus to take a trip.
+    commute : np.array, optional
+        travel time to each trip's charger (see charging_trajectory), no layover
+        charging if None
+    min_charge_time, last_end_time, tolerance :
+        layover charging settings, see critical_start_charge_charging
+
+    Returns
+    -------
+    dataframe: block_id, trips, critical_start_charge, tightest_trip_id (at the
+    critical start charge), min_charge (lowest state of charge at
+    start_charge_pct), slack (min_charge - min_charge_threshold) and failed
+    (slack < 0, same as find_failed_blocks without charging), lowest slack first.
+    A block also completes for any min_charge_threshold up to min_charge.
+    '''
+    if commute is None:
+        critical, tightest = critical_start_charge(block_table, charge_required, min_charge_threshold)
+        charge_level = charge_trajectory(block_table, start_charge_pct, charge_required)
+    else:
+        critical, tightest = critical_start_charge_charging(block_table, charge_required, commute,
+                                                            min_charge_threshold, min_charge_time,
+                                                            last_end_time, tolerance)
+        charge_level, _ = charging_trajectory(block_table, start_charge_pct, charge_required, commute,
+                                              min_charge_time, last_end_time)
+    min_charge, _ = block_minimum(block_table, charge_level)
+    slack = pd.DataFrame({'block_id': block_table.block_ids,
+                          'trips': np.diff(block_table.offsets),
+                          'critical_start_charge': critical,
+                          'tightest_trip_id': block_table.trip_id[tightest],
+                          'min_charge': min_charge,
+                          'slack': min_charge - min_charge_threshold,
+                          'failed': min_charge < min_charge_threshold})
+    return slack.sort_values('slack', kind='stable').reset_index(drop = True)
+
+
+if __name__ == '__main__':
+
+    ### global vars
+    start_charge_pct = 90 # max charge at start
+    min_charge_threshold = 30 # minimum allowed charge remaining
+    min_charge_time = 5 #minimum charging time in minutes
+    time_of_year = 'Winter' # seasonality var
+    eval_type = 'reg' # whether to eval charging profile by regression or worst case scenario
+    bus_type = '40ft'
+    data = sys.argv[1] if len(sys.argv) > 1 else 'allRoutes'
+    charging = len(sys.argv) > 2 and sys.argv[2] == 'charging'
+
+    df = pd.read_csv(os.path.join(repo_path, data, 'trips_flattened_'+data+'.csv'))
+    block_table = build_block_table(df)
+    charge_required = block_charge_required(block_table, time_of_year, bus_type, eval_type)
+    commute = None
+    if charging:
+        from BusMileage import load_travel_time_matrix
+        from contention_simulation import trip_chargers
+        travel_time_matrix = load_travel_time_matrix(os.path.join(repo_path, 'dataGenerated', 'stop_to_layover_travelTime.csv'))
+        _, commute = trip_chargers(block_table, travel_time_matrix)
+
+    slack = block_slack(block_table, charge_required, start_charge_pct, min_charge_threshold, commute, min_charge_time)
+    print('Failed blocks: ', slack.failed.sum(), ' of ', len(slack))
+    print(slack.head(20))
+    slack.to_csv('block_slack_'+data+'.csv', index = False)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Charger Index
+
+Finds the closest active layover charger for each stop once, from the end stop
+to layover travel time matrix (stop_to_layover_travelTime.csv), and maps the
+result onto the trips that would charge at each stop.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# for each stop, the active layover charger with the shortest travel time
+def nearest_active_charger(travel_time_matrix, stops, max_time=60):
+    '''
+    Parameters
+    ----------
+    travel_time_matrix : dataframe
+        output of load_travel_time_matrix in BusMileage.py, travel time in minutes
+        from each end stop (columns) to each layover (rows). Column 0 flags active chargers.
+    stops : list
+        stop ids to look up
+    max_time : float
+        travel time (minutes) used when no active charger is closer, a bus can't
+        usefully charge when it is this far from a charger
+
+    Purpose
+    --------
+    Vectorized argmin over the active layovers for all stops at once. Ties go
+    to the first layover in the matrix. Stops missing from the matrix are
+    reported, and keep themselves as the location with max_time.
+
+    Returns
+    -------
+    dataframe: indexed by stop, with the best charger location, travel time and
+    whether the stop was found in the travel time matrix
+    '''
+    stops = pd.unique(pd.Series(stops))
+    in_matrix = np.isin(stops, travel_time_matrix.columns.values)
+    missing = stops[~in_matrix]
+    if len(missing) > 0:
+        print('stop IDs ', list(missing), ' not in time matrix')
+
+    active = (travel_time_matrix[0] == 1).values
+    times = travel_time_matrix.loc[active, stops[in_matrix]].values.astype(float)
+    times[np.isnan(times)] = np.inf
+
+    location = stops.astype(object)
+    time = np.full(len(stops), max_time, dtype=float)
+    if times.shape[0] > 0 and times.shape[1] > 0:
+        best = np.argmin(times, axis=0)
+        best_time = times[best, np.arange(times.shape[1])]
+        closer = best_time < max_time
+        found_idx = np.where(in_matrix)[0][closer]
+        location[found_idx] = travel_time_matrix.index.values[active][best[closer]]
+        time[found_idx] = best_time[closer]
+
+    charger_index = pd.DataFrame({'stop': stops, 'location': location, 'time': time,
+                                  'in_matrix': in_matrix})
+    return charger_index.set_index('stop')
+
+
+# time to the closest active charger for every trip that could charge
+def build_time_to_charge(tripLocations, charger_index):
+    '''
+    Parameters
+    ----------
+    tripLocations : pd.Series
+        indexed by stop, list of trips starting after a charging layover at that stop
+    charger_index : dataframe
+        output of nearest_active_charger
+
+    Returns
+    -------
+    dataframe: indexed by trip, with the stop, closest charger location and travel time
+    '''
+    trips = tripLocations.explode()
+    time_to_charge = pd.DataFrame({'trip': trips.values.astype(int),
+                                   'stop': trips.index.values,
+                                   'location': charger_index['location'].loc[trips.index].values,
+                                   'time': charger_index['time'].loc[trips.index].values})
+    return time_to_charge.set_index('trip')
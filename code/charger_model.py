@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Charger Model
+
+Charger types and their state of charge vs time curves. A charger charges at a
+constant rate (constant current) up to its taper state of charge, then the rate
+falls off in proportion to the charge left to fill (constant voltage), so the
+bus approaches 100% but never overshoots. Each curve is compiled once into a
+state of charge vs time lookup table; the charge added for any start state of
+charge and charging time is read off the table with np.interp, for arrays of
+layovers at once.
+
+'Faster' (450 kW) adds 60% in 35 minutes and 'Slower' (150 kW) 60% in 130
+minutes, the original Bus.chargeBus rates, up to 80% and taper above it.
+'Faster Linear' and 'Slower Linear' keep the original linear curves (no taper),
+to reproduce results from before the taper.
+
+"""
+
+import numpy as np
+
+
+# create ChargerType class
+class ChargerType:
+    """
+    Charging curve of a charger type.
+
+    Attributes of the class include:
+        - name
+        - power_kw: rated power, for reference
+        - pct_gain, minutes: constant current rate, pct_gain % of charge every minutes
+        - taper_soc: state of charge (%) where the constant voltage taper starts,
+          None for a linear charger
+        - time_grid, soc_grid: lookup table of state of charge vs minutes charging
+          from 0%, built by compile()
+    """
+
+    def __init__(self, name, power_kw, pct_gain, minutes, taper_soc=None, resolution=0.05):
+        self.name = name
+        self.power_kw = power_kw
+        self.pct_gain = pct_gain
+        self.minutes = minutes
+        self.taper_soc = taper_soc
+        self.resolution = resolution
+        self.time_grid = None
+        self.soc_grid = None
+        self.compile()
+
+    def rate(self):
+        '''
+        Returns
+        -------
+        float: constant current charging rate, % per minute
+        '''
+        return self.pct_gain/self.minutes
+
+    def compile(self):
+        '''
+        Purpose
+        --------
+        Tabulates the state of charge when charging from 0% every resolution
+        minutes until the charge is within 0.01% of 100%. The constant voltage
+        phase is dSOC/dt = rate*(100 - SOC)/(100 - taper_soc).
+        '''
+        if self.taper_soc is None:
+            return
+        rate = self.rate()
+        taper_time = self.taper_soc/rate
+        tau = (100 - self.taper_soc)/rate
+        end_time = taper_time + tau*np.log((100 - self.taper_soc)/0.01) if self.taper_soc < 100 else taper_time
+        self.time_grid = np.append(np.arange(0, end_time, self.resolution), end_time)
+        self.soc_grid = np.where(self.time_grid <= taper_time, rate*self.time_grid,
+                                 100 - (100 - self.taper_soc)*np.exp(-(self.time_grid - taper_time)/tau))
+
+    # charge added by charging, before the max charge clamp
+    def added(self, start_soc, charge_time):
+        '''
+        Parameters
+        ----------
+        start_soc : float or np.array
+            state of charge (%) when charging starts
+        charge_time : float or np.array
+            minutes charging
+
+        Returns
+        -------
+        float or np.array: charge added (%)
+        '''
+        if self.soc_grid is None:
+            # same expression as the original Bus.chargeBus rates
+            return charge_time*self.pct_gain/self.minutes
+        # below 0% (a block run past its failure) the constant current rate applies up
+        # to 0%, so the time on the curve starts negative
+        start_time = np.interp(np.maximum(start_soc, 0), self.soc_grid, self.time_grid) \
+            - np.maximum(-np.asarray(start_soc, dtype=float), 0)/self.rate()
+        end_time = start_time + charge_time
+        soc = np.where(end_time < 0, end_time*self.rate(), np.interp(end_time, self.time_grid, self.soc_grid))
+        # past the end of the table only the last 0.01% is left
+        return np.maximum(soc - start_soc, 0)
+
+
+charger_types = {}
+
+
+# adds a charger type to the model, replacing any with the same name
+def register_charger_type(charger_type):
+    charger_types[charger_type.name] = charger_type
+    return charger_type
+
+
+register_charger_type(ChargerType('Faster', 450, 60, 35, taper_soc=80))
+register_charger_type(ChargerType('Slower', 150, 60, 130, taper_soc=80))
+register_charger_type(ChargerType('Faster Linear', 450, 60, 35))
+register_charger_type(ChargerType('Slower Linear', 150, 60, 130))
+
+
+def get_charger_type(chargerType):
+    '''
+    Returns
+    -------
+    ChargerType: registered charger type with that name (or the ChargerType itself)
+    '''
+    if isinstance(chargerType, ChargerType):
+        return chargerType
+    if chargerType not in charger_types:
+        raise ValueError('charger type ' + str(chargerType) + ' not characterized in model, choose from '
+                         + str(list(charger_types)))
+    return charger_types[chargerType]
+
+
+# charge added by charging, for arrays of layovers
+def charge_added(current_charge_pct, charge_time, start_charge_pct, chargerType='Faster'):
+    '''
+    Parameters
+    ----------
+    current_charge_pct : float or np.array
+        state of charge (%) when charging starts
+    charge_time : float or np.array
+        minutes charging
+    start_charge_pct : float
+        charging pct of bus at "full charge", charging stops there
+    chargerType : str or ChargerType
+        registered charger type, e.g. 'Faster' or 'Slower'
+
+    Returns
+    -------
+    float or np.array: charge added (%), never more than what's left to
+    start_charge_pct and never negative
+    '''
+    charger = get_charger_type(chargerType)
+    added = charger.added(current_charge_pct, charge_time)
+    added = np.where(current_charge_pct + added > start_charge_pct, start_charge_pct - current_charge_pct, added)
+    added = np.maximum(added, 0)
+    return added if np.ndim(added) > 0 else float(added)
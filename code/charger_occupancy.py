@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Charger Occupancy
+
+Tracks the charging sessions at a charger location as minute intervals, and
+finds the number of chargers needed (peak concurrent sessions) with a sweep line.
+
+"""
+
+import numpy as np
+
+# service day in minutes, some trips continue into the next day so the hour time stamps are > 24
+SERVICE_DAY_MINUTES = 60*27
+
+
+# create ChargerTimeline class
+class ChargerTimeline:
+    """
+    ChargerTimeline holds the charge sessions at one charger location.
+
+    Attributes of the class include:
+        - starts: first minute of each session
+        - ends: minute after the last minute of each session, sessions are [start, end)
+        - blocks: block_id of the bus charging in each session (None if not given)
+    """
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.blocks = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __repr__(self):
+        return str(list(zip(self.starts, self.ends)))
+
+    # records a session covering the minutes int(start_time) ... int(start_time) + int(charge_time) - 1
+    def add_session(self, start_time, charge_time, block=None):
+        start = int(start_time)
+        self.starts.append(start)
+        self.ends.append(start + int(charge_time))
+        self.blocks.append(block)
+
+    # drops the sessions of a block, used to re-simulate a single block
+    def remove_block(self, block):
+        keep = [i for i, b in enumerate(self.blocks) if b != block]
+        self.starts = [self.starts[i] for i in keep]
+        self.ends = [self.ends[i] for i in keep]
+        self.blocks = [self.blocks[i] for i in keep]
+
+    def peak(self):
+        '''
+        Purpose
+        --------
+        Sweep line over the session start (+1) and end (-1) events. Ends are
+        processed before starts at the same minute since sessions are half open.
+
+        Returns
+        -------
+        int: max number of sessions charging at the same minute
+        '''
+        if len(self) == 0:
+            return 0
+        times = np.concatenate([self.starts, self.ends])
+        change = np.concatenate([np.ones(len(self), dtype=int), -np.ones(len(self), dtype=int)])
+        order = np.lexsort((change, times))
+        return int(np.cumsum(change[order]).max())
+
+    def occupancy(self, n_minutes=SERVICE_DAY_MINUTES):
+        '''
+        Returns
+        -------
+        np.array of int: number of sessions charging at each minute of the service
+        day, extended if a session runs past n_minutes
+        '''
+        n_minutes = max([n_minutes] + self.ends)
+        change = np.zeros(n_minutes + 1, dtype=int)
+        np.add.at(change, self.starts, 1)
+        np.add.at(change, self.ends, -1)
+        return np.cumsum(change[:-1])
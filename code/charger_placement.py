@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Charger Placement Optimizer
+
+Python version of the binary optimization model in allRoutes/BinaryOptimizationModel.xlsx.
+Each failed block needs some charge (charge needed), and can get charge at the
+charger locations its layovers reach (charge options from failed_block_loop).
+Chooses which locations to install chargers at so that the fewest blocks fail
+with the fewest charger locations, then re-runs the block simulation with only
+the chosen locations active to check the result.
+
+Solved as a binary program with scipy's MILP solver when scipy is installed,
+otherwise (or with method='greedy') with a greedy heuristic.
+
+Usage: python charger_placement.py [eastLib|brt|allRoutes]
+
+"""
+
+import contextlib
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from BusMileage import load_travel_time_matrix, run_charging_assessment
+from block_simulation import build_block_table, block_charge_required, charge_trajectory
+from incremental_charging import IncrementalAssessment
+
+try:
+    from scipy.optimize import milp, LinearConstraint, Bounds
+except ImportError:
+    milp = None
+
+
+# charge short of min_charge_threshold at the end of each block, without charging
+def block_charge_needed(block_table, start_charge_pct, min_charge_threshold,
+                        time_of_year, eval_type, bus_type):
+    '''
+    Returns
+    -------
+    dict: block_id -> charge needed (0 if the block ends above min_charge_threshold)
+    '''
+    charge_required = block_charge_required(block_table, time_of_year, bus_type, eval_type)
+    final_charge = charge_trajectory(block_table, start_charge_pct, charge_required)[block_table.offsets[1:] - 1]
+    charge_needed = np.maximum(min_charge_threshold - final_charge, 0)
+    return dict(zip(block_table.block_ids.tolist(), charge_needed))
+
+
+# blocks x charger locations matrix of the charge possible at each location
+def build_placement_model(charge_options, charge_needed):
+    '''
+    Parameters
+    ----------
+    charge_options : dict
+        block_id -> {charger location: charge added}, failed_block_loop charge options
+    charge_needed : dict
+        block_id -> charge needed, see block_charge_needed
+
+    Returns
+    -------
+    list
+        blocks, sites (charger locations), charge possible (blocks x sites) and
+        charge needed per block, for the blocks needing charge
+    '''
+    blocks = [b for b in charge_options if charge_needed.get(b, 0) > 0]
+    sites = sorted({location for b in blocks for location in charge_options[b]}, key=str)
+    site_position = {s: j for j, s in enumerate(sites)}
+    charge_possible = np.zeros((len(blocks), len(sites)))
+    for i, b in enumerate(blocks):
+        for location, added_charge in charge_options[b].items():
+            charge_possible[i, site_position[location]] += added_charge
+    need = np.array([charge_needed[b] for b in blocks], dtype=float)
+    return [blocks, sites, charge_possible, need]
+
+
+def solve_placement_milp(charge_possible, need, cost, failure_cost):
+    '''
+    Purpose
+    --------
+    x_j = 1 installs a charger at site j, y_b = 1 lets block b fail.
+    minimize   sum(cost_j x_j) + failure_cost * sum(y_b)
+    subject to sum_j(charge_possible_bj x_j) + need_b y_b >= need_b for every block
+
+    Returns
+    -------
+    np.array of bool: install flag per site
+    '''
+    n_blocks, n_sites = charge_possible.shape
+    c = np.concatenate([cost, np.full(n_blocks, failure_cost)])
+    constraint = LinearConstraint(np.hstack([charge_possible, np.diag(need)]), lb=need, ub=np.inf)
+    result = milp(c, constraints=constraint, integrality=np.ones(len(c)), bounds=Bounds(0, 1))
+    if not result.success:
+        raise RuntimeError('charger placement MILP failed: ' + result.message)
+    return np.round(result.x[:n_sites]).astype(bool)
+
+
+def solve_placement_greedy(charge_possible, need, cost):
+    '''
+    Purpose
+    --------
+    Blocks that can't get enough charge even with every site installed are left
+    to fail. Then repeatedly installs the site with the most charge still needed
+    that it covers per unit cost, until every other block has enough charge.
+
+    Returns
+    -------
+    np.array of bool: install flag per site
+    '''
+    install = np.zeros(charge_possible.shape[1], dtype=bool)
+    remaining = np.where(charge_possible.sum(axis=1) >= need, need, 0)
+    while (remaining > 0).any():
+        gain = np.minimum(charge_possible, remaining[:, None]).sum(axis=0) / cost
+        gain[install] = 0
+        j = np.argmax(gain)
+        if gain[j] <= 0:
+            break
+        install[j] = True
+        remaining = np.maximum(remaining - charge_possible[:, j], 0)
+    return install
+
+
+# chooses the charger locations to install
+def solve_placement(charge_possible, need, cost=None, failure_cost=None, method='auto'):
+    '''
+    Parameters
+    ----------
+    charge_possible : np.array
+        blocks x sites, charge added at each site, see build_placement_model
+    need : np.array
+        charge needed per block
+    cost : np.array, optional
+        cost of installing each site, 1 per site by default
+    failure_cost : float, optional
+        cost of a failed block, defaults to more than installing every site so
+        that failed blocks are minimized first
+    method : str
+        'milp', 'greedy', or 'auto' (milp if scipy is installed, otherwise greedy)
+
+    Returns
+    -------
+    np.array of bool: install flag per site
+    '''
+    cost = np.ones(charge_possible.shape[1]) if cost is None else np.asarray(cost, dtype=float)
+    if failure_cost is None:
+        failure_cost = cost.sum() + 1
+    if method == 'auto':
+        method = 'greedy' if milp is None else 'milp'
+    if method == 'milp':
+        if milp is None:
+            raise ImportError('scipy >= 1.9 is needed for the MILP charger placement')
+        return solve_placement_milp(charge_possible, need, cost, failure_cost)
+    elif method == 'greedy':
+        return solve_placement_greedy(charge_possible, need, cost)
+    raise ValueError('unknown charger placement method ' + str(method))
+
+
+# block and site level summaries, same layout as the Excel model
+def placement_summary(blocks, sites, charge_possible, need, install):
+    '''
+    Returns
+    -------
+    list
+        dataframe per block (Charge Needed, Charge Possible, Route Failure) and
+        dataframe per site (Install Charger, number of blocks and charge it serves)
+    '''
+    possible = charge_possible[:, install].sum(axis=1)
+    block_summary = pd.DataFrame({'Block': blocks, 'Charge Needed': need, 'Charge Possible': possible,
+                                  'Route Failure': (need > possible).astype(int)})
+    site_summary = pd.DataFrame({'Charge Location': sites, 'Install Charger': install.astype(int),
+                                 'num_blocks': (charge_possible > 0).sum(axis=0),
+                                 'Charge Added': charge_possible.sum(axis=0)})
+    return [block_summary, site_summary]
+
+
+# re-runs the block simulation with only the chosen charger locations active
+def validate_placement(block_table, tripLocations, travel_time_matrix, blockID_needing_charge, sites,
+                       start_charge_pct, min_charge_threshold, min_charge_time,
+                       time_of_year, eval_type, bus_type):
+    '''
+    Returns
+    -------
+    IncrementalAssessment: assessment with only sites active, see failed_block_count
+    and numberOchargers for the simulated failed blocks and chargers needed
+    '''
+    travel_time_matrix = travel_time_matrix.copy()
+    travel_time_matrix[0] = np.isin(travel_time_matrix.index.values, list(sites)).astype(int)
+    return IncrementalAssessment(block_table, tripLocations, travel_time_matrix, blockID_needing_charge,
+                                 start_charge_pct, min_charge_threshold, min_charge_time,
+                                 time_of_year, eval_type, bus_type)
+
+
+if __name__ == '__main__':
+
+    ### global vars
+    start_charge_pct = 90 # max charge at start
+    min_charge_threshold = 30 # minimum allowed charge remaining
+    min_charge_time = 5 #minimum charging time in minutes
+    time_of_year = 'Winter' # seasonality var
+    eval_type = 'reg' # whether to eval charging profile by regression or worst case scenario
+    bus_type = '40ft'
+    data = sys.argv[1] if len(sys.argv) > 1 else 'allRoutes'
+    repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    datafilepath = os.path.join(repo_path, data)
+    df = pd.read_csv(os.path.join(datafilepath, 'trips_flattened_'+data+'.csv'))
+    travel_time_matrix = load_travel_time_matrix(os.path.join(repo_path, 'dataGenerated', 'stop_to_layover_travelTime.csv'))
+    scenario = (start_charge_pct, min_charge_threshold, min_charge_time, time_of_year, eval_type, bus_type)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = run_charging_assessment(df, *scenario, travel_time_matrix)
+    block_table = build_block_table(df)
+
+    # charge options with every layover location as a candidate charger
+    candidates = travel_time_matrix.copy()
+    candidates[0] = 1
+    assessment = IncrementalAssessment(block_table, results['tripLocations'], candidates,
+                                       results['blockID_needing_charge'], *scenario)
+    charge_needed = block_charge_needed(block_table, start_charge_pct, min_charge_threshold,
+                                        time_of_year, eval_type, bus_type)
+    blocks, sites, charge_possible, need = build_placement_model(assessment.charge_options, charge_needed)
+
+    install = solve_placement(charge_possible, need)
+    block_summary, site_summary = placement_summary(blocks, sites, charge_possible, need, install)
+    chosen = [s for s, i in zip(sites, install) if i]
+    print('Number of Charge Locations: ', len(chosen), chosen)
+    print('Number of Failed Blocks (model): ', block_summary['Route Failure'].sum())
+
+    validation = validate_placement(block_table, results['tripLocations'], travel_time_matrix,
+                                    results['blockID_needing_charge'], chosen, *scenario)
+    print('Number of Failed Blocks (simulation): ', validation.failed_block_count())
+
+    block_summary.to_csv(os.path.join(datafilepath, 'charger_placement_blocks.csv'), index=False)
+    site_summary.to_csv(os.path.join(datafilepath, 'charger_placement_sites.csv'), index=False)
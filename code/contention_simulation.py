@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Charger Contention Simulation
+
+Discrete-event version of the layover charging in failed_block_loop where each
+charger site has a fixed number of plugs. All blocks of the service day are run
+together in one time-ordered sweep of a heap-based event queue, so buses at the
+same site compete for its plugs. A bus that finds every plug busy either skips
+charging ('skip') or waits in the site's queue. With 'queue' a queued bus gives
+up and goes back without charging once it can no longer charge min_charge_time
+and make its next trip, so buses never run late. With 'late' it waits for a
+plug however long it takes and charges at least min_charge_time, then starts
+its next trip late; the delay and its state of charge carry through the rest
+of the block (a late bus only charges again at layovers long enough to).
+
+Without contention (enough plugs everywhere) every block charges exactly as in
+simulate_block(..., stop_at_failure=False) in block_simulation.py.
+
+Usage: python contention_simulation.py [eastLib|brt|allRoutes] [plugs per site] [queue|skip|late]
+
+"""
+
+import collections
+import contextlib
+import heapq
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from BusMileage import Bus, load_travel_time_matrix, run_charging_assessment
+from block_simulation import build_block_table, block_charge_required
+from charger_index import nearest_active_charger
+
+
+repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# event kinds, in the order they are processed at the same minute
+CHARGE_DONE = 0
+ARRIVE_CHARGER = 1
+LAYOVER = 2
+GIVE_UP = 3
+
+
+# charger site and travel time to it for every trip that can charge
+def trip_chargers(block_table, travel_time_matrix, stops=None, max_time=60):
+    '''
+    Parameters
+    ----------
+    block_table : BlockTable
+    travel_time_matrix : dataframe
+        output of load_travel_time_matrix in BusMileage.py
+    stops : list, optional
+        start stops where trips can charge (e.g. tripLocations.index), every start stop if None
+    max_time : float
+        chargers this far (minutes) or further are out of reach
+
+    Returns
+    -------
+    list: charger site (None if the trip can't charge) and commute (minutes, nan
+    if the trip can't charge) per trip, from the closest active charger to the
+    trip's start stop
+    '''
+    stops = np.unique(block_table.start_stop_id) if stops is None else np.asarray(stops)
+    with contextlib.redirect_stdout(io.StringIO()):
+        charger_index = nearest_active_charger(travel_time_matrix, stops, max_time)
+    reach = charger_index[charger_index.in_matrix & (charger_index.time < max_time)]
+    site = pd.Series(block_table.start_stop_id).map(reach.location).values
+    commute = pd.Series(block_table.start_stop_id).map(reach.time).values.astype(float)
+    site = np.where(pd.isna(site), None, site)
+    return [site, commute]
+
+
+# one event-driven sweep over all blocks
+def simulate_contention(block_table, charge_required, site, commute, plugs, start_charge_pct,
+                        min_charge_threshold, min_charge_time, policy='queue', blocks=None,
+                        last_end_time=60*24):
+    '''
+    Parameters
+    ----------
+    block_table : BlockTable
+    charge_required : np.array
+        charge used by each trip, see block_charge_required
+    site, commute : np.array
+        charger site and travel time (minutes) per trip, see trip_chargers
+    plugs : int or dict
+        plugs at every site, or site -> plugs (sites not in the dict have no limit)
+    start_charge_pct : float
+        charging pct of bus at "full charge"
+    min_charge_threshold : float
+        min allowed charge for bus to take a trip.
+    min_charge_time : int
+        minimum number of minutes required for charge to happen.
+    policy : str
+        'queue' to wait for a plug (first come first served) until the bus can
+        no longer charge min_charge_time and make its next trip, 'late' to wait
+        for a plug and charge at least min_charge_time even if the next trip
+        starts late, 'skip' to go back without charging when every plug is busy
+    blocks : array like, optional
+        positions of the blocks to run, all blocks if None
+    last_end_time : float
+        end time used for the layover before the first trip, see simulate_block
+
+    Returns
+    -------
+    list
+        dataframe per trip run (block_id, trip_id, delay at trip start, charge
+        after the trip), dataframe per charge session (block_id, trip before which
+        it charged, site, arrive, plug_in, plug_out, added), and dataframe per block
+        (failed trip index or -1, final charge, total delay, charges skipped)
+    '''
+    if policy not in ['queue', 'skip', 'late']:
+        raise ValueError('unknown charger contention policy ' + str(policy))
+    blocks = np.arange(len(block_table.block_ids)) if blocks is None else np.asarray(blocks)
+    offsets = block_table.offsets
+    duration = block_table.end_min - block_table.start_min
+
+    buses = {}
+    failure = {}
+    skipped = collections.Counter()
+    free = {}
+    queues = collections.defaultdict(collections.deque)
+    trips = []
+    sessions = []
+
+    def plugs_at(s):
+        if isinstance(plugs, dict):
+            return plugs.get(s, np.inf)
+        return plugs
+
+    # (time, kind, sequence, block, trip index, start of charging)
+    events = []
+    sequence = 0
+
+    def push(time, kind, b, i, start=None):
+        nonlocal sequence
+        heapq.heappush(events, (time, kind, sequence, b, i, start))
+        sequence += 1
+
+    # bus b starts trip i at its scheduled time or when it gets back, whichever is later
+    def start_trip(now, b, i):
+        start = max(block_table.start_min[i], now)
+        bus = buses[b]
+        bus.current_charge_pct = bus.current_charge_pct - charge_required[i]
+        if bus.current_charge_pct < min_charge_threshold and b not in failure:
+            failure[b] = i
+        trips.append((b, i, start - block_table.start_min[i], bus.current_charge_pct))
+        if i + 1 < offsets[b+1]:
+            push(start + duration[i], LAYOVER, b, i + 1)
+
+    # bus b is back from trip i-1 at now, goes to charge if there's time or waits for trip i
+    def layover(now, b, i):
+        if (block_table.start_min[i] - now > min_charge_time and not np.isnan(commute[i])
+                and block_table.start_min[i] - now - 2*commute[i] > min_charge_time):
+            push(now + commute[i], ARRIVE_CHARGER, b, i)
+            return True
+        return False
+
+    # bus b plugs in at now, with trip i next, a late bus charges min_charge_time
+    def plug_in(now, b, i, arrive, late=False):
+        charge_time = block_table.start_min[i] - now - commute[i]
+        if late or charge_time > min_charge_time:
+            charge_time = max(charge_time, min_charge_time)
+            free[site[i]] -= 1
+            push(now + charge_time, CHARGE_DONE, b, i, (arrive, now))
+            return True
+        return False
+
+    for b in blocks:
+        bus = Bus()
+        bus.current_charge_pct = start_charge_pct
+        bus.block_id = block_table.block_ids[b]
+        buses[b] = bus
+        # the first trip of a block always starts on time
+        if not layover(last_end_time, b, offsets[b]):
+            start_trip(block_table.start_min[offsets[b]], b, offsets[b])
+
+    while events:
+        now, kind, _, b, i, start = heapq.heappop(events)
+        s = site[i]
+        if kind == LAYOVER:
+            # same checks as simulate_block, on the time the bus is actually back
+            if not layover(now, b, i):
+                start_trip(now, b, i)
+        elif kind == ARRIVE_CHARGER:
+            free.setdefault(s, plugs_at(s))
+            if free[s] > 0:
+                if not plug_in(now, b, i, now):
+                    start_trip(now + commute[i], b, i)
+            elif policy in ['queue', 'late']:
+                queues[s].append((b, i, now))
+                if policy == 'queue':
+                    # last minute it could still plug in for more than min_charge_time
+                    push(block_table.start_min[i] - commute[i] - min_charge_time, GIVE_UP, b, i, now)
+            else:
+                skipped[b] += 1
+                start_trip(now + commute[i], b, i)
+        elif kind == GIVE_UP:
+            # still waiting at its deadline, goes back without charging to start trip i on time
+            if (b, i, start) in queues[s]:
+                queues[s].remove((b, i, start))
+                skipped[b] += 1
+                start_trip(now + commute[i], b, i)
+        else:
+            arrive, plugged = start
+            charge_time = now - plugged
+            added_charge = buses[b].chargeBus(charge_time, start_charge_pct, charge=True, chargerType='Faster')
+            sessions.append((b, i, s, arrive, plugged, now, added_charge))
+            free[s] += 1
+            start_trip(now + commute[i], b, i)
+            # next buses in the queue, those out of time go back without charging
+            while free[s] > 0 and queues[s]:
+                qb, qi, qarrive = queues[s].popleft()
+                if not plug_in(now, qb, qi, qarrive, policy == 'late'):
+                    skipped[qb] += 1
+                    start_trip(now + commute[qi], qb, qi)
+
+    trips = pd.DataFrame(trips, columns=['block', 'trip', 'delay', 'charge'])
+    trips.insert(0, 'block_id', block_table.block_ids[trips.block.values.astype(int)])
+    trips.insert(1, 'trip_id', block_table.trip_id[trips.trip.values.astype(int)])
+    sessions = pd.DataFrame(sessions, columns=['block', 'trip', 'site', 'arrive', 'plug_in', 'plug_out', 'added'])
+    sessions.insert(0, 'block_id', block_table.block_ids[sessions.block.values.astype(int)])
+    sessions['wait'] = sessions.plug_in - sessions.arrive
+    block_summary = pd.DataFrame({'block_id': block_table.block_ids[blocks],
+                                  'failed_trip': [failure.get(b, -1) for b in blocks],
+                                  'final_charge': [buses[b].current_charge_pct for b in blocks],
+                                  'total_delay': trips.groupby('block').delay.sum().reindex(blocks, fill_value=0).values,
+                                  'skipped_charges': [skipped[b] for b in blocks]})
+    return [trips, sessions, block_summary]
+
+
+if __name__ == '__main__':
+
+    ### global vars
+    start_charge_pct = 90 # max charge at start
+    min_charge_threshold = 30 # minimum allowed charge remaining
+    min_charge_time = 5 #minimum charging time in minutes
+    time_of_year = 'Winter' # seasonality var
+    eval_type = 'reg' # whether to eval charging profile by regression or worst case scenario
+    bus_type = '40ft'
+    data = sys.argv[1] if len(sys.argv) > 1 else 'allRoutes'
+    plugs = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    policy = sys.argv[3] if len(sys.argv) > 3 else 'queue'
+
+    df = pd.read_csv(os.path.join(repo_path, data, 'trips_flattened_'+data+'.csv'))
+    travel_time_matrix = load_travel_time_matrix(os.path.join(repo_path, 'dataGenerated', 'stop_to_layover_travelTime.csv'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = run_charging_assessment(df, start_charge_pct, min_charge_threshold, min_charge_time,
+                                          time_of_year, eval_type, bus_type, travel_time_matrix)
+    block_table = build_block_table(df)
+    charge_required = block_charge_required(block_table, time_of_year, bus_type, eval_type)
+    site, commute = trip_chargers(block_table, travel_time_matrix, results['tripLocations'].index.values)
+    failed = np.searchsorted(block_table.block_ids, results['blockID_needing_charge'])
+
+    trips, sessions, block_summary = simulate_contention(block_table, charge_required, site, commute, plugs,
+                                                         start_charge_pct, min_charge_threshold, min_charge_time,
+                                                         policy, blocks=failed)
+    print('Failed blocks without charging: ', len(failed))
+    print('Failed blocks with ', plugs, ' plug(s) per site (', policy, '): ', (block_summary.failed_trip >= 0).sum())
+    print('Charge sessions: ', len(sessions), ' skipped: ', block_summary.skipped_charges.sum(),
+          ' mean wait: ', round(sessions.wait.mean(), 2), ' late trips: ', (trips.delay > 0).sum(),
+          ' total delay (minutes): ', round(trips.delay.sum(), 1))
@@ -6,9 +6,18 @@ Purpose: Create flattened trip dataset. Resulting dataset is at trip_id level.
 
 import pandas as pd
 import numpy as np
-import datetime as datetime
 from matplotlib import pyplot as plt
 
+# incline/rail routes
+excludeRoutes = ['DQI-199', 'MI-199', 'RED-199', 'SLVR-199', 'BLUE-199']
+
+# routes from east liberty garage
+east_lib_routes = ['71A','71D','74','89','P2','P78','P1','71B','88','68','69','71','77','86',
+                   '87','P68','P69','P71','75','67','P12','P16','P67','28X','79','82','P17','71C','58']
+
+# day the service day starts on for the datetime columns, times past 24:00 roll into the next day
+service_date = pd.Timestamp('2023-01-01')
+
 ### helper function to import code if needed
 def open_file(path):
     dataDict = {}
@@ -25,122 +34,227 @@ def open_file(path):
     return(dataDF)
 
 
-path = '/Users/sumati/Documents/CMU/Academics/Spring2023/Capstone/code/data'
-# read in trips
-trips = pd.read_csv(path+'/GTFS_2022/trips.csv')
-trips = trips[~trips.trip_id.str.contains('Rail')] # remove rail/incline
-print(trips.shape)
-trips.head()
-
-# read in stop times
-stop_times = pd.read_csv(path+'/GTFS_2022/stop_times.csv')
-print(stop_times.shape)
-stop_times.trip_id = stop_times.trip_id.apply(lambda x: str(x))
-stop_times.stop_id = stop_times.stop_id.apply(lambda x: str(x))
-stop_times.head()
-
-# merge stops with stoptimes to add lat/long
-stops = pd.read_csv(path+'/GTFS_2022/stops.csv')
-stops = stops[['stop_id', 'stop_name']]
-print(stops.shape)
-stops.head()
-
-# merge stops with stop times to add geography
-stop_times_w_stopnames = pd.merge(stop_times, stops, on = 'stop_id', how = 'left')
-print(stop_times_w_stopnames.shape)
-stop_times_w_stopnames.head()
-
-# merge stop times with trips to get trip duration and sequence 
-tripCols = ['trip_id', 'block_id', 'route_id','trip_headsign', 'service_id']
-stoptimesCols = ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence', 
-                 'stop_name','shape_dist_traveled']
-tripTimes = pd.merge(trips[tripCols], stop_times_w_stopnames[stoptimesCols], how = 'inner', on = 'trip_id')
-#tripTimes = tripTimes[tripTimes.route_id.apply(lambda x: x in ['71C', '82'])]
-print(tripTimes.shape)
-
-# look into total block duration and trip duration -- trip starts
-tripStarts = tripTimes.sort_values(by = ['trip_id', 'block_id', 'stop_sequence']).groupby(['trip_id', 'block_id']).head(1)[['trip_id', 'block_id', 'route_id', 'trip_headsign', 'departure_time', 'service_id', 'stop_name', 'stop_id']]
-tripStarts.rename(columns = {'departure_time': 'trip_start_time',
-                            'service_id': 'service_id_start',
-                            'stop_name':'start_stop',
-                            'stop_id': 'start_stop_id'}, inplace = True)
-print(tripStarts.shape)
-
-# look into total block duration and trip duration -- trip ends
-tripEnds = tripTimes.sort_values(by = ['trip_id', 'block_id', 'stop_sequence']).groupby(['trip_id', 'block_id']).tail(1)[['trip_id', 'block_id', 'route_id', 'departure_time', 'stop_sequence', 'shape_dist_traveled', 'service_id', 'stop_name', 'stop_id']]
-tripEnds.rename(columns = {'departure_time':'trip_end_time',
-                           'stop_sequence': 'number_total_stops', 
-                           'shape_dist_traveled': 'total_distance_traveled', 
-                          'service_id': 'service_id_end', 
-                          'stop_name': 'end_stop',
-                          'stop_id':'end_stop_id'}, inplace = True)
-print(tripEnds.shape)
-
-# dataset at trip-block level with the start/end time for each trip, and total distance traveled 
-tripWide = pd.merge(tripStarts, tripEnds, on = ['trip_id', 'block_id', 'route_id'], how = 'inner')
-tripWide.sort_values(['block_id', 'trip_id']).head(5)
-
-
-
-
-# adjust time variables so that they can be converted to datetime, calculate trip time deltas
-for i in range(len(tripWide)):
-    if int(tripWide.loc[i, 'trip_start_time'][0:2]) < 24:
-        tripWide.loc[i, 'trip_start_datetime'] = "01/01/23 "+tripWide.loc[i, 'trip_start_time']
-    else: 
-        diff = str(abs(24 - int(tripWide.loc[i, 'trip_start_time'][0:2])))
-        diff_fmt = diff.rjust(2, '0')
-        tripWide.loc[i, 'trip_start_datetime'] = "01/02/23 "+diff_fmt+tripWide.loc[i, 'trip_start_time'][2:]
-        
-    if int(tripWide.loc[i, 'trip_end_time'][0:2]) < 24: 
-        tripWide.loc[i, 'trip_end_datetime'] = "01/01/23 "+tripWide.loc[i, 'trip_end_time'] 
-    else: 
-        diff = str(abs(24 - int(tripWide.loc[i, 'trip_end_time'][0:2])))
-        diff_fmt = diff.rjust(2, '0')
-        tripWide.loc[i, 'trip_end_datetime'] = "01/02/23 "+diff_fmt+tripWide.loc[i, 'trip_end_time'][2:]
-        
-    tripWide.loc[i, 'trip_start_datetime'] = datetime.datetime.strptime(tripWide.loc[i, 'trip_start_datetime'], '%m/%d/%y %H:%M:%S')
-    tripWide.loc[i, 'trip_end_datetime'] = datetime.datetime.strptime(tripWide.loc[i, 'trip_end_datetime'], '%m/%d/%y %H:%M:%S')
-    
-    tripWide.loc[i, 'timeDelta'] = tripWide.loc[i, 'trip_end_datetime'] - tripWide.loc[i, 'trip_start_datetime']
-    tripWide.loc[i, 'timeDelta_minutes'] = tripWide.loc[i, 'timeDelta'].seconds / 60
-    tripWide.loc[i, 'timeDelta_hours'] = tripWide.loc[i, 'timeDelta_minutes']/60
-  
-    
-  
-# exclude incline/rail
-excludeRoutes = ['DQI-199', 'MI-199', 'RED-199', 'SLVR-199', 'BLUE-199']
-tripWide = tripWide[tripWide.route_id.apply(lambda x: x not in excludeRoutes)]
-tripWide.shape
-  
-# output for all routes
-tripWide.total_distance_traveled = tripWide.total_distance_traveled.apply(lambda x: x/1609.34) # convert to miles
-tripWide.head()[['block_id', 'trip_id', 'trip_start_time', 'trip_end_time', 'total_distance_traveled']]
-tripWide = tripWide.sort_values(['block_id', 'trip_start_datetime']).reset_index(drop = True)
-tripWide.to_csv('trips_flattened_allRoutes.csv')
-   
- 
-# filter for routes from east liberty garage 
-east_lib_routes = ['71A','71D','74','89','P2','P78','P1','71B','88','68','69','71','77','86',
-                   '87','P68','P69','P71','75','67','P12','P16','P67','28X','79','82','P17','71C','58']
+# GTFS 'HH:MM:SS' times to seconds after midnight, hours can be >= 24 for trips past midnight
+def gtfs_time_to_seconds(times):
+    '''
+    Parameters
+    ----------
+    times : pd.Series of str
+
+    Returns
+    -------
+    np.array: integer seconds after midnight of the service day
+    '''
+    hms = times.astype(str).str.strip().str.split(':', expand=True).astype(int).values
+    return hms[:, 0]*3600 + hms[:, 1]*60 + hms[:, 2]
+
+
+# stop_times columns used to flatten trips, with narrow dtypes for reading
+stopTimesDtypes = {'trip_id': str, 'departure_time': str, 'stop_id': str,
+                   'stop_sequence': np.int32, 'shape_dist_traveled': np.float64}
+
+
+# first and last stop_times row of every trip
+def first_last_stops(stop_times):
+    '''
+    Returns
+    -------
+    list: dataframes of the first and last stop_times row of each trip (by stop_sequence)
+    '''
+    stop_times = stop_times[list(stopTimesDtypes)].sort_values(['trip_id', 'stop_sequence'])
+    # rows are kept whole, same as head(1)/tail(1) of each trip
+    first = stop_times.drop_duplicates('trip_id', keep='first')
+    last = stop_times.drop_duplicates('trip_id', keep='last')
+    return [first, last]
+
+
+# one row per trip from the first and last stop_times rows
+def trip_ends_from_stops(first, last):
+    tripEnds = pd.DataFrame({'trip_id': first.trip_id.values,
+                             'trip_start_time': first.departure_time.values,
+                             'start_stop_id': first.stop_id.values})
+    tripEnds = pd.merge(tripEnds, pd.DataFrame({'trip_id': last.trip_id.values,
+                                                'trip_end_time': last.departure_time.values,
+                                                'number_total_stops': last.stop_sequence.values,
+                                                'total_distance_traveled': last.shape_dist_traveled.values,
+                                                'end_stop_id': last.stop_id.values}),
+                        on = 'trip_id', how = 'inner')
+    return tripEnds
+
+
+# first and last stop of every trip in stop_times
+def reduce_stop_times(stop_times):
+    '''
+    Parameters
+    ----------
+    stop_times : dataframe
+        GTFS stop_times, with trip_id, departure_time, stop_id, stop_sequence and shape_dist_traveled
+
+    Returns
+    -------
+    dataframe: one row per trip_id with trip_start_time, start_stop_id, trip_end_time,
+    end_stop_id, number_total_stops (last stop_sequence) and total_distance_traveled
+    (last shape_dist_traveled, meters)
+    '''
+    first, last = first_last_stops(stop_times)
+    return trip_ends_from_stops(first, last)
+
+
+# same as reduce_stop_times, reading stop_times.csv in chunks
+def reduce_stop_times_chunked(path, chunksize = 1000000, trip_ids = None):
+    '''
+    Parameters
+    ----------
+    path : str
+        path to GTFS stop_times.csv
+    chunksize : int
+        number of stop_times rows read at a time
+    trip_ids : collection of str, optional
+        only keep these trips (e.g. without rail/incline)
+
+    Purpose
+    --------
+    Keeps a running first/last stop_times row per trip while reading, so peak
+    memory is set by the number of trips and the chunk size, not the number of
+    stop events.
+
+    Returns
+    -------
+    dataframe: same as reduce_stop_times
+    '''
+    first = pd.DataFrame(columns = list(stopTimesDtypes)).astype(stopTimesDtypes)
+    last = first.copy()
+    for chunk in pd.read_csv(path, usecols = list(stopTimesDtypes), dtype = stopTimesDtypes,
+                             chunksize = chunksize):
+        if trip_ids is not None:
+            chunk = chunk[chunk.trip_id.isin(trip_ids)]
+        chunk_first, chunk_last = first_last_stops(chunk)
+        first = first_last_stops(pd.concat([first, chunk_first]))[0]
+        last = first_last_stops(pd.concat([last, chunk_last]))[1]
+    return trip_ends_from_stops(first, last)
+
+
+# join the per-trip first/last stops with trips and stops, and compute trip durations
+def join_trip_ends(tripEnds, trips, stops, exclude_routes = excludeRoutes):
+    '''
+    Parameters
+    ----------
+    tripEnds : dataframe
+        output of reduce_stop_times
+    trips : dataframe
+        GTFS trips (rail/incline trips already removed)
+    stops : dataframe
+        GTFS stops, with stop_id and stop_name
+
+    Returns
+    -------
+    dataframe: flattened trips dataset, block-trip level, sorted by block and start time.
+    Distance is in miles.
+    '''
+    tripCols = ['trip_id', 'block_id', 'route_id','trip_headsign', 'service_id']
+    stopNames = stops[['stop_id', 'stop_name']].drop_duplicates('stop_id').set_index('stop_id').stop_name
+    tripWide = pd.merge(trips[tripCols], tripEnds, on = 'trip_id', how = 'inner')
+
+    start_seconds = gtfs_time_to_seconds(tripWide.trip_start_time)
+    end_seconds = gtfs_time_to_seconds(tripWide.trip_end_time)
+    tripWide = pd.DataFrame({'trip_id': tripWide.trip_id,
+                             'block_id': tripWide.block_id,
+                             'route_id': tripWide.route_id,
+                             'trip_headsign': tripWide.trip_headsign,
+                             'trip_start_time': tripWide.trip_start_time,
+                             'service_id_start': tripWide.service_id,
+                             'start_stop': tripWide.start_stop_id.map(stopNames),
+                             'start_stop_id': tripWide.start_stop_id,
+                             'trip_end_time': tripWide.trip_end_time,
+                             'number_total_stops': tripWide.number_total_stops,
+                             'total_distance_traveled': tripWide.total_distance_traveled/1609.34, # convert to miles
+                             'service_id_end': tripWide.service_id,
+                             'end_stop': tripWide.end_stop_id.map(stopNames),
+                             'end_stop_id': tripWide.end_stop_id,
+                             'trip_start_datetime': service_date + pd.to_timedelta(start_seconds, unit = 's'),
+                             'trip_end_datetime': service_date + pd.to_timedelta(end_seconds, unit = 's')})
+    tripWide['timeDelta'] = tripWide.trip_end_datetime - tripWide.trip_start_datetime
+    # seconds part of the timedelta, same as timedelta.seconds
+    tripWide['timeDelta_minutes'] = ((end_seconds - start_seconds) % 86400) / 60
+    tripWide['timeDelta_hours'] = tripWide.timeDelta_minutes/60
+
+    tripWide = tripWide[~tripWide.route_id.isin(exclude_routes)]
+    tripWide = tripWide.sort_values(['block_id', 'trip_start_datetime']).reset_index(drop = True)
+    return tripWide
+
+
+# build the flattened trips dataset from GTFS trips, stop_times and stops
+def flatten_trips(trips, stop_times, stops, exclude_routes = excludeRoutes):
+    '''
+    Parameters
+    ----------
+    trips, stop_times, stops : dataframe
+        GTFS tables
+
+    Purpose
+    --------
+    Reduces stop_times to the first and last stop of each trip, then joins
+    trips and stop names. Rail/incline trips and routes are removed.
 
-eastLibTrips = tripWide.copy()
+    Returns
+    -------
+    dataframe: flattened trips dataset (input of BusMileage.py)
+    '''
+    trips = trips[~trips.trip_id.astype(str).str.contains('Rail')] # remove rail/incline
+    trips = trips.assign(trip_id = trips.trip_id.astype(str))
+    stop_times = stop_times.assign(trip_id = stop_times.trip_id.astype(str),
+                                   stop_id = stop_times.stop_id.astype(str))
+    stops = stops.assign(stop_id = stops.stop_id.astype(str))
+    tripEnds = reduce_stop_times(stop_times[stop_times.trip_id.isin(trips.trip_id)])
+    return join_trip_ends(tripEnds, trips, stops, exclude_routes)
 
-eastLibTrips = eastLibTrips[eastLibTrips.route_id.apply(lambda x: x in east_lib_routes)]
-eastLibTrips = eastLibTrips.sort_values(['block_id', 'trip_start_datetime']).reset_index(drop = True)
 
+# same as flatten_trips, streaming stop_times.csv in chunks instead of loading it
+def flatten_trips_streaming(trips, stop_times_path, stops, chunksize = 1000000,
+                            exclude_routes = excludeRoutes):
+    '''
+    Parameters
+    ----------
+    trips, stops : dataframe
+        GTFS tables
+    stop_times_path : str
+        path to GTFS stop_times.csv
+    chunksize : int
+        number of stop_times rows read at a time
 
-# output
-eastLibTrips.to_csv('data/trips_flattened_eastLibRoutes.csv')
+    Returns
+    -------
+    dataframe: flattened trips dataset (input of BusMileage.py)
+    '''
+    trips = trips[~trips.trip_id.astype(str).str.contains('Rail')] # remove rail/incline
+    trips = trips.assign(trip_id = trips.trip_id.astype(str))
+    stops = stops.assign(stop_id = stops.stop_id.astype(str))
+    tripEnds = reduce_stop_times_chunked(stop_times_path, chunksize, set(trips.trip_id))
+    return join_trip_ends(tripEnds, trips, stops, exclude_routes)
 
 
+if __name__ == '__main__':
 
-# updating total distance from meters to miles 
-trips_flattened = pd.read_csv('/Users/sumati/Documents/CMU/Academics/Spring2023/Capstone/code/data/trips_flattened_eastLibRoutes.csv')
+    path = '/Users/sumati/Documents/CMU/Academics/Spring2023/Capstone/code/data'
+    # rows of stop_times read at a time, None to load the whole file
+    chunksize = 1000000
+    trips = pd.read_csv(path+'/GTFS_2022/trips.csv')
+    stops = pd.read_csv(path+'/GTFS_2022/stops.csv')
+    print(trips.shape, stops.shape)
 
-trips_flattened.total_distance_traveled = trips_flattened.total_distance_traveled.apply(lambda x: x/1609.34)
+    # output for all routes
+    if chunksize is None:
+        stop_times = pd.read_csv(path+'/GTFS_2022/stop_times.csv')
+        tripWide = flatten_trips(trips, stop_times, stops)
+    else:
+        tripWide = flatten_trips_streaming(trips, path+'/GTFS_2022/stop_times.csv', stops, chunksize)
+    print(tripWide.shape)
+    tripWide.head()[['block_id', 'trip_id', 'trip_start_time', 'trip_end_time', 'total_distance_traveled']]
+    tripWide.to_csv('trips_flattened_allRoutes.csv')
 
-trips_flattened.head()[['block_id', 'trip_id', 'trip_start_time', 'trip_end_time', 'total_distance_traveled']]
+    # filter for routes from east liberty garage
+    eastLibTrips = tripWide[tripWide.route_id.isin(east_lib_routes)]
+    eastLibTrips = eastLibTrips.sort_values(['block_id', 'trip_start_datetime']).reset_index(drop = True)
 
-# output
-trips_flattened.to_csv('/Users/sumati/Documents/CMU/Academics/Spring2023/Capstone/code/data/trips_flattened_eastLibRoutes_miles.csv')
+    # output
+    eastLibTrips.to_csv('data/trips_flattened_eastLibRoutes.csv')
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Depot Charging
+
+Overnight charging at the garages. Takes each block's state of charge at pull-in
+from the block simulation and each garage's charger inventory (Garage in
+multiday_simulation.py), and schedules the charging with an event-driven
+priority queue: buses waiting for a charger are served earliest pull-out first.
+Outputs the charge sessions, a 1-minute kW demand profile per garage, and the
+peak demand and energy per garage.
+
+One night is one day type: the datasets hold the blocks of several service_ids
+(e.g. weekday, Saturday and Sunday service), which never pull in on the same
+night, so the blocks are filtered to one service_id.
+
+Usage: python depot_charging.py [eastLib|brt|allRoutes] --service-id 4 [--chargers 100 --charger-kw 150]
+
+"""
+
+import argparse
+import heapq
+import os
+
+import numpy as np
+import pandas as pd
+
+from block_simulation import build_block_table, block_charge_required, charge_trajectory
+from multiday_simulation import DAY_MINUTES, Garage, block_garages
+
+
+repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+# state of charge and times of each block at pull-in
+def block_pull_in(block_table, start_charge_pct, charge_required, route_garage=None, default_garage='depot',
+                  service=None, service_id=None):
+    '''
+    Parameters
+    ----------
+    block_table : BlockTable
+    start_charge_pct : float
+        charging pct of bus at "full charge"
+    charge_required : np.array
+        charge used by each trip, see block_charge_required
+    service : np.array, optional
+        service_id_start of each trip, see trip_services in block_rechaining.py
+    service_id : int, optional
+        only the blocks of this service_id (one night), every block if None
+
+    Returns
+    -------
+    dataframe: block_id, garage, pull_in (minutes), pull_out (the block's pull-out
+    the next day, minutes on the same clock) and end_soc, one row per block
+    '''
+    first = block_table.offsets[:-1]
+    last = block_table.offsets[1:] - 1
+    charge_level = charge_trajectory(block_table, start_charge_pct, charge_required)
+    pull_in = pd.DataFrame({'block_id': block_table.block_ids,
+                            'garage': block_garages(block_table, route_garage, default_garage),
+                            'pull_in': block_table.end_min[last],
+                            'pull_out': block_table.start_min[first] + DAY_MINUTES,
+                            'end_soc': np.maximum(charge_level[last], 0)})
+    if service_id is not None:
+        # each block runs under a single service_id
+        pull_in = pull_in[np.asarray(service)[first] == service_id].reset_index(drop = True)
+    return pull_in
+
+
+# event-driven charging schedule at one garage
+def schedule_garage(garage, arrival, departure, soc, max_charge_pct, battery_kwh):
+    '''
+    Parameters
+    ----------
+    garage : Garage
+    arrival, departure : np.array
+        minutes each bus gets back to and leaves the garage
+    soc : np.array
+        state of charge (pct) at arrival
+    max_charge_pct : float
+        charging stops at this state of charge
+    battery_kwh : float
+        usable battery capacity
+
+    Purpose
+    --------
+    Events are bus arrivals and charge completions, processed in time order from
+    a heap (completions first at the same minute). Whenever a charger is free, the
+    waiting bus with the earliest departure plugs in and charges at
+    garage.charger_power() until it reaches max_charge_pct or has to leave.
+    Buses that leave before getting a charger aren't charged.
+
+    Returns
+    -------
+    dataframe: plug_in, plug_out (minutes, nan if not charged), wait (minutes),
+    energy_kwh, final_soc and unmet_kwh (energy short of max_charge_pct), one row per bus
+    '''
+    n = len(arrival)
+    power = garage.charger_power()
+    needed = np.maximum(max_charge_pct - np.asarray(soc, dtype=float), 0)/100*battery_kwh
+    plug_in = np.full(n, np.nan)
+    plug_out = np.full(n, np.nan)
+    energy = np.zeros(n)
+
+    # (time, 0 = charge complete / 1 = arrival, bus)
+    events = [(arrival[i], 1, i) for i in range(n)]
+    heapq.heapify(events)
+    waiting = []
+    free = garage.chargers if power > 0 else 0
+    while events:
+        now, kind, i = heapq.heappop(events)
+        if kind == 0:
+            free += 1
+        else:
+            heapq.heappush(waiting, (departure[i], i))
+        while free > 0 and waiting:
+            leave, j = heapq.heappop(waiting)
+            full_minutes = needed[j]/power*60 if power > 0 else 0
+            charge_minutes = min(full_minutes, leave - now)
+            if charge_minutes <= 0:
+                continue
+            plug_in[j] = now
+            plug_out[j] = now + charge_minutes
+            energy[j] = needed[j] if charge_minutes == full_minutes else power*charge_minutes/60
+            free -= 1
+            heapq.heappush(events, (plug_out[j], 0, j))
+
+    return pd.DataFrame({'plug_in': plug_in, 'plug_out': plug_out,
+                         'wait': np.where(np.isnan(plug_in), np.nan, plug_in - arrival),
+                         'energy_kwh': energy,
+                         'final_soc': np.asarray(soc, dtype=float) + energy/battery_kwh*100,
+                         'unmet_kwh': needed - energy})
+
+
+# average kW drawn in each minute
+def demand_profile(plug_in, plug_out, power, start_minute, end_minute):
+    '''
+    Parameters
+    ----------
+    plug_in, plug_out : np.array
+        charge session start and end times (minutes), nan for no session
+    power : float or np.array
+        kW drawn during each session
+    start_minute, end_minute : int
+        profile covers the minutes [start_minute, end_minute)
+
+    Returns
+    -------
+    np.array: average kW in each minute, partial minutes at the ends of a session
+    counted by the fraction of the minute charged
+    '''
+    n_minutes = end_minute - start_minute
+    charged = ~np.isnan(plug_in)
+    power = np.broadcast_to(np.asarray(power, dtype=float), plug_in.shape)[charged]
+    s = plug_in[charged] - start_minute
+    e = plug_out[charged] - start_minute
+    s_floor = np.floor(s).astype(int)
+    e_floor = np.floor(e).astype(int)
+    profile = np.zeros(n_minutes + 1)
+
+    same = s_floor == e_floor
+    np.add.at(profile, s_floor[same], power[same]*(e[same] - s[same]))
+    # partial first and last minutes, full minutes in between via a difference array
+    spans = ~same
+    np.add.at(profile, s_floor[spans], power[spans]*(s_floor[spans] + 1 - s[spans]))
+    np.add.at(profile, e_floor[spans], power[spans]*(e[spans] - e_floor[spans]))
+    full = np.zeros(n_minutes + 2)
+    np.add.at(full, s_floor[spans] + 1, power[spans])
+    np.add.at(full, e_floor[spans], -power[spans])
+    profile = profile + np.cumsum(full)[:n_minutes + 1]
+    return profile[:n_minutes]
+
+
+# schedules every garage and summarizes demand
+def schedule_depots(pull_in, garages, max_charge_pct, battery_kwh):
+    '''
+    Parameters
+    ----------
+    pull_in : dataframe
+        output of block_pull_in
+    garages : dict
+        garage name -> Garage
+    max_charge_pct : float
+        charging stops at this state of charge
+    battery_kwh : float
+        usable battery capacity
+
+    Returns
+    -------
+    list
+        sessions (pull_in with the schedule_garage columns), demand profile
+        (minute x garage kW, minutes after midnight of the service day) and
+        summary per garage (buses, peak_kw, energy_kwh, unmet_kwh, buses_not_full)
+    '''
+    sessions = []
+    for name, garage in garages.items():
+        blocks = pull_in[pull_in.garage == name].reset_index(drop = True)
+        schedule = schedule_garage(garage, blocks.pull_in.values, blocks.pull_out.values,
+                                   blocks.end_soc.values, max_charge_pct, battery_kwh)
+        sessions.append(pd.concat([blocks, schedule], axis=1))
+    sessions = pd.concat(sessions, ignore_index=True)
+    unassigned = set(pull_in.garage) - set(garages)
+    if len(unassigned) > 0:
+        print('Blocks at garages without chargers: ', sorted(unassigned))
+
+    charged = sessions.plug_in.notna()
+    start_minute = int(np.floor(sessions.plug_in[charged].min())) if charged.any() else 0
+    end_minute = int(np.ceil(sessions.plug_out[charged].max())) + 1 if charged.any() else 1
+    profile = pd.DataFrame(index=pd.RangeIndex(start_minute, end_minute, name='minute'))
+    summary = []
+    for name, garage in garages.items():
+        rows = sessions[sessions.garage == name]
+        profile[name] = demand_profile(rows.plug_in.values, rows.plug_out.values, garage.charger_power(),
+                                       start_minute, end_minute)
+        summary.append({'garage': name, 'buses': len(rows), 'chargers': garage.chargers,
+                        'peak_kw': profile[name].max(),
+                        'energy_kwh': rows.energy_kwh.sum(),
+                        'unmet_kwh': rows.unmet_kwh.sum(),
+                        'buses_not_full': int((rows.unmet_kwh > 1e-9).sum())})
+    return [sessions, profile, pd.DataFrame(summary)]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Overnight depot charging schedule for one service day.')
+    parser.add_argument('data', nargs='?', default='allRoutes', help="'eastLib', 'brt' or 'allRoutes'")
+    parser.add_argument('--service-id', type=int, required=True, help='service_id of the day type to schedule')
+    parser.add_argument('--chargers', type=int, default=100)
+    parser.add_argument('--charger-kw', type=float, default=150)
+    args = parser.parse_args()
+
+    ### global vars
+    start_charge_pct = 90 # max charge at start
+    time_of_year = 'Winter' # seasonality var
+    eval_type = 'reg' # whether to eval charging profile by regression or worst case scenario
+    bus_type = '40ft'
+    battery_kwh = 440
+    data = args.data
+
+    df = pd.read_csv(os.path.join(repo_path, data, 'trips_flattened_'+data+'.csv'))
+    if args.service_id not in df.service_id_start.values:
+        raise ValueError('service_id ' + str(args.service_id) + ' not in the dataset, choose from '
+                         + str(sorted(df.service_id_start.unique().tolist())))
+    block_table = build_block_table(df)
+    charge_required = block_charge_required(block_table, time_of_year, bus_type, eval_type)
+    service = pd.Series(df.service_id_start.values, index=df.trip_id.values).reindex(block_table.trip_id).values
+    pull_in = block_pull_in(block_table, start_charge_pct, charge_required, service=service,
+                            service_id=args.service_id)
+    garages = {'depot': Garage('depot', args.chargers, args.charger_kw)}
+
+    sessions, profile, summary = schedule_depots(pull_in, garages, start_charge_pct, battery_kwh)
+    print(summary)
+    profile.to_csv('depot_demand_profile.csv')
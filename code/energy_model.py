@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Energy Model
+
+Battery charge used per trip, for arrays of trip distances and durations.
+Coefficients are read from BusMileageRegressionParams.txt (distance, time,
+distance+time and worst case models, per season), or any table with the same
+layout, so model variants can be swapped or compared in one call. The table
+is refit from the PRT data with regression_fit.py. Tables can
+also have ClimbBeta and DescentBeta terms for the trip's climb and descent in
+meters (see grade_energy.py).
+
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+params_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'BusMileageRegressionParams.txt')
+
+# depletion multiplier for 60 ft ('jumbo') buses
+JUMBO_MULTIPLIER = 1.58
+
+# eval_type names used in BusMileage.py
+eval_type_models = {'reg': 'distance+time', 'wc': 'worst case'}
+
+coefficient_names = ['DistanceBeta', 'TimeBeta', 'Const']
+# optional terms, per meter of climb and descent
+grade_coefficient_names = ['ClimbBeta', 'DescentBeta']
+
+_coefficients = {}
+
+
+# reads the regression parameter settings file into a coefficient table
+def load_coefficients(path=params_path):
+    '''
+    Parameters
+    ----------
+    path : str
+        file laid out like BusMileageRegressionParams.txt: '<NAME> MODELS' headers,
+        then a season line and DistanceBeta/TimeBeta/Const values per season
+
+    Returns
+    -------
+    dataframe: indexed by (model, season), columns DistanceBeta, TimeBeta, Const,
+    ClimbBeta and DescentBeta. Models are named by their header in lower case,
+    e.g. 'distance+time'. Files written by regression_fit.py also have a
+    'Version' line, kept in attrs['version'].
+    '''
+    rows = {}
+    model = None
+    season = None
+    version = None
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            tokens = [t.replace('\ufeff', '').strip() for t in line.split('\t')]
+            tokens = [t for t in tokens if t != '']
+            if len(tokens) == 0:
+                continue
+            if tokens[0] == 'Version' and len(tokens) == 2 and model is None:
+                version = int(tokens[1])
+                continue
+            if tokens[0].endswith('MODELS'):
+                model = tokens[0][:-len('MODELS')].strip().lower()
+                continue
+            if tokens[0] in ['Summer', 'Winter']:
+                season = tokens[0]
+                tokens = tokens[1:]
+            if len(tokens) == 2 and model is not None:
+                name = tokens[0].replace(' ', '').lower()
+                for c in coefficient_names + grade_coefficient_names:
+                    if c.lower() == name:
+                        rows.setdefault((model, season), {})[c] = float(tokens[1])
+    # terms a model doesn't use are 0
+    coefficients = pd.DataFrame.from_dict(rows, orient='index')
+    coefficients = coefficients.reindex(columns=coefficient_names + grade_coefficient_names).fillna(0)
+    coefficients.index = pd.MultiIndex.from_tuples(coefficients.index, names=['model', 'season'])
+    if version is not None:
+        coefficients.attrs['version'] = version
+    return coefficients
+
+
+def default_coefficients():
+    '''
+    Returns
+    -------
+    dataframe: coefficients from BusMileageRegressionParams.txt, read once
+    '''
+    if params_path not in _coefficients:
+        _coefficients[params_path] = load_coefficients(params_path)
+    return _coefficients[params_path]
+
+
+def bus_multiplier(bus_type):
+    return JUMBO_MULTIPLIER if bus_type[0:5] == 'jumbo' else 1
+
+
+# charge used by every trip
+def charge_required(distance, duration, time_of_year, bus_type, eval_type='reg', coefficients=None,
+                    climb=None, descent=None):
+    '''
+    Parameters
+    ----------
+    distance : float or np.array
+        trip distance (miles)
+    duration : float or np.array
+        trip duration (minutes)
+    time_of_year: str, "Summer", anything else uses the Winter model
+    bus_type: str, 'jumbo' for 60ft, anything else means 40'
+    eval_type: str, 'reg' (distance+time regression), 'wc' (worst case), or
+        a model name from the coefficient table ('distance', 'time', 'distance+time')
+    coefficients : dataframe, optional
+        see load_coefficients, defaults to BusMileageRegressionParams.txt
+    climb, descent : float or np.array, optional
+        trip climb and descent (meters), see grade_energy.trip_grades. Adds the
+        ClimbBeta and DescentBeta terms, a trip downhill enough to charge the
+        battery uses 0.
+
+    Returns
+    -------
+    float or np.array: battery percentage required to complete each trip
+    '''
+    coefficients = default_coefficients() if coefficients is None else coefficients
+    model = eval_type_models.get(eval_type, eval_type)
+    season = 'Summer' if time_of_year == 'Summer' else 'Winter'
+    if (model, season) not in coefficients.index:
+        raise KeyError('no ' + str(model) + ' model for ' + season + ' in coefficient table')
+    Distancebeta, timeBeta, const = coefficients.loc[(model, season), coefficient_names]
+    batteryChange = np.abs((Distancebeta*distance)+(timeBeta*duration)+const)
+    if climb is not None or descent is not None:
+        climbBeta, descentBeta = coefficients.loc[(model, season), grade_coefficient_names]
+        climb = 0 if climb is None else climb
+        descent = 0 if descent is None else descent
+        batteryChange = np.maximum(batteryChange + climbBeta*climb + descentBeta*descent, 0)
+    return batteryChange*bus_multiplier(bus_type)
+
+
+# charge used by every trip under every model in the coefficient table
+def charge_required_all_models(distance, duration, bus_type, coefficients=None, climb=None, descent=None):
+    '''
+    Parameters
+    ----------
+    distance, duration : np.array
+        trip distance (miles) and duration (minutes)
+    bus_type: str, 'jumbo' for 60ft, anything else means 40'
+    coefficients : dataframe, optional
+        see load_coefficients, defaults to BusMileageRegressionParams.txt
+    climb, descent : np.array, optional
+        trip climb and descent (meters), see charge_required
+
+    Returns
+    -------
+    dataframe: one row per trip, one column per (model, season)
+    '''
+    coefficients = default_coefficients() if coefficients is None else coefficients
+    X = np.column_stack([distance, duration, np.ones(len(distance))])
+    batteryChange = np.abs(X @ coefficients[coefficient_names].values.T)
+    if climb is not None or descent is not None:
+        G = np.column_stack([np.zeros(len(distance)) if climb is None else climb,
+                             np.zeros(len(distance)) if descent is None else descent])
+        batteryChange = np.maximum(batteryChange + G @ coefficients[grade_coefficient_names].values.T, 0)
+    batteryChange = batteryChange * bus_multiplier(bus_type)
+    return pd.DataFrame(batteryChange, columns=coefficients.index)
@@ -4,166 +4,160 @@
 
 Converting output of BusMileage.py to GIS friendly output
 
-Using the output of BusMileage.py (blocks_needing_charge) to analyze the 
-routes before failure for each block. Also focuses on the previous layover spot before failure
-
-# run after running BusMileage.py
-
-"""
-
-
-import pandas as pd
-import numpy as np
-import datetime as datetime
-
-# read stops dataset
-
-# read in output from BusMileage.py
-blocks_to_charge = pd.read_csv('blocks_needing_charge.csv') # output from BusMileage.py
-blocks_to_charge.shape
-len(np.unique(blocks_to_charge.block_id))
-
-# convert datetime objects
-blocks_to_charge.trip_start_datetime = blocks_to_charge.trip_start_datetime.apply(lambda x: datetime.datetime.strptime(x, '%Y-%m-%d %H:%M:%S'))
-blocks_to_charge.trip_end_datetime = blocks_to_charge.trip_end_datetime.apply(lambda x: datetime.datetime.strptime(x, '%Y-%m-%d %H:%M:%S'))
-
-# identify layover trips
-df_w_layover = pd.DataFrame()
-for block in np.unique(blocks_to_charge.block_id):
-    df_block = blocks_to_charge.copy()
-    df_block = df_block[df_block.block_id == block].reset_index(drop = True)
-    if df_block.shape[0] > 1:
-        for i in range(len(df_block)-1):
-            if (df_block.loc[i+1, 'trip_start_datetime'] - df_block.loc[i, 'trip_end_datetime']).seconds > 300:
-                df_block.loc[i, 'layoverEndStop'] = 1
-            else: 
-                df_block.loc[i, 'layoverEndStop'] = 0
-        df_w_layover = pd.concat([df_w_layover, df_block])
-
-df_w_layover = df_w_layover.reset_index(drop = True)
-df_w_layover.shape
-
-failed_trips_id = tripFails # from BusMileage.py
-
-# for each trip, get the index where it failed, and return the previous trip
-# this represents the last completed trip before requiring charge (subtract 1 to get the previous stop if not a layover)
-last_route_idx = []
-for trip in failed_trips_id: 
-    failure_idx = np.where(df_w_layover.trip_id == trip)[0][0]
-    if df_w_layover.loc[failure_idx-1, 'layoverEndStop'] == 1:
-        last_route_idx.append(failure_idx-1)
-    else: 
-        last_route_idx.append(failure_idx-2)
-    
-last_route_per_block = df_w_layover.copy()
-last_route_per_block = last_route_per_block.iloc[last_route_idx]
-
-# check what routes/directions are represented
-np.unique(last_route_per_block.trip_headsign)
-np.unique(last_route_per_block.route_id)
-last_route_per_block.groupby(['trip_headsign', 'route_id'])['block_id'].count().sort_values()   
-last_route_per_block.groupby('route_id')['block_id'].count()
-# look at end stops
-last_route_per_block.groupby(['trip_headsign', 'end_stop_id'])['block_id'].count().sort_values()   
-np.unique(last_route_per_block.end_stop_id)
-
-
-
-
-# code for outputs
-keep_vars = ['block_id','trip_id','route_id','trip_start_time','trip_end_time',
-             'total_distance_traveled','timeDelta_minutes','trip_headsign',
-             'start_stop','start_stop_id','end_stop','end_stop_id']
-
-# store and analyze together
-winterResults = last_route_per_block.copy()
-winterResults['Season'] = 'Winter'
-winterResults.groupby(['trip_headsign', 'route_id'])['block_id'].count().sort_values()   
-
-summerResults = last_route_per_block.copy()
-summerResults['Season'] = 'Summer'
-
-allResults = pd.concat([winterResults, summerResults])
-allResults.groupby(['trip_headsign', 'route_id'])['block_id'].count().sort_values(ascending = False)   
-np.unique(allResults.end_stop_id)
-
-
-allResults[keep_vars].to_csv('lastRoutes_EL_distance.csv')
-
-
-
-
-# read in and analyze across routes
-dist = pd.read_csv('lastRoutes_all_distance.csv')
-time = pd.read_csv('lastRoutes_all_time.csv')
-distTime = pd.read_csv('lastRoutes_all_distancetime.csv')
-
-allData = pd.concat([dist, time, distTime])
-allData['end_stop_id'] = allData['end_stop_id'].apply(lambda x: str(x))
-allData.groupby(['route_id', 'end_stop_id', 'trip_headsign'], 
-                as_index = False)['block_id'].count().sort_values(by = 'block_id', ascending = False)
-
-
-
-el_dist = pd.read_csv('lastRoutes_EL_distance.csv')
-el_time = pd.read_csv('lastRoutes_EL_time.csv')
-el_distTime = pd.read_csv('lastRoutes_EL_distancetime.csv')
-
-allELData = pd.concat([el_dist, el_time, el_distTime])
-allELData['end_stop_id'] = allELData['end_stop_id'].apply(lambda x: str(x))
-allELData.groupby(['route_id', 'end_stop_id', 'trip_headsign'], 
-                as_index = False)['block_id'].count().sort_values(by = 'block_id', ascending = False)
-
-
-
-
-## adding geo to the stops
-path = '/Users/sumati/Documents/CMU/Academics/Spring2023/Capstone/code/data'
-stops = pd.read_csv(path+'/GTFS_2022/stops.csv')
-stops = stops[['stop_id', 'stop_name', 'stop_lat', 'stop_lon']]
-
-
-allStops = allData.groupby(['route_id', 'end_stop_id', 'trip_headsign'], 
-                as_index = False)['block_id'].count().sort_values(by = 'block_id', ascending = False).reset_index(drop = True)
-allStops = pd.merge(allStops, stops, how = 'left', left_on = 'end_stop_id', right_on = 'stop_id')
-allStops.rename(columns = {'block_id': 'blockCount'}, inplace = True)
-allStops
-allStops.to_csv('all_failed_stops.csv')
-
-ELStops = allELData.groupby(['route_id', 'end_stop_id', 'trip_headsign'], 
-                as_index = False)['block_id'].count().sort_values(by = 'block_id', ascending = False)
-
-ELStops = pd.merge(ELStops, stops, how = 'left', left_on = 'end_stop_id', right_on = 'stop_id')
-ELStops.rename(columns = {'block_id': 'blockCount'}, inplace = True)
-ELStops
-ELStops.to_csv('EastLib_failed_stops.csv')
+Using the failed trips of BusMileage.py (tripFails, or find_failed_blocks in
+block_simulation.py) to analyze the routes before failure for each block. Also
+focuses on the previous layover spot before failure.
 
+Layover flags, the last trip ending at a layover before each failure, and the
+failed stop summaries are computed with grouped shifts and merges over all
+failed blocks at once, from the trips already in memory, so they can run for
+every scenario of a sweep.
 
+Usage: python getLastRoutes.py [stops.csv]
 
+"""
 
-EL_blocks = np.unique(allELData.block_id)
-allBlocks = np.unique(allData.block_id)
 
-# failed blocks in all data that aren't in the east liberty list 
-all_only = []
-for block in allBlocks: 
-    if block not in EL_blocks: 
-        print(block)
-        all_only.append(block)
+import os
+import sys
 
-# read in trips_flattened_allRoutes.csv
-trips = pd.read_csv('trips_flattened_allRoutes.csv')
-trips[trips.block_id.apply(lambda x: x in all_only)].groupby('route_id')['block_id'].count().sort_values(ascending = False)
-        
-# failed blocks in east liberty list not in overall list
-for block in EL_blocks: 
-    if block not in allBlocks: 
-        print(block)
+import numpy as np
+import pandas as pd
 
+from block_simulation import time_to_minutes
 
-### ALL FAILED BLOCKS IN EAST LIBERTY ALSO FAIL OVERALL. 
 
+repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
 
+# a gap longer than this (seconds) between trips is a layover
+LAYOVER_SECONDS = 300
 
+keep_vars = ['block_id','trip_id','route_id','trip_start_time','trip_end_time',
+             'total_distance_traveled','timeDelta_minutes','trip_headsign',
+             'start_stop','start_stop_id','end_stop','end_stop_id']
 
 
+# flag the trips of failed blocks that end at a layover
+def layover_flags(df, blockID_needing_charge, layover_seconds=LAYOVER_SECONDS):
+    '''
+    Parameters
+    ----------
+    df : dataframe
+        output of the create_trips_flattened.py file, block-trip level dataset on the drive.
+    blockID_needing_charge : list
+        failed blocks, from BusMileage.py
+    layover_seconds : int
+        a gap longer than this before the next trip of the block is a layover
+
+    Returns
+    -------
+    dataframe: trips of the failed blocks with more than one trip, in block
+    order, with layoverEndStop 1 if the trip ends at a layover, 0 if not and nan
+    for the last trip of a block. Gaps are taken mod 24 hours like timedelta.seconds.
+    '''
+    blocks = df[df.block_id.isin(blockID_needing_charge)]
+    blocks = blocks.iloc[np.argsort(blocks.block_id.values, kind='stable')]
+    blocks = blocks[blocks.groupby('block_id').block_id.transform('size') > 1].reset_index(drop = True)
+    start_sec = np.round(time_to_minutes(blocks.trip_start_time)*60)
+    end_sec = np.round(time_to_minutes(blocks.trip_end_time)*60)
+    gap = pd.Series(start_sec).groupby(blocks.block_id.values).shift(-1) - end_sec
+    blocks['layoverEndStop'] = np.where(gap.isna(), np.nan, (gap % 86400 > layover_seconds).astype(float))
+    return blocks
+
+
+# last trip ending at a layover before the failed trip of each block
+def last_routes(df, tripFails, blockID_needing_charge, layover_seconds=LAYOVER_SECONDS):
+    '''
+    Parameters
+    ----------
+    df : dataframe
+        flattened trips dataset
+    tripFails, blockID_needing_charge : list
+        failed trip and block ids, from BusMileage.py (run_charging_assessment)
+        or find_failed_blocks in block_simulation.py
+
+    Purpose
+    --------
+    The last completed trip before a failure is the trip before the failed
+    trip if it ends at a layover, otherwise the one before that (the bus can't
+    charge at the stop if it isn't a layover). Failures too early in their
+    block to have that trip are left out.
+
+    Returns
+    -------
+    dataframe: one row per failed block, the trip (see layover_flags) before its failure
+    '''
+    blocks = layover_flags(df, blockID_needing_charge, layover_seconds)
+    blocks['position'] = blocks.groupby('block_id').cumcount()
+    previous_layover = blocks.groupby('block_id').layoverEndStop.shift(1)
+    failures = pd.DataFrame({'trip_id': tripFails, 'block_id': blockID_needing_charge})
+    failed = blocks[['trip_id', 'block_id', 'position']].assign(previous_layover = previous_layover.values)
+    failures = failures.merge(failed, on = ['trip_id', 'block_id'], how = 'inner')
+    failures['position'] = failures.position - np.where(failures.previous_layover == 1, 1, 2)
+    failures = failures[failures.position >= 0]
+    last = blocks.merge(failures[['block_id', 'position']], on = ['block_id', 'position'], how = 'inner')
+    return last.drop(columns = 'position')
+
+
+# failed stops for GIS, number of failed blocks per route, end stop and direction
+def failed_stops(last_route_per_block, stops):
+    '''
+    Parameters
+    ----------
+    last_route_per_block : dataframe
+        output of last_routes, or several concatenated (e.g. across models and seasons)
+    stops : dataframe
+        stop_id, stop_name, stop_lat and stop_lon (GTFS stops)
+
+    Returns
+    -------
+    dataframe: route_id, end_stop_id, trip_headsign, blockCount and the stop's
+    name and coordinates, most failed blocks first
+    '''
+    counts = last_route_per_block.groupby(['route_id', 'end_stop_id', 'trip_headsign'],
+                                          as_index = False)['block_id'].count()
+    counts = counts.sort_values(by = 'block_id', ascending = False, kind='stable').reset_index(drop = True)
+    stops = stops[['stop_id', 'stop_name', 'stop_lat', 'stop_lon']].drop_duplicates('stop_id')
+    counts = pd.merge(counts, stops, how = 'left', left_on = 'end_stop_id', right_on = 'stop_id')
+    counts.rename(columns = {'block_id': 'blockCount'}, inplace = True)
+    return counts
+
+
+# stop names and coordinates of the end stops in trips_flattened_w_geo.csv
+def stops_from_trips_geo(trips_geo):
+    stops = trips_geo[['end_stop_id', 'end_stop_name', 'end_stop_lat', 'end_stop_lon']]
+    stops.columns = ['stop_id', 'stop_name', 'stop_lat', 'stop_lon']
+    return stops.drop_duplicates('stop_id').reset_index(drop = True)
+
+
+if __name__ == '__main__':
+
+    from block_simulation import build_block_table, find_failed_blocks
+
+    ### global vars
+    start_charge_pct = 90 # max charge at start
+    min_charge_threshold = 30 # minimum allowed charge remaining
+    bus_type = '40ft'
+    models = ['distance', 'time', 'distance+time']
+    seasons = ['Winter', 'Summer']
+
+    if len(sys.argv) > 1:
+        stops = pd.read_csv(sys.argv[1])
+    else:
+        stops = stops_from_trips_geo(pd.read_csv(os.path.join(repo_path, 'dataGenerated', 'trips_flattened_w_geo.csv')))
+
+    # last routes across models and seasons, for all routes and east liberty
+    for data, output in [('allRoutes', 'all_failed_stops.csv'), ('eastLib', 'EastLib_failed_stops.csv')]:
+        df = pd.read_csv(os.path.join(repo_path, data, 'trips_flattened_'+data+'.csv'))
+        block_table = build_block_table(df)
+        results = []
+        for model in models:
+            for season in seasons:
+                blockFails = find_failed_blocks(block_table, start_charge_pct, min_charge_threshold,
+                                                season, model, bus_type)
+                last_route_per_block = last_routes(df, [i[0] for i in blockFails], [i[1] for i in blockFails])
+                results.append(last_route_per_block[keep_vars].assign(Season = season, model = model))
+        allResults = pd.concat(results, ignore_index = True)
+        summary = failed_stops(allResults, stops)
+        print(data, ': ', allResults.block_id.nunique(), ' failed blocks, ', len(summary), ' failed stops')
+        summary.to_csv(output)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Grade Energy
+
+Per-trip climb and descent from GTFS stop sequences joined with stop elevations
+(dataGenerated/stop_elevation_v2.xls). Trips that serve the same stops in the
+same order share a trip pattern, so elevation changes are computed once per
+pattern and every trip gets its climb, descent and steepest grade by lookup.
+
+The climb and descent feed the ClimbBeta/DescentBeta terms of the energy
+model's coefficient table (see energy_model.load_coefficients). The PRT test
+runs have no climb or descent, so regression_fit.py doesn't fit these terms;
+grade_coefficients fills them in from physics, the potential energy of the
+climb less regenerative braking on the descent.
+
+Usage: python grade_energy.py trips.csv stop_times.csv stops.csv [trips_flattened.csv]
+
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from energy_model import default_coefficients, grade_coefficient_names
+from travel_time_engine import haversine_miles, unit_vectors
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+
+repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+elevation_path = os.path.join(repo_path, 'dataGenerated', 'stop_elevation_v2.xls')
+
+GRAVITY = 9.81 # m/s^2
+JOULES_PER_KWH = 3.6e6
+BUS_MASS_KG = 14000 # 40ft battery electric bus with an average load, jumbo buses scale by JUMBO_MULTIPLIER
+BATTERY_KWH = 440
+DRIVETRAIN_EFFICIENCY = 0.85 # battery to wheels
+REGEN_EFFICIENCY = 0.6 # share of the descent's potential energy recovered
+# stop elevations further than this from a stop aren't used for it
+ELEVATION_SNAP_MILES = 0.05
+
+
+# stop elevation points from the ArcGIS stop to stop segment export
+def load_stop_elevations(path=elevation_path):
+    '''
+    Parameters
+    ----------
+    path : str
+        stop_elevation_v2.xls, stop to stop line segments (start/end long and lat)
+        spatially joined to the elevation contours (Contour, meters). .csv
+        exports with the same columns also work.
+
+    Returns
+    -------
+    dataframe: StopID (point number), Latitude, Longitude and elevation_m, one row
+    per segment end point, averaging the contours of the segments that meet there
+    '''
+    if path.endswith('.csv'):
+        segments = pd.read_csv(path)
+    else:
+        # .xls needs xlrd
+        segments = pd.read_excel(path)
+    segments.columns = [c.split('.')[-1] for c in segments.columns]
+    segments = segments[segments.Contour.notna()]
+    points = pd.concat([pd.DataFrame({'Latitude': segments.start_lat.values, 'Longitude': segments.start_long.values,
+                                      'elevation_m': segments.Contour.values}),
+                        pd.DataFrame({'Latitude': segments.end_lat.values, 'Longitude': segments.end_long.values,
+                                      'elevation_m': segments.Contour.values})])
+    points = points.round({'Latitude': 6, 'Longitude': 6}).groupby(['Latitude', 'Longitude'], as_index = False).mean()
+    points.insert(0, 'StopID', np.arange(len(points)))
+    return points
+
+
+# elevation of every GTFS stop from the nearest elevation point
+def stop_elevations(stops, elevations, snap_miles=ELEVATION_SNAP_MILES):
+    '''
+    Parameters
+    ----------
+    stops : dataframe
+        GTFS stops, with stop_id, stop_lat and stop_lon
+    elevations : dataframe
+        output of load_stop_elevations
+
+    Returns
+    -------
+    pd.Series: elevation (meters) indexed by stop_id, nan for stops with no
+    elevation point within snap_miles
+    '''
+    lat = stops.stop_lat.values.astype(float)
+    lon = stops.stop_lon.values.astype(float)
+    point_lat = elevations.Latitude.values.astype(float)
+    point_lon = elevations.Longitude.values.astype(float)
+    if cKDTree is not None:
+        # nearest point on the unit sphere, the chord grows with the great circle distance
+        _, nearest = cKDTree(unit_vectors(point_lat, point_lon)).query(unit_vectors(lat, lon))
+    else:
+        nearest = np.array([np.argmin(haversine_miles(y, x, point_lat, point_lon)) for y, x in zip(lat, lon)],
+                           dtype=int)
+    distance = haversine_miles(lat, lon, point_lat[nearest], point_lon[nearest])
+    elevation = np.where(distance <= snap_miles, elevations.elevation_m.values[nearest], np.nan)
+    return pd.Series(elevation, index=stops.stop_id.astype(str).values, name='elevation_m')
+
+
+# trip pattern of every trip, one pattern per distinct stop sequence
+def trip_patterns(stop_times, trips=None):
+    '''
+    Parameters
+    ----------
+    stop_times : dataframe
+        GTFS stop_times, with trip_id, stop_id and stop_sequence
+    trips : dataframe, optional
+        GTFS trips, adds the route_id and shape_id of each pattern when given
+
+    Returns
+    -------
+    dataframe: trip_id and pattern_id, one row per trip
+    '''
+    stop_times = stop_times.sort_values(['trip_id', 'stop_sequence'])
+    sequence = stop_times.stop_id.astype(str).groupby(stop_times.trip_id.astype(str)).agg(' '.join)
+    pattern_id, _ = pd.factorize(sequence.values)
+    patterns = pd.DataFrame({'trip_id': sequence.index.values, 'pattern_id': pattern_id})
+    if trips is not None:
+        columns = [c for c in ['route_id', 'shape_id'] if c in trips.columns]
+        patterns = patterns.merge(trips.assign(trip_id = trips.trip_id.astype(str))[['trip_id'] + columns],
+                                  on = 'trip_id', how = 'left')
+    return patterns
+
+
+# climb, descent and grades of every trip pattern, from one trip of each pattern
+def pattern_grades(stop_times, patterns, elevation):
+    '''
+    Parameters
+    ----------
+    stop_times : dataframe
+        GTFS stop_times, with trip_id, stop_id, stop_sequence and shape_dist_traveled (meters)
+    patterns : dataframe
+        output of trip_patterns
+    elevation : pd.Series
+        output of stop_elevations
+
+    Purpose
+    --------
+    Stops without an elevation take the elevation of the stop before them (or
+    the first stop with one), so they add no climb or descent.
+
+    Returns
+    -------
+    dataframe: indexed by pattern_id, with trips, stops, stops_with_elevation,
+    distance_miles, climb_m, descent_m (positive) and max_grade (steepest
+    climb between two stops, rise/run)
+    '''
+    first_trip = patterns.drop_duplicates('pattern_id')
+    rows = stop_times.assign(trip_id = stop_times.trip_id.astype(str))
+    rows = rows[rows.trip_id.isin(first_trip.trip_id)].sort_values(['trip_id', 'stop_sequence'])
+    rows = rows.merge(first_trip[['trip_id', 'pattern_id']], on = 'trip_id')
+    z = rows.stop_id.astype(str).map(elevation)
+    known = z.notna()
+    z = z.groupby(rows.pattern_id).transform(lambda e: e.ffill().bfill()).fillna(0).values
+
+    new_trip = np.append(True, rows.pattern_id.values[1:] != rows.pattern_id.values[:-1])
+    rise = np.where(new_trip, 0, np.diff(z, prepend=z[0]))
+    run = np.where(new_trip, 0, np.diff(rows.shape_dist_traveled.values, prepend=0))
+    grade = np.where(run > 0, rise/np.where(run > 0, run, 1), 0)
+
+    grades = pd.DataFrame({'pattern_id': rows.pattern_id.values, 'known': known.values,
+                           'run': run, 'climb_m': np.maximum(rise, 0), 'descent_m': np.maximum(-rise, 0),
+                           'grade': grade}).groupby('pattern_id')
+    table = pd.DataFrame({'trips': patterns.groupby('pattern_id').size(),
+                          'stops': grades.size(),
+                          'stops_with_elevation': grades.known.sum(),
+                          'distance_miles': grades.run.sum()/1609.34, # same conversion as create_trips_flattened.py
+                          'climb_m': grades.climb_m.sum(),
+                          'descent_m': grades.descent_m.sum(),
+                          'max_grade': grades.grade.max()})
+    return table
+
+
+# climb and descent of every trip in a flattened trips dataset
+def trip_grades(trip_ids, patterns, grades):
+    '''
+    Parameters
+    ----------
+    trip_ids : array like
+        e.g. the trip_id column of trips_flattened or BlockTable.trip_id
+    patterns, grades : dataframe
+        outputs of trip_patterns and pattern_grades
+
+    Returns
+    -------
+    dataframe: climb_m, descent_m and max_grade per trip (same order as
+    trip_ids), 0 for trips without a pattern
+    '''
+    pattern_id = pd.Series(patterns.pattern_id.values, index=patterns.trip_id.values)
+    pattern = pd.Series(np.asarray(trip_ids)).astype(str).map(pattern_id)
+    lookup = grades[['climb_m', 'descent_m', 'max_grade']].reindex(pattern.values).fillna(0)
+    return lookup.reset_index(drop = True)
+
+
+# coefficient table with the grade terms from physics
+def grade_coefficients(coefficients=None, mass_kg=BUS_MASS_KG, battery_kwh=BATTERY_KWH,
+                       drivetrain_efficiency=DRIVETRAIN_EFFICIENCY, regen_efficiency=REGEN_EFFICIENCY):
+    '''
+    Parameters
+    ----------
+    coefficients : dataframe, optional
+        see energy_model.load_coefficients, defaults to BusMileageRegressionParams.txt
+
+    Purpose
+    --------
+    Climbing h meters takes mass_kg*g*h/drivetrain_efficiency of battery energy
+    and descending h meters gives back regen_efficiency*mass_kg*g*h, both as a
+    percentage of battery_kwh per meter. Models that already have fitted grade
+    terms keep them.
+
+    Returns
+    -------
+    dataframe: copy of coefficients with ClimbBeta and DescentBeta filled in
+    '''
+    coefficients = (default_coefficients() if coefficients is None else coefficients).copy()
+    pct_per_meter = mass_kg*GRAVITY/JOULES_PER_KWH/battery_kwh*100
+    fitted = (coefficients[grade_coefficient_names] != 0).any(axis=1)
+    coefficients.loc[~fitted, 'ClimbBeta'] = pct_per_meter/drivetrain_efficiency
+    coefficients.loc[~fitted, 'DescentBeta'] = -pct_per_meter*regen_efficiency
+    return coefficients
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 4:
+        print('Usage: python grade_energy.py trips.csv stop_times.csv stops.csv [trips_flattened.csv]')
+        sys.exit(1)
+    trips = pd.read_csv(sys.argv[1], dtype = {'trip_id': str})
+    stop_times = pd.read_csv(sys.argv[2], usecols = ['trip_id', 'stop_id', 'stop_sequence', 'shape_dist_traveled'],
+                             dtype = {'trip_id': str, 'stop_id': str})
+    stops = pd.read_csv(sys.argv[3], dtype = {'stop_id': str})
+
+    elevation = stop_elevations(stops, load_stop_elevations())
+    print('Stops with an elevation: ', elevation.notna().sum(), ' of ', len(elevation))
+    patterns = trip_patterns(stop_times, trips)
+    grades = pattern_grades(stop_times, patterns, elevation)
+    print('Trips: ', len(patterns), ' trip patterns: ', len(grades))
+    patterns.to_csv('trip_patterns.csv', index = False)
+    grades.to_csv('pattern_grades.csv')
+
+    if len(sys.argv) > 4:
+        from energy_model import charge_required
+        df = pd.read_csv(sys.argv[4])
+        grade = trip_grades(df.trip_id.values, patterns, grades)
+        flat = charge_required(df.total_distance_traveled.values, df.timeDelta_minutes.values, 'Winter', '40ft')
+        hilly = charge_required(df.total_distance_traveled.values, df.timeDelta_minutes.values, 'Winter', '40ft',
+                                climb=grade.climb_m.values, descent=grade.descent_m.values,
+                                coefficients=grade_coefficients())
+        print('Mean charge per trip without grades: ', round(flat.mean(), 3), ' with grades: ', round(hilly.mean(), 3))
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Incremental Charger What-If
+
+Keeps the state of a charger assessment (BusMileage.py run_charging_assessment)
+so that a single charger site can be turned on or off and only the blocks that
+can reach that site are re-simulated. Updates the number of failed blocks with
+charging and the '# needed' chargers per stop.
+
+Usage: python incremental_charging.py [eastLib|brt|allRoutes]
+
+"""
+
+import contextlib
+import io
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from BusMileage import load_travel_time_matrix, run_charging_assessment
+from block_simulation import build_block_table, block_charge_required, simulate_block
+from charger_index import nearest_active_charger
+from charger_occupancy import ChargerTimeline
+
+
+# create IncrementalAssessment class
+class IncrementalAssessment:
+    """
+    IncrementalAssessment holds the charger assessment for one scenario.
+
+    Attributes of the class include:
+        - block_table, charge_required: trips and charge used per trip
+        - travel_time_matrix: copy of the travel time matrix, column 0 is updated on toggle
+        - charger_index: closest active charger and travel time per stop in tripLocations
+        - commute: travel time to the charger per trip, np.nan if the trip can't charge
+        - site_stops / site_blocks: reverse index from each layover location to the stops
+          within reach of it, and to the positions of the blocks charging at those stops
+        - numberOchargers: ChargerTimeline and '# needed' per stop
+        - charge_needed: failed_block_loop charge needed per failed block
+        - charge_options: failed_block_loop charge options per failed block, charge
+          added at each charger location
+        - final_failures: block position -> failed trip index, with charging
+    """
+
+    def __init__(self, block_table, tripLocations, travel_time_matrix, blockID_needing_charge,
+                 start_charge_pct, min_charge_threshold, min_charge_time,
+                 time_of_year, eval_type, bus_type, max_time=60):
+        '''
+        Parameters
+        ----------
+        block_table : BlockTable
+            output of build_block_table in block_simulation.py
+        tripLocations : pd.Series
+            indexed by stop, list of trips that can charge at that stop (output of run_charging_assessment)
+        travel_time_matrix : dataframe
+            output of load_travel_time_matrix in BusMileage.py
+        blockID_needing_charge : list
+            blocks failing without charging, these are assessed with failed_block_loop
+        max_time : float
+            travel time (minutes) at or above which a charger is out of reach
+        other parameters are the scenario settings, see run_charging_assessment
+        '''
+        self.block_table = block_table
+        self.start_charge_pct = start_charge_pct
+        self.min_charge_threshold = min_charge_threshold
+        self.min_charge_time = min_charge_time
+        self.max_time = max_time
+        self.charge_required = block_charge_required(block_table, time_of_year, bus_type, eval_type)
+        self.travel_time_matrix = travel_time_matrix.copy()
+        self.failed_blocks = set(np.searchsorted(block_table.block_ids, blockID_needing_charge).tolist())
+
+        # trips that can charge at each stop, as positions in the block table
+        trip_position = pd.Series(np.arange(len(block_table)), index=block_table.trip_id)
+        trips = tripLocations.explode()
+        self.stop_trips = pd.Series(trip_position.loc[trips.values.astype(int)].values,
+                                    index=trips.index.values)
+        block_index = block_table.block_index
+
+        # reverse index from each layover to the blocks that can reach it
+        stops = tripLocations.index.values
+        in_matrix = stops[np.isin(stops, self.travel_time_matrix.columns.values)]
+        times = self.travel_time_matrix[in_matrix].values.astype(float)
+        self.site_stops = {}
+        self.site_blocks = {}
+        for j, location in enumerate(self.travel_time_matrix.index.values):
+            reach = in_matrix[times[j] < max_time]
+            if location in self.site_stops:
+                reach = np.union1d(self.site_stops[location], reach)
+            self.site_stops[location] = reach
+            self.site_blocks[location] = np.unique(block_index[self.stop_trips.loc[reach].values])
+
+        # closest active charger per stop, and per trip
+        self.charger_index = nearest_active_charger(self.travel_time_matrix, stops, max_time)
+        self.commute = np.full(len(block_table), np.nan)
+        self._update_commute(stops)
+
+        self.numberOchargers = pd.DataFrame({'stop_id': stops,
+                                             'charger': [ChargerTimeline() for s in stops],
+                                             '# needed': 0}).set_index('stop_id')
+        self.block_stops = {}
+        self.charge_needed = {}
+        self.charge_options = {}
+        self.final_failures = {}
+        for b in self.failed_blocks:
+            self._simulate(b)
+        self.numberOchargers['# needed'] = [c.peak() for c in self.numberOchargers['charger']]
+
+    def _update_commute(self, stops):
+        for s in stops:
+            self.commute[self.stop_trips.loc[[s]].values] = self.charger_index['time'].loc[s]
+
+    # re-simulates one block: failed_block_loop, then the final check with charging
+    def _simulate(self, b):
+        block = self.block_table.block_ids[b]
+        changed = self.block_stops.get(b, set())
+        for s in changed:
+            self.numberOchargers['charger'].loc[s].remove_block(block)
+
+        failure, charge, sessions = simulate_block(self.block_table, b, self.charge_required, self.commute,
+                                                   self.start_charge_pct, self.min_charge_threshold,
+                                                   self.min_charge_time, last_end_time=60*24,
+                                                   stop_at_failure=False)
+        session_stops = set()
+        charge_options = {}
+        for i, start, charge_time, added_charge in sessions:
+            s = self.block_table.start_stop_id[i]
+            self.numberOchargers['charger'].loc[s].add_session(start, charge_time, block)
+            session_stops.add(s)
+            location = self.charger_index['location'].loc[s]
+            charge_options[location] = charge_options.get(location, 0) + added_charge
+        self.block_stops[b] = session_stops
+        self.charge_options[block] = charge_options
+        self.charge_needed[block] = max(self.min_charge_threshold - charge, 0)
+
+        failure = simulate_block(self.block_table, b, self.charge_required, self.commute,
+                                 self.start_charge_pct, self.min_charge_threshold, self.min_charge_time)[0]
+        if failure >= 0:
+            self.final_failures[b] = failure
+        else:
+            self.final_failures.pop(b, None)
+        return changed | session_stops
+
+    # turns a charger site on or off and re-simulates only the blocks that can reach it
+    def toggle(self, location):
+        '''
+        Parameters
+        ----------
+        location : str
+            layover location (row of the travel time matrix, e.g. 'TP7106')
+
+        Returns
+        -------
+        list
+            number of failed blocks with charging, and '# needed' for the stops that changed
+        '''
+        rows = np.where(self.travel_time_matrix.index.values == location)[0]
+        if len(rows) == 0:
+            raise KeyError('location ' + str(location) + ' not in travel time matrix')
+        active = self.travel_time_matrix.columns.get_loc(0)
+        self.travel_time_matrix.iloc[rows, active] = 1 - self.travel_time_matrix.iloc[rows, active]
+
+        stops = self.site_stops[location]
+        if len(stops) > 0:
+            self.charger_index.loc[stops] = nearest_active_charger(self.travel_time_matrix, stops, self.max_time)
+            self._update_commute(stops)
+        changed = set()
+        for b in self.site_blocks[location]:
+            if b in self.failed_blocks:
+                changed |= self._simulate(b)
+        changed = list(changed)
+        self.numberOchargers.loc[changed, '# needed'] = [c.peak() for c in self.numberOchargers['charger'].loc[changed]]
+        return [self.failed_block_count(), self.numberOchargers['# needed'].loc[changed]]
+
+    def failed_block_count(self):
+        return len(self.final_failures)
+
+    def final_blockID_needing_charge(self):
+        return sorted(self.block_table.block_ids[list(self.final_failures)].tolist())
+
+
+if __name__ == '__main__':
+
+    ### global vars
+    start_charge_pct = 90 # max charge at start
+    min_charge_threshold = 30 # minimum allowed charge remaining
+    min_charge_time = 5 #minimum charging time in minutes
+    time_of_year = 'Winter' # seasonality var
+    eval_type = 'reg' # whether to eval charging profile by regression or worst case scenario
+    bus_type = '40ft'
+    data = sys.argv[1] if len(sys.argv) > 1 else 'allRoutes'
+    repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    df = pd.read_csv(os.path.join(repo_path, data, 'trips_flattened_'+data+'.csv'))
+    travel_time_matrix = load_travel_time_matrix(os.path.join(repo_path, 'dataGenerated', 'stop_to_layover_travelTime.csv'))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = run_charging_assessment(df, start_charge_pct, min_charge_threshold, min_charge_time,
+                                          time_of_year, eval_type, bus_type, travel_time_matrix)
+    assessment = IncrementalAssessment(build_block_table(df), results['tripLocations'], travel_time_matrix,
+                                       results['blockID_needing_charge'], start_charge_pct,
+                                       min_charge_threshold, min_charge_time, time_of_year, eval_type, bus_type)
+    print('Failed blocks with charging: ', assessment.failed_block_count())
+
+    # turn each charger site off and back on
+    for location in travel_time_matrix.index[travel_time_matrix[0] == 1].unique():
+        t0 = time.perf_counter()
+        failed, needed = assessment.toggle(location)
+        toggle_time = time.perf_counter() - t0
+        print(location, ' off: ', failed, ' failed blocks (%.2f ms)' % (toggle_time*1000))
+        assessment.toggle(location)
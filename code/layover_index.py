@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Layover Index
+
+Spatial index over the candidate layover/charger sites in LayoverLocations.csv.
+Finds the k nearest sites within a radius of every trip end stop in one batched
+query, instead of a dense matrix over a hand-picked list of end stops, and turns
+the candidates into a travel time matrix in the layout of
+stop_to_layover_travelTime.csv for the simulation's charger reach lookup
+(nearest_active_charger in charger_index.py).
+
+The Google matrix in stop_to_layover_travelTime.csv only covers the flagged end
+stops. load_reach_matrix keeps it and adds the candidate sites of every other
+end stop, with screening travel times, so stops missing from the Google matrix
+can still reach a charger. scenario_sweep.py uses it with --layover-candidates,
+and running this file writes it to stop_to_layover_travelTime_candidates.csv,
+which can replace stop_to_layover_travelTime.csv anywhere it is read.
+
+Sites are stored as points on the unit sphere in a KD-tree (scipy), where the
+straight-line distance orders points the same way as the great circle
+(haversine) distance. Without scipy every query falls back to a brute force
+haversine search.
+
+Usage: python layover_index.py [k] [radius in miles]
+
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from charger_index import nearest_active_charger
+from travel_time_engine import (EARTH_RADIUS_MILES, DETOUR_FACTOR, SCREENING_SPEED_MPH,
+                                haversine_miles, load_layovers, read_active_chargers, unit_vectors,
+                                write_travel_time_csv)
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+
+repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+travel_time_path = os.path.join(repo_path, 'dataGenerated', 'stop_to_layover_travelTime.csv')
+trips_geo_path = os.path.join(repo_path, 'dataGenerated', 'trips_flattened_w_geo.csv')
+layovers_path = os.path.join(repo_path, 'dataGenerated', 'LayoverLocations.csv')
+
+# candidate sites per end stop and search radius (miles) for the reach matrix
+CANDIDATE_SITES = 5
+CANDIDATE_RADIUS_MILES = 10
+
+
+class LayoverIndex:
+    '''
+    Nearest candidate site lookup.
+
+    Attributes of the class include:
+        layovers: dataframe, candidate sites with StopID, Latitude and Longitude
+            (see load_layovers), sites without coordinates are left out
+        tree: cKDTree over the sites' unit vectors, None without scipy
+    '''
+    def __init__(self, layovers):
+        self.layovers = layovers[~(pd.isna(layovers.Latitude) | pd.isna(layovers.Longitude))].reset_index(drop = True)
+        self.points = unit_vectors(self.layovers.Latitude.values, self.layovers.Longitude.values)
+        self.tree = None if cKDTree is None else cKDTree(self.points)
+
+    def __len__(self):
+        return len(self.layovers)
+
+    # k nearest sites within radius_miles of each point
+    def query(self, lat, lon, k=5, radius_miles=np.inf):
+        '''
+        Parameters
+        ----------
+        lat, lon : np.array
+            points to look up
+        k : int
+            most sites returned per point
+        radius_miles : float
+            only sites within this great circle distance are returned
+
+        Returns
+        -------
+        list: site positions (points x k, -1 where there is no site) and distances
+        in miles (inf where there is no site), nearest first
+        '''
+        k = min(k, len(self))
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        if self.tree is not None:
+            # chord length of a great circle distance on the unit sphere
+            chord = np.inf if np.isinf(radius_miles) else 2*np.sin(min(radius_miles/EARTH_RADIUS_MILES, np.pi)/2)
+            _, sites = self.tree.query(unit_vectors(lat, lon), k=k, distance_upper_bound=chord)
+            sites = sites.reshape(len(lat), k)
+            found = sites < len(self)
+            sites = np.where(found, sites, -1)
+        else:
+            distance = haversine_miles(lat[:, None], lon[:, None],
+                                       self.layovers.Latitude.values[None, :], self.layovers.Longitude.values[None, :])
+            sites = np.argsort(distance, axis=1, kind='stable')[:, :k]
+            found = np.take_along_axis(distance, sites, axis=1) <= radius_miles
+            sites = np.where(found, sites, -1)
+        site_lat = np.where(found, self.layovers.Latitude.values[sites], np.nan)
+        site_lon = np.where(found, self.layovers.Longitude.values[sites], np.nan)
+        distance = np.where(found, haversine_miles(lat[:, None], lon[:, None], site_lat, site_lon), np.inf)
+        return [sites, distance]
+
+    # k nearest sites for each stop, one row per stop and site
+    def candidates(self, stops, k=5, radius_miles=np.inf):
+        '''
+        Parameters
+        ----------
+        stops : dataframe
+            stop_id, stop_lat and stop_lon
+
+        Returns
+        -------
+        dataframe: stop_id, rank (1 is nearest), site (position in layovers),
+        LayoverID and distance_miles, for the sites within radius_miles
+        '''
+        sites, distance = self.query(stops.stop_lat.values, stops.stop_lon.values, k, radius_miles)
+        candidates = pd.DataFrame({'stop_id': np.repeat(stops.stop_id.values, sites.shape[1]),
+                                   'rank': np.tile(np.arange(1, sites.shape[1] + 1), len(stops)),
+                                   'site': sites.ravel(),
+                                   'distance_miles': distance.ravel()})
+        candidates = candidates[candidates.site >= 0].reset_index(drop = True)
+        candidates.insert(3, 'LayoverID', self.layovers.StopID.values[candidates.site.values])
+        return candidates
+
+
+# end stops and their coordinates in a flattened trips dataset with stop coordinates
+def end_stops_from_trips(trips_geo):
+    '''
+    Parameters
+    ----------
+    trips_geo : dataframe
+        trips_flattened_w_geo.csv, with end_stop_id, end_stop_lat and end_stop_lon
+
+    Returns
+    -------
+    dataframe: stop_id, stop_lat, stop_lon, one row per end stop
+    '''
+    end_stops = trips_geo[['end_stop_id', 'end_stop_lat', 'end_stop_lon']].drop_duplicates('end_stop_id')
+    end_stops.columns = ['stop_id', 'stop_lat', 'stop_lon']
+    return end_stops.sort_values('stop_id').reset_index(drop = True)
+
+
+# candidate sites as a travel time matrix for the charger reach lookup
+def candidate_travel_time_matrix(candidates, layovers, active_chargers=None, travel_minutes=None):
+    '''
+    Parameters
+    ----------
+    candidates : dataframe
+        output of LayoverIndex.candidates
+    layovers : dataframe
+        LayoverIndex.layovers
+    active_chargers : array like, optional
+        0/1 flag per layover row, all 0 if None
+    travel_minutes : np.array, optional
+        travel time in minutes per candidate row. Defaults to the haversine
+        screening estimate in travel_time_engine.py (distance x detour factor at
+        the screening speed).
+
+    Returns
+    -------
+    dataframe: same layout as load_travel_time_matrix in BusMileage.py, layovers
+    (rows) x end stops (columns) plus column 0 for the active chargers. Sites that
+    aren't among a stop's candidates are empty, so they are never its nearest charger.
+    '''
+    if travel_minutes is None:
+        travel_minutes = candidates.distance_miles.values*DETOUR_FACTOR/SCREENING_SPEED_MPH*60
+    stops = pd.unique(candidates.stop_id)
+    stop_position = pd.Series(np.arange(len(stops)), index=stops)
+    times = np.full((len(layovers), len(stops)), np.nan)
+    times[candidates.site.values, stop_position.loc[candidates.stop_id.values].values] = travel_minutes
+    travel_time_matrix = pd.DataFrame(times, index=layovers.StopID.values, columns=stops)
+    travel_time_matrix[0] = np.zeros(len(layovers), dtype=int) if active_chargers is None else np.asarray(active_chargers)
+    return travel_time_matrix
+
+
+# layover ids as load_travel_time_matrix reads them back, repeats numbered like pandas (E70451, E70451.1)
+def matrix_layover_ids(stop_ids):
+    seen = {}
+    ids = []
+    for stop in stop_ids:
+        k = seen.get(stop, 0)
+        seen[stop] = k + 1
+        ids.append(stop if k == 0 else stop + '.' + str(k))
+    return ids
+
+
+# travel time matrix with the candidate sites of the stops it doesn't cover
+def extend_travel_time_matrix(travel_time_matrix, candidate_matrix):
+    '''
+    Parameters
+    ----------
+    travel_time_matrix : dataframe
+        output of load_travel_time_matrix in BusMileage.py, e.g. the Google matrix
+    candidate_matrix : dataframe
+        output of candidate_travel_time_matrix
+
+    Returns
+    -------
+    dataframe: travel_time_matrix plus one column per stop that is only in
+    candidate_matrix, with the candidate travel times on the matching layover
+    rows. Stops already in travel_time_matrix and the active charger flags
+    (column 0) are kept as they are.
+    '''
+    candidates = candidate_matrix.drop(columns=0)
+    candidates.index = matrix_layover_ids(candidates.index.values)
+    new_stops = [s for s in candidates.columns if s not in travel_time_matrix.columns]
+    return pd.concat([travel_time_matrix, candidates[new_stops].reindex(travel_time_matrix.index)], axis=1)
+
+
+# charger reach matrix: stop_to_layover_travelTime.csv plus the candidates of every other end stop
+def load_reach_matrix(path=travel_time_path, k=CANDIDATE_SITES, radius_miles=CANDIDATE_RADIUS_MILES,
+                      trips_geo_path=trips_geo_path, layovers_path=layovers_path):
+    '''
+    Parameters
+    ----------
+    path : str
+        stop_to_layover_travelTime.csv, its travel times and active chargers are kept
+    k, radius_miles :
+        candidate sites per end stop, see LayoverIndex.candidates
+    trips_geo_path : str
+        trips_flattened_w_geo.csv, its end stops get candidates
+    layovers_path : str
+        LayoverLocations.csv
+
+    Returns
+    -------
+    dataframe: same layout as load_travel_time_matrix in BusMileage.py, see extend_travel_time_matrix
+    '''
+    from BusMileage import load_travel_time_matrix
+
+    index = LayoverIndex(load_layovers(layovers_path))
+    end_stops = end_stops_from_trips(pd.read_csv(trips_geo_path))
+    candidates = index.candidates(end_stops, k, radius_miles)
+    candidate_matrix = candidate_travel_time_matrix(candidates, index.layovers,
+                                                    read_active_chargers(path, index.layovers))
+    return extend_travel_time_matrix(load_travel_time_matrix(path), candidate_matrix)
+
+
+if __name__ == '__main__':
+
+    k = int(sys.argv[1]) if len(sys.argv) > 1 else CANDIDATE_SITES
+    radius_miles = float(sys.argv[2]) if len(sys.argv) > 2 else CANDIDATE_RADIUS_MILES
+    layovers = load_layovers(layovers_path)
+    trips_geo = pd.read_csv(trips_geo_path)
+    end_stops = end_stops_from_trips(trips_geo)
+
+    index = LayoverIndex(layovers)
+    candidates = index.candidates(end_stops, k, radius_miles)
+    print('End stops: ', len(end_stops), ' with a candidate site: ', candidates.stop_id.nunique())
+    candidates.to_csv('end_stop_layover_candidates.csv', index = False)
+
+    # charger reach with the active chargers in stop_to_layover_travelTime.csv
+    reach = load_reach_matrix(travel_time_path, k, radius_miles)
+    charger_index = nearest_active_charger(reach, end_stops.stop_id.values)
+    print('End stops reaching an active charger: ', (charger_index.time < 60).sum(), ' of ', len(charger_index))
+    # same layout as stop_to_layover_travelTime.csv, rows are end stops and row 0 the active chargers
+    write_travel_time_csv(reach.drop(columns=0).T*60, 'stop_to_layover_travelTime_candidates.csv', reach[0].values)
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo Charge Depletion
+
+The depletion coefficients are an OLS fit on the PRT test runs
+(dataGenerated/PRT_data.csv, ~385 rows, see regression_fit.py), so the charge
+used per trip is an estimate. This draws coefficient samples from the fit's
+covariance and residual samples from its residual spread, evaluates every trip
+under every sample as one broadcast array (trips x samples, in chunks of
+samples to bound memory), and reports:
+    - the probability each block fails (no layover charging, same check as
+      find_failed_blocks in block_simulation.py), and
+    - the P50/P90/P99 number of chargers needed per charger site, the peak
+      overlap of the layover charge sessions of the blocks that fail in each
+      sample (sessions as in failed_block_loop in BusMileage.py).
+
+The residuals are for a PRT run, so each trip's residual is scaled by the
+square root of its duration over the mean PRT run duration (a block gets the
+spread of a run as long as the block). Coefficient samples are centered on the
+coefficients of the fit the covariance comes from: the coefficient table when
+it was written with its covariance by regression_fit.py (then with no spread
+the samples match find_failed_blocks), otherwise the refit on PRT_data.csv.
+
+Usage: python monte_carlo.py [eastLib|brt|allRoutes] [samples]
+
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from block_simulation import build_block_table
+from energy_model import bus_multiplier, coefficient_names, default_coefficients, eval_type_models, params_path
+from regression_fit import fit_models, load_prt_data, load_uncertainty, model_terms
+
+
+repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# trips x samples arrays of one chunk are kept under this size
+MAX_CHUNK_BYTES = 2**28
+
+
+# fitted coefficients, their covariance and the residual spread of one model and season
+def fit_uncertainty(prt_data, model, season):
+    '''
+    Parameters
+    ----------
+    prt_data : dataframe
+        output of regression_fit.load_prt_data
+    model : str
+        'distance', 'time' or 'distance+time'
+    season : str
+        'Summer' or 'Winter'
+
+    Returns
+    -------
+    list: coefficients and their covariance (sigma^2 (X'X)^-1), in
+    coefficient_names order with 0 for terms the model doesn't use, residual
+    standard deviation per PRT run, and the mean PRT run duration (minutes)
+    '''
+    if model not in model_terms:
+        raise ValueError('no fit for model ' + str(model) + ', choose from ' + str(list(model_terms)))
+    fit, covariance = fit_models(prt_data, [model])
+    row = fit.index.get_loc((model, season))
+    return [fit[coefficient_names].values[row], covariance[row], fit.Sigma.iloc[row], fit.MeanDuration.iloc[row]]
+
+
+# charge used by every trip under every sample
+def sample_charge_required(distance, duration, coefficient_samples, residuals, bus_type):
+    '''
+    Parameters
+    ----------
+    distance, duration : np.array
+        trip distance (miles) and duration (minutes)
+    coefficient_samples : np.array
+        samples x DistanceBeta, TimeBeta, Const
+    residuals : np.array or None
+        trips x samples residuals (battery pct), None for none
+    bus_type: str, 'jumbo' for 60ft, anything else means 40'
+
+    Returns
+    -------
+    np.array: trips x samples battery percentage required, same as
+    energy_model.charge_required for each row of coefficient_samples, plus the residual
+    '''
+    X = np.column_stack([distance, duration, np.ones(len(distance))])
+    batteryChange = np.abs(X @ coefficient_samples.T)
+    if residuals is not None:
+        batteryChange += residuals
+    return batteryChange*bus_multiplier(bus_type)
+
+
+# which blocks fail under every sample, no layover charging
+def failed_block_samples(block_table, charge_required_samples, start_charge_pct, min_charge_threshold):
+    '''
+    Returns
+    -------
+    np.array: blocks x samples, True where a trip of the block finishes below
+    min_charge_threshold (see charge_trajectory and first_failure in block_simulation.py)
+    '''
+    used = np.cumsum(charge_required_samples, axis=0)
+    # cumulative charge used before the first trip of each block
+    before_block = np.vstack([np.zeros((1, used.shape[1])), used])[block_table.offsets[:-1]]
+    charge_level = start_charge_pct - (used - np.repeat(before_block, np.diff(block_table.offsets), axis=0))
+    lowest = np.minimum.reduceat(charge_level, block_table.offsets[:-1], axis=0)
+    return lowest < min_charge_threshold
+
+
+# layover charge sessions of every block, as added to the ChargerTimeline in failed_block_loop
+def charge_sessions(block_table, site, commute, min_charge_time, last_end_time=60*24):
+    '''
+    Parameters
+    ----------
+    block_table : BlockTable
+    site, commute : np.array
+        charger site (None if the trip can't charge) and travel time (minutes)
+        per trip, see trip_chargers in contention_simulation.py
+    min_charge_time: int
+        minimum number of minutes required for charge to happen.
+    last_end_time : float
+        end time used for the layover before the first trip, 60*24 in failed_block_loop
+
+    Returns
+    -------
+    dataframe: one row per session with block (position in block_ids), site,
+    start and end (minutes, half open as in ChargerTimeline.add_session)
+    '''
+    last_end = np.append(np.nan, block_table.end_min[:-1])
+    last_end[block_table.offsets[:-1]] = last_end_time
+    charge_time = block_table.start_min - last_end - 2*commute
+    charges = ((block_table.start_min - last_end > min_charge_time) & (charge_time > min_charge_time)
+               & ~np.isnan(commute) & pd.notna(site))
+    start = (last_end + commute)[charges].astype(int)
+    return pd.DataFrame({'block': block_table.block_index[charges],
+                         'site': site[charges],
+                         'start': start,
+                         'end': start + charge_time[charges].astype(int)})
+
+
+# chargers needed per site under every sample, counting the sessions of failed blocks only
+def site_peak_samples(sessions, failed):
+    '''
+    Parameters
+    ----------
+    sessions : dataframe
+        output of charge_sessions
+    failed : np.array
+        blocks x samples, output of failed_block_samples
+
+    Purpose
+    --------
+    One sweep line for every site and sample: session starts (+1) and ends (-1)
+    sorted by site, minute and ends first, weighted by whether the session's block
+    failed in the sample. Every site's sessions end, so the running count is
+    back at 0 at the start of the next site.
+
+    Returns
+    -------
+    list: site names, and sites x samples peak number of sessions charging at the same minute
+    '''
+    sites, site_code = np.unique(sessions.site.values.astype(str), return_inverse=True)
+    n = len(sessions)
+    code = np.concatenate([site_code, site_code])
+    times = np.concatenate([sessions.start.values, sessions.end.values])
+    change = np.concatenate([np.ones(n, dtype=np.int32), -np.ones(n, dtype=np.int32)])
+    block = np.concatenate([sessions.block.values, sessions.block.values])
+    order = np.lexsort((change, times, code))
+    running = np.cumsum(change[order, None]*failed[block[order]], axis=0, dtype=np.int32)
+    first = np.searchsorted(code[order], np.arange(len(sites)))
+    return [sites, np.maximum.reduceat(running, first, axis=0)]
+
+
+# failure probability per block and charger count quantiles per site
+def monte_carlo(block_table, start_charge_pct, min_charge_threshold, time_of_year, eval_type, bus_type,
+                n_samples=1000, prt_data=None, coefficients=None, site=None, commute=None, min_charge_time=5,
+                quantiles=(0.5, 0.9, 0.99), residuals=True, seed=0, max_bytes=MAX_CHUNK_BYTES):
+    '''
+    Parameters
+    ----------
+    block_table : BlockTable
+    start_charge_pct : float
+        charging pct of bus at "full charge"
+    min_charge_threshold : float
+        min allowed charge for bus to take a trip.
+    time_of_year: str, "Summer", anything else uses the Winter model
+    eval_type: str, 'reg' (distance+time) or 'distance', 'time', 'distance+time'.
+        The worst case model isn't fitted, so it has no covariance.
+    bus_type: str, 'jumbo' for 60ft, anything else means 40'
+    n_samples : int
+        number of coefficient (and residual) samples
+    prt_data : dataframe, optional
+        runs to fit the covariance on, output of regression_fit.load_prt_data.
+        Defaults to the covariance written in BusMileageRegressionParams.txt by
+        regression_fit.py, or a fit on PRT_data.csv if the file has none
+    coefficients : dataframe, optional
+        coefficient table the samples are centered on, see
+        energy_model.load_coefficients. Defaults to BusMileageRegressionParams.txt
+        when the covariance is read from it, otherwise to the fitted coefficients
+    site, commute : np.array, optional
+        charger site and travel time per trip (see trip_chargers in
+        contention_simulation.py), no charger counts if None
+    min_charge_time: int
+        minimum number of minutes required for charge to happen.
+    quantiles : tuple
+        quantiles of the chargers needed per site
+    residuals : bool
+        add residual samples, False only samples the coefficients
+    seed : int
+        random seed, results don't depend on max_bytes
+    max_bytes : int
+        bound on the size of the trips x samples arrays of a chunk
+
+    Returns
+    -------
+    list
+        blocks: block_id, trips and failure_probability, most at risk first
+        sites: site, P50/P90/P99 (per quantiles), mean and max chargers needed
+        (None without site), and the number of failed blocks per sample
+    '''
+    model = eval_type_models.get(eval_type, eval_type)
+    season = 'Summer' if time_of_year == 'Summer' else 'Winter'
+    uncertainty = load_uncertainty(params_path) if prt_data is None else {}
+    if (model, season) in uncertainty:
+        covariance, sigma, mean_duration = uncertainty[(model, season)]
+        center = default_coefficients().loc[(model, season), coefficient_names].values.astype(float)
+    else:
+        # mean and covariance from the same fit
+        prt_data = load_prt_data() if prt_data is None else prt_data
+        center, covariance, sigma, mean_duration = fit_uncertainty(prt_data, model, season)
+    if coefficients is not None:
+        center = coefficients.loc[(model, season), coefficient_names].values.astype(float)
+
+    rng = np.random.default_rng(seed)
+    coefficient_samples = rng.multivariate_normal(center, covariance, n_samples, method='eigh')
+    residual_scale = sigma*np.sqrt(block_table.duration/mean_duration)
+    sessions = None if site is None else charge_sessions(block_table, site, commute, min_charge_time)
+
+    # 3 trips x samples float arrays are alive at once (charge, cumulative charge, charge level)
+    chunk = int(max(1, max_bytes // (3*8*max(len(block_table), 1))))
+    failed_count = np.zeros(len(block_table.block_ids))
+    failed_blocks = []
+    peaks = []
+    for s in range(0, n_samples, chunk):
+        samples = coefficient_samples[s:s+chunk]
+        # drawn samples x trips so the random stream doesn't depend on the chunk size
+        noise = rng.standard_normal((len(samples), len(block_table))).T*residual_scale[:, None] if residuals else None
+        required = sample_charge_required(block_table.distance, block_table.duration, samples, noise, bus_type)
+        failed = failed_block_samples(block_table, required, start_charge_pct, min_charge_threshold)
+        failed_count += failed.sum(axis=1)
+        failed_blocks.append(failed.sum(axis=0))
+        if sessions is not None:
+            sites, peak = site_peak_samples(sessions, failed)
+            peaks.append(peak)
+
+    blocks = pd.DataFrame({'block_id': block_table.block_ids,
+                           'trips': np.diff(block_table.offsets),
+                           'failure_probability': failed_count/n_samples})
+    blocks = blocks.sort_values('failure_probability', ascending=False, kind='stable').reset_index(drop = True)
+    site_chargers = None
+    if sessions is not None:
+        peak = np.hstack(peaks)
+        site_chargers = pd.DataFrame({'site': sites})
+        for q in quantiles:
+            site_chargers['P%g' % (q*100)] = np.quantile(peak, q, axis=1)
+        site_chargers['mean'] = peak.mean(axis=1)
+        site_chargers['max'] = peak.max(axis=1)
+    return [blocks, site_chargers, np.concatenate(failed_blocks)]
+
+
+if __name__ == '__main__':
+
+    from BusMileage import load_travel_time_matrix
+    from contention_simulation import trip_chargers
+
+    ### global vars
+    start_charge_pct = 90 # max charge at start
+    min_charge_threshold = 30 # minimum allowed charge remaining
+    min_charge_time = 5 #minimum charging time in minutes
+    time_of_year = 'Winter' # seasonality var
+    eval_type = 'reg' # regression model to sample, the worst case model can't be sampled
+    bus_type = '40ft'
+    data = sys.argv[1] if len(sys.argv) > 1 else 'allRoutes'
+    n_samples = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    df = pd.read_csv(os.path.join(repo_path, data, 'trips_flattened_'+data+'.csv'))
+    block_table = build_block_table(df)
+    travel_time_matrix = load_travel_time_matrix(os.path.join(repo_path, 'dataGenerated', 'stop_to_layover_travelTime.csv'))
+    site, commute = trip_chargers(block_table, travel_time_matrix)
+
+    blocks, site_chargers, failed_blocks = monte_carlo(block_table, start_charge_pct, min_charge_threshold,
+                                                       time_of_year, eval_type, bus_type, n_samples,
+                                                       site=site, commute=commute, min_charge_time=min_charge_time)
+    print('Failed blocks P50/P90/P99: ', np.quantile(failed_blocks, [0.5, 0.9, 0.99]))
+    print('Blocks failing in over 10% of samples: ', (blocks.failure_probability > 0.1).sum(), ' of ', len(blocks))
+    print(blocks.head(20))
+    print(site_chargers)
+    blocks.to_csv('monte_carlo_blocks_'+data+'.csv', index = False)
+    site_chargers.to_csv('monte_carlo_sites_'+data+'.csv', index = False)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Multi-Day Simulation
+
+Rolling simulation over several service days (e.g. a week or a month of GTFS
+service_ids). Each day's blocks are run by vehicles from a garage fleet, and
+vehicles are recharged overnight at their garage with a limited number of
+chargers and a power limit. The state of charge each vehicle ends the night with
+is where its next block starts, instead of every block starting at
+start_charge_pct as in charge_status_via_trip_completion.
+
+Days are simulated one at a time; only the per-vehicle state of charge and
+depot arrival time is kept between days, so memory doesn't grow with the number
+of days simulated.
+
+Dispatch: at each garage, the day's blocks are handed out in order of pull-out
+time to the vehicles in order of their return to the garage the day before
+(first in, first out). Vehicles are added to the fleet at start_charge_pct when
+a garage has more blocks than vehicles.
+
+Every day needs its own service_ids: the datasets hold several day types (and
+duplicated service_ids, e.g. 1 and 2 in allRoutes), so running every service_id
+every day would put several days of blocks on the fleet at once. Give either a
+GTFS calendar, or one service_id to run every day.
+
+Usage: python multiday_simulation.py [eastLib|brt|allRoutes] (--calendar calendar.csv | --service-id 4) [--start-date 20230101]
+
+"""
+
+import argparse
+import heapq
+import os
+
+import numpy as np
+import pandas as pd
+
+from block_simulation import build_block_table, block_charge_required, charge_trajectory, first_failure
+
+
+repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+DAY_MINUTES = 60*24
+
+weekdays = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+
+# create Garage class
+class Garage:
+    """
+    Overnight charging inventory of a garage.
+
+    Attributes of the class include:
+        - name
+        - chargers: number of depot chargers (one bus per charger at a time)
+        - charger_kw: rated power of each charger
+        - power_limit_kw: most power the garage can draw for charging, None for
+          chargers*charger_kw
+    """
+
+    def __init__(self, name, chargers, charger_kw, power_limit_kw=None):
+        self.name = name
+        self.chargers = chargers
+        self.charger_kw = charger_kw
+        self.power_limit_kw = power_limit_kw
+
+    def charger_power(self):
+        '''
+        Returns
+        -------
+        float: power of each charger when all of them are in use (kW)
+        '''
+        if self.power_limit_kw is None or self.chargers == 0:
+            return self.charger_kw
+        return min(self.charger_kw, self.power_limit_kw/self.chargers)
+
+
+# service_ids running on each day, from GTFS calendar.txt
+def service_calendar(calendar, start_date, n_days):
+    '''
+    Parameters
+    ----------
+    calendar : dataframe
+        GTFS calendar, with service_id, monday ... sunday, start_date and end_date
+    start_date : str
+        first day, 'YYYYMMDD'
+    n_days : int
+
+    Returns
+    -------
+    list: (date, list of service_ids) per day
+    '''
+    days = []
+    for date in pd.date_range(pd.to_datetime(str(start_date), format='%Y%m%d'), periods=n_days):
+        ymd = int(date.strftime('%Y%m%d'))
+        running = calendar[(calendar[weekdays[date.weekday()]] == 1) &
+                           (calendar.start_date <= ymd) & (calendar.end_date >= ymd)]
+        days.append((date, sorted(running.service_id.tolist())))
+    return days
+
+
+# garage of each block, from the route of its first trip
+def block_garages(block_table, route_garage=None, default_garage='depot'):
+    '''
+    Parameters
+    ----------
+    route_garage : dict, optional
+        route_id -> garage name, routes not in it go to default_garage
+
+    Returns
+    -------
+    np.array: garage name per block
+    '''
+    first_route = block_table.route_id[block_table.offsets[:-1]]
+    route_garage = {} if route_garage is None else route_garage
+    return np.array([route_garage.get(r, default_garage) for r in first_route], dtype=object)
+
+
+# charge vehicles at a garage between their arrival and departure
+def overnight_charge(garage, soc, arrival, departure, max_charge_pct, battery_kwh):
+    '''
+    Parameters
+    ----------
+    garage : Garage
+    soc : np.array
+        state of charge (pct) of each vehicle when it arrives
+    arrival, departure : np.array
+        minutes, on the same clock (finite arrivals). Vehicles without a block to run
+        have departure inf.
+    max_charge_pct : float
+        charging stops at this state of charge
+    battery_kwh : float
+        usable battery capacity
+
+    Purpose
+    --------
+    Vehicles get a free charger in order of arrival, and charge at
+    garage.charger_power() until they reach max_charge_pct or leave.
+
+    Returns
+    -------
+    list: state of charge at departure, and energy delivered (kWh) for each vehicle
+    '''
+    soc = np.array(soc, dtype=float)
+    energy = np.zeros(len(soc))
+    power = garage.charger_power()
+    if garage.chargers == 0 or power <= 0:
+        return [soc, energy]
+    free = [-np.inf]*garage.chargers
+    for v in np.argsort(arrival, kind='stable'):
+        free_at = heapq.heappop(free)
+        plug = max(arrival[v], free_at)
+        needed = max(max_charge_pct - soc[v], 0)/100*battery_kwh
+        charge_minutes = min(needed/power*60, max(departure[v] - plug, 0))
+        energy[v] = power*charge_minutes/60
+        soc[v] = soc[v] + energy[v]/battery_kwh*100
+        # a vehicle that doesn't charge leaves the charger free
+        heapq.heappush(free, plug + charge_minutes if charge_minutes > 0 else free_at)
+    return [soc, energy]
+
+
+class MultiDaySimulation:
+    """
+    Rolling multi-day simulation state.
+
+    Attributes of the class include:
+        - trips: flattened trips dataset (with service_id_start)
+        - garages: dict of garage name -> Garage
+        - soc: dict of garage name -> state of charge of each vehicle
+        - arrival: dict of garage name -> minute each vehicle got back to the
+          garage, on the clock of the last simulated day (-inf if it stayed in)
+        - day: number of days simulated
+    """
+
+    def __init__(self, trips, garages, start_charge_pct, min_charge_threshold, time_of_year,
+                 eval_type, bus_type, battery_kwh, route_garage=None, default_garage='depot'):
+        self.trips = trips
+        self.garages = garages
+        self.start_charge_pct = start_charge_pct
+        self.min_charge_threshold = min_charge_threshold
+        self.time_of_year = time_of_year
+        self.eval_type = eval_type
+        self.bus_type = bus_type
+        self.battery_kwh = battery_kwh
+        self.route_garage = route_garage
+        self.default_garage = default_garage
+        self.soc = {g: np.zeros(0) for g in garages}
+        self.arrival = {g: np.zeros(0) for g in garages}
+        self.day = 0
+        # one block table per set of service_ids (day type), not per day
+        self._day_types = {}
+
+    def day_type(self, service_ids):
+        '''
+        Returns
+        -------
+        list: BlockTable of the day's trips, charge required per trip and garage per block
+        '''
+        key = tuple(sorted(service_ids))
+        if key not in self._day_types:
+            trips = self.trips[self.trips.service_id_start.isin(key)]
+            block_table = build_block_table(trips)
+            charge_required = block_charge_required(block_table, self.time_of_year, self.bus_type, self.eval_type)
+            garages = block_garages(block_table, self.route_garage, self.default_garage)
+            self._day_types[key] = [block_table, charge_required, garages]
+        return self._day_types[key]
+
+    # simulate the next day
+    def run_day(self, service_ids, date=None):
+        '''
+        Parameters
+        ----------
+        service_ids : list
+            service_ids running that day
+        date : optional
+            label for the day in the summary
+
+        Returns
+        -------
+        list of dict: one summary row per garage
+        '''
+        block_table, charge_required, block_garage = self.day_type(service_ids)
+        first = block_table.offsets[:-1]
+        last = block_table.offsets[1:] - 1
+        pull_out = block_table.start_min[first]
+        pull_in = block_table.end_min[last]
+
+        # vehicle running each block, and state of charge at pull out
+        start_soc = np.zeros(len(block_table.block_ids))
+        block_vehicle = np.zeros(len(block_table.block_ids), dtype=int)
+        summary = []
+        for name, garage in self.garages.items():
+            blocks = np.where(block_garage == name)[0]
+            blocks = blocks[np.argsort(pull_out[blocks], kind='stable')]
+            soc, arrival = self.soc[name], self.arrival[name]
+            added = max(len(blocks) - len(soc), 0)
+            soc = np.append(soc, np.full(added, float(self.start_charge_pct)))
+            arrival = np.append(arrival, np.full(added, -np.inf))
+            # previous day's clock is 24 hours earlier, vehicles that stayed in
+            # have been at the garage since the start of the previous day
+            arrival = np.where(np.isinf(arrival), -DAY_MINUTES, arrival - DAY_MINUTES)
+
+            vehicles = np.argsort(arrival, kind='stable')[:len(blocks)]
+            departure = np.full(len(soc), np.inf)
+            departure[vehicles] = pull_out[blocks]
+            if self.day == 0:
+                energy = np.zeros(len(soc))
+            else:
+                soc, energy = overnight_charge(garage, soc, arrival, departure,
+                                               self.start_charge_pct, self.battery_kwh)
+            start_soc[blocks] = soc[vehicles]
+            block_vehicle[blocks] = vehicles
+            self.soc[name], self.arrival[name] = soc, arrival
+            summary.append({'day': self.day, 'date': date, 'garage': name, 'blocks': len(blocks),
+                            'vehicles': len(soc), 'vehicles_added': added,
+                            'depot_energy_kwh': energy.sum(),
+                            'min_pull_out_soc': soc[vehicles].min() if len(blocks) > 0 else np.nan})
+
+        # run the blocks from each vehicle's state of charge
+        charge_level = charge_trajectory(block_table, np.repeat(start_soc, np.diff(block_table.offsets)),
+                                         charge_required)
+        failed = first_failure(block_table, charge_level, self.min_charge_threshold) >= 0
+        end_soc = np.maximum(charge_level[last], 0)
+
+        for row in summary:
+            name = row['garage']
+            blocks = block_garage == name
+            vehicles = block_vehicle[blocks]
+            # vehicles that stayed in have been at the garage all day
+            arrival = np.full(len(self.soc[name]), -np.inf)
+            arrival[vehicles] = pull_in[blocks]
+            self.soc[name][vehicles] = end_soc[blocks]
+            self.arrival[name] = arrival
+            row['failed_blocks'] = int(failed[blocks].sum())
+            row['min_pull_in_soc'] = end_soc[blocks].min() if blocks.any() else np.nan
+        self.day += 1
+        return summary
+
+
+# streams the simulation day by day
+def run_days(simulation, days):
+    '''
+    Parameters
+    ----------
+    simulation : MultiDaySimulation
+    days : iterable of (date, list of service_ids), see service_calendar
+
+    Returns
+    -------
+    generator of dict: summary row per garage per day
+    '''
+    for date, service_ids in days:
+        for row in simulation.run_day(service_ids, date):
+            yield row
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Rolling multi-day simulation with overnight depot charging.')
+    parser.add_argument('data', nargs='?', default='allRoutes', help="'eastLib', 'brt' or 'allRoutes'")
+    service = parser.add_mutually_exclusive_group(required=True)
+    service.add_argument('--calendar', help='GTFS calendar.csv, the service_ids running each day')
+    service.add_argument('--service-id', type=int, help='run this one service_id every day, without a calendar')
+    parser.add_argument('--start-date', default='20230101', help='YYYYMMDD')
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--chargers', type=int, default=50, help='depot chargers per garage')
+    parser.add_argument('--charger-kw', type=float, default=150)
+    parser.add_argument('--power-limit-kw', type=float, default=None, help='garage charging power limit')
+    parser.add_argument('--battery-kwh', type=float, default=440)
+    args = parser.parse_args()
+
+    ### global vars
+    start_charge_pct = 90 # max charge at start
+    min_charge_threshold = 30 # minimum allowed charge remaining
+    time_of_year = 'Winter' # seasonality var
+    eval_type = 'reg' # whether to eval charging profile by regression or worst case scenario
+    bus_type = '40ft'
+
+    trips = pd.read_csv(os.path.join(repo_path, args.data, 'trips_flattened_'+args.data+'.csv'))
+    if args.calendar is not None:
+        days = service_calendar(pd.read_csv(args.calendar), args.start_date, args.days)
+    else:
+        if args.service_id not in trips.service_id_start.values:
+            raise ValueError('service_id ' + str(args.service_id) + ' not in the dataset, choose from '
+                             + str(sorted(trips.service_id_start.unique().tolist())))
+        days = [(date, [args.service_id]) for date in pd.date_range(pd.to_datetime(args.start_date, format='%Y%m%d'),
+                                                                    periods=args.days)]
+    garages = {'depot': Garage('depot', args.chargers, args.charger_kw, args.power_limit_kw)}
+    simulation = MultiDaySimulation(trips, garages, start_charge_pct, min_charge_threshold, time_of_year,
+                                    eval_type, bus_type, args.battery_kwh)
+    summary = pd.DataFrame(list(run_days(simulation, days)))
+    print(summary)
+    summary.to_csv('multiday_summary.csv', index = False)
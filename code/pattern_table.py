@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pattern Table
+
+Interns the trips of a flattened trips dataset into trip patterns: trips with
+the same route_id, trip_headsign, start_stop_id, end_stop_id and
+total_distance_traveled (same as the rows of dataGenerated/route_mileage.csv,
+split by end stops) only differ in their start time. Each pattern is stored
+once, and trips are stored as integer arrays of pattern id and start/end
+seconds after midnight, grouped by block like the BlockTable.
+
+Charge required, distance and charger reach are computed once per pattern (per
+pattern and trip duration for models with a time term) and broadcast back to
+the trips.
+
+Usage: python pattern_table.py [eastLib|brt|allRoutes]
+
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from block_simulation import block_table_from_columns
+from contention_simulation import trip_chargers
+from energy_model import charge_required
+from trips_cache import seconds_to_minutes, time_to_seconds
+
+
+repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# trip columns that define a pattern
+pattern_columns = ['route_id', 'trip_headsign', 'start_stop_id', 'end_stop_id', 'total_distance_traveled']
+
+
+# create PatternTable class
+class PatternTable:
+    """
+    PatternTable holds the flattened trips dataset as a pattern table and
+    integer trip arrays, with the trips of each block stored contiguously (same
+    order as BlockTable).
+
+    Attributes of the class include:
+        - patterns: dataframe, one row per pattern with the pattern_columns and
+          first_trip (trip_id of a trip of the pattern, e.g. for grade_energy.trip_grades)
+        - block_ids: unique block ids, sorted (same order as np.unique)
+        - offsets: start index of each block in the trip arrays, plus the total length
+        - trip_id
+        - pattern_id: int32 row of patterns per trip
+        - start_sec, end_sec: int32 trip start/end times in seconds after midnight
+        - duration_min: trip duration (minutes) as given in the dataset
+          (timeDelta_minutes), None to compute it from start_sec and end_sec
+    """
+
+    def __init__(self):
+        self.patterns = None
+        self.block_ids = None
+        self.offsets = None
+        self.trip_id = None
+        self.pattern_id = None
+        self.start_sec = None
+        self.end_sec = None
+        self.duration_min = None
+
+    def __len__(self):
+        return len(self.trip_id)
+
+    def start_min(self):
+        return seconds_to_minutes(self.start_sec)
+
+    def end_min(self):
+        return seconds_to_minutes(self.end_sec)
+
+    def duration(self):
+        '''
+        Returns
+        -------
+        np.array: trip duration (minutes), same as timeDelta_minutes in create_trips_flattened.py
+        '''
+        if self.duration_min is not None:
+            return self.duration_min
+        return ((self.end_sec.astype(np.int64) - self.start_sec) % 86400)/60
+
+    def distance(self):
+        '''
+        Returns
+        -------
+        np.array: total distance traveled per trip (miles)
+        '''
+        return self.patterns.total_distance_traveled.values[self.pattern_id]
+
+    def nbytes(self):
+        '''
+        Returns
+        -------
+        int: memory used by the trip arrays and the pattern table
+        '''
+        arrays = [self.block_ids, self.offsets, self.trip_id, self.pattern_id, self.start_sec, self.end_sec]
+        if self.duration_min is not None:
+            arrays.append(self.duration_min)
+        return sum(a.nbytes for a in arrays) + int(self.patterns.memory_usage(deep=True).sum())
+
+    # charge used by every trip, evaluated once per (pattern, duration)
+    def charge_required(self, time_of_year, bus_type, eval_type, coefficients=None, grades=None):
+        '''
+        Parameters
+        ----------
+        coefficients : dataframe, optional
+            see energy_model.load_coefficients, defaults to BusMileageRegressionParams.txt
+        grades : dataframe, optional
+            climb_m and descent_m per pattern (same order as patterns), e.g.
+            grade_energy.trip_grades(table.patterns.first_trip, ...)
+
+        Returns
+        -------
+        np.array: battery percentage required to complete each trip, see energy_model.charge_required
+        '''
+        keys, trip_key = np.unique(np.column_stack([self.pattern_id, self.duration()]), axis=0, return_inverse=True)
+        key_pattern = keys[:, 0].astype(np.int64)
+        climb = None if grades is None else grades.climb_m.values[key_pattern]
+        descent = None if grades is None else grades.descent_m.values[key_pattern]
+        required = charge_required(self.patterns.total_distance_traveled.values[key_pattern], keys[:, 1],
+                                   time_of_year, bus_type, eval_type, coefficients, climb=climb, descent=descent)
+        return required[trip_key.ravel()]
+
+    # closest active charger to every trip's start stop, looked up once per pattern
+    def charger_reach(self, travel_time_matrix, stops=None, max_time=60):
+        '''
+        Parameters
+        ----------
+        travel_time_matrix : dataframe
+            output of load_travel_time_matrix in BusMileage.py
+        stops : list, optional
+            start stops where trips can charge (e.g. tripLocations.index), every start stop if None
+        max_time : float
+            chargers this far (minutes) or further are out of reach
+
+        Returns
+        -------
+        list: charger site (None if the trip can't charge) and commute (minutes,
+        nan if the trip can't charge) per trip, from trip_chargers in
+        contention_simulation.py run on one trip per pattern
+        '''
+        if stops is None:
+            stops = np.unique(self.patterns.start_stop_id)
+        site, commute = trip_chargers(self.pattern_block_table(), travel_time_matrix, stops, max_time)
+        return [site[self.pattern_id], commute[self.pattern_id]]
+
+    # one row per pattern, with the pattern's stops, for lookups done once per pattern
+    def pattern_block_table(self):
+        '''
+        Returns
+        -------
+        BlockTable: one single trip block per pattern, in pattern order
+        '''
+        n = len(self.patterns)
+        columns = {'trip_id': self.patterns.first_trip.values,
+                   'block_id': np.arange(n),
+                   'start_min': np.zeros(n),
+                   'end_min': np.zeros(n),
+                   'distance': self.patterns.total_distance_traveled.values.astype(float),
+                   'duration': np.zeros(n)}
+        for column in ['route_id', 'start_stop_id', 'end_stop_id']:
+            columns[column] = self.patterns[column].values
+        return block_table_from_columns(columns)
+
+    # expands the patterns back into a block table for the simulation
+    def to_block_table(self):
+        '''
+        Returns
+        -------
+        BlockTable: same trips and order, distance from the pattern and duration
+        from duration(). Its pattern_table is this table, so block_charge_required
+        evaluates it per pattern.
+        '''
+        columns = {'trip_id': self.trip_id,
+                   'block_id': np.repeat(self.block_ids, np.diff(self.offsets)),
+                   'start_min': self.start_min(),
+                   'end_min': self.end_min(),
+                   'distance': self.distance(),
+                   'duration': self.duration()}
+        for column in ['route_id', 'start_stop_id', 'end_stop_id']:
+            columns[column] = self.patterns[column].values[self.pattern_id]
+        block_table = block_table_from_columns(columns)
+        block_table.pattern_table = self
+        return block_table
+
+
+# intern the trips of a flattened trips dataset into patterns
+def build_pattern_table(trips_flattened_df):
+    '''
+    Parameters
+    ----------
+    trips_flattened_df : dataframe
+        output of the create_trips_flattened.py file, block-trip level dataset on the drive.
+
+    Returns
+    -------
+    PatternTable
+    '''
+    df = trips_flattened_df
+    columns = {column: df[column].values for column in pattern_columns + ['trip_id', 'block_id']}
+    columns['distance'] = columns.pop('total_distance_traveled').astype(float)
+    columns['start_sec'] = time_to_seconds(df.trip_start_time)
+    columns['end_sec'] = time_to_seconds(df.trip_end_time)
+    columns['duration'] = df.timeDelta_minutes.values.astype(float)
+    return pattern_table_from_columns(columns)
+
+
+# intern trip level arrays into patterns (see build_pattern_table and trips_cache.py)
+def pattern_table_from_columns(columns):
+    '''
+    Parameters
+    ----------
+    columns : dict
+        trip level arrays for trip_id, block_id, route_id, trip_headsign,
+        start_stop_id, end_stop_id, distance, start_sec and end_sec, and
+        optionally duration (minutes)
+
+    Returns
+    -------
+    PatternTable
+    '''
+    # stable sort keeps the dataset order of the trips within a block, same as block_table_from_columns
+    order = np.argsort(columns['block_id'], kind='stable')
+    keys = pd.DataFrame({column: np.asarray(columns[column])[order] for column in pattern_columns[:-1]})
+    keys['total_distance_traveled'] = np.asarray(columns['distance'], dtype=float)[order]
+    pattern_id = keys.groupby(pattern_columns, sort=True, dropna=False).ngroup().values
+
+    table = PatternTable()
+    first = np.unique(pattern_id, return_index=True)[1]
+    table.patterns = keys.iloc[first].reset_index(drop = True)
+    table.trip_id = np.asarray(columns['trip_id'])[order]
+    table.patterns['first_trip'] = table.trip_id[first]
+    table.block_ids, starts = np.unique(np.asarray(columns['block_id'])[order], return_index=True)
+    table.offsets = np.append(starts, len(order))
+    table.pattern_id = pattern_id.astype(np.int32)
+    table.start_sec = np.asarray(columns['start_sec'], dtype=np.int32)[order]
+    table.end_sec = np.asarray(columns['end_sec'], dtype=np.int32)[order]
+    if 'duration' in columns:
+        table.duration_min = np.asarray(columns['duration'], dtype=float)[order]
+    return table
+
+
+if __name__ == '__main__':
+
+    ### global vars
+    time_of_year = 'Winter' # seasonality var
+    eval_type = 'reg' # whether to eval charging profile by regression or worst case scenario
+    bus_type = '40ft'
+    data = sys.argv[1] if len(sys.argv) > 1 else 'allRoutes'
+
+    df = pd.read_csv(os.path.join(repo_path, data, 'trips_flattened_'+data+'.csv'))
+    table = build_pattern_table(df)
+    print('Trips: ', len(table), ' patterns: ', len(table.patterns),
+          ' memory (MB): ', round(table.nbytes()/1e6, 3), ' dataframe (MB): ',
+          round(df.memory_usage(deep=True).sum()/1e6, 3))
+    required = table.charge_required(time_of_year, bus_type, eval_type)
+    print('Mean charge required per trip: ', round(required.mean(), 3))
+    table.patterns.to_csv('trip_patterns_'+data+'.csv', index_label = 'pattern_id')
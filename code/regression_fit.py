@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Regression Fit
+
+Fits the charge depletion models used by the simulation from the PRT test runs
+(dataGenerated/PRT_data.csv) and any charging logs with the same measurements,
+and writes the coefficient table in the BusMileageRegressionParams.txt layout,
+so energy_model.load_coefficients (and get_charge_required in BusMileage.py)
+read it as is. Replaces the hand-copied coefficients of Model_PRT.ipynb and the
+per-row duration parsing of baselineLinearModel.py.
+
+    - Durations (H:MM:SS) are parsed for the whole column at once.
+    - The distance, time and distance+time models of every season are solved
+      together from the normal equations (X'X b = X'y), one batched solve.
+    - Bootstrap confidence intervals resample the runs of each season with
+      multinomial counts, so a batch of replicates is also one batched solve.
+      Batches run across processes.
+    - The output file has a version number (one more than the file it
+      replaces), the fit date and the sha256 of the input data, and keeps the
+      worst case models, which aren't fitted, from the file it replaces. The
+      residual spread and covariance of each fit are written with the
+      coefficients (see load_uncertainty, used by monte_carlo.py).
+
+Usage example:
+    python regression_fit.py --log ChargingDataJuly.csv Summer --bootstrap 2000 \
+        --output BusMileageRegressionParams.txt
+
+"""
+
+import argparse
+import datetime
+import hashlib
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from energy_model import coefficient_names, grade_coefficient_names, load_coefficients, params_path
+
+
+repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+prt_path = os.path.join(repo_path, 'dataGenerated', 'PRT_data.csv')
+
+# regressors of each fitted model, the other terms are 0
+model_terms = {'distance': ['DistanceBeta', 'Const'],
+               'time': ['TimeBeta', 'Const'],
+               'distance+time': ['DistanceBeta', 'TimeBeta', 'Const']}
+seasons = ['Summer', 'Winter']
+
+# models written to the coefficient file, in order, with their header
+model_headers = {'distance': 'DISTANCE MODELS', 'time': 'TIME MODELS',
+                 'distance+time': 'DISTANCE+TIME MODELS', 'worst case': 'WORST CASE MODELS'}
+
+# bootstrap replicates per batch (and per process)
+BOOTSTRAP_BATCH = 250
+
+
+# duration strings to minutes, for a whole column at once
+def duration_minutes(durations):
+    '''
+    Parameters
+    ----------
+    durations : pd.Series
+        'H:MM:SS' durations, hours can be over 24
+
+    Returns
+    -------
+    np.array: duration in minutes, nan where missing
+    '''
+    return pd.to_timedelta(durations).dt.total_seconds().values/60
+
+
+# reads the PRT test runs
+def load_prt_data(path=prt_path):
+    '''
+    Returns
+    -------
+    dataframe: PRT_data.csv with Season ('Summer' or 'Winter', from Seasonality)
+    and timeDelta_minutes (from Duration, H:MM:SS)
+    '''
+    prt_data = pd.read_csv(path)
+    prt_data['Season'] = np.where(prt_data.Seasonality == 1, 'Winter', 'Summer')
+    prt_data['timeDelta_minutes'] = duration_minutes(prt_data.Duration)
+    return prt_data
+
+
+# reads a charging log (e.g. ChargingDataJuly.csv, WinterChargingData.csv) in the PRT_data.csv layout
+def load_charging_log(path, season):
+    '''
+    Parameters
+    ----------
+    path : str
+        csv with Date, Duration (H:MM:SS), Distance and Battery Change columns,
+        as read by baselineLinearModel.py
+    season : str
+        'Summer' or 'Winter', season of every run in the log
+
+    Returns
+    -------
+    dataframe: Date, Distance, Electric_use (battery pct used), Seasonality,
+    Season and timeDelta_minutes, runs without a duration left out
+    '''
+    log = pd.read_csv(path)
+    log = log[log.Duration.notna()].reset_index(drop = True)
+    return pd.DataFrame({'Date': log.Date,
+                         'Distance': log.Distance.astype(float),
+                         'Electric_use': log['Battery Change'].astype(float).abs(),
+                         'Seasonality': int(season == 'Winter'),
+                         'Season': season,
+                         'timeDelta_minutes': duration_minutes(log.Duration)})
+
+
+# one model matrix per (model, season), so all fits are one batched solve
+def _model_masks(models):
+    '''
+    Returns
+    -------
+    np.array: models x 3, True for the terms (coefficient_names order) a model uses
+    '''
+    return np.array([[c in model_terms[m] for c in coefficient_names] for m in models])
+
+
+# batched solve of the normal equations, with unused terms fixed at 0
+def _solve(gram, moment, mask):
+    '''
+    Parameters
+    ----------
+    gram : np.array
+        ... x 3 x 3, X'X with all of DistanceBeta, TimeBeta and Const
+    moment : np.array
+        ... x 3, X'y
+    mask : np.array
+        ... x 3, terms used by each model
+
+    Returns
+    -------
+    list: coefficients (... x 3) and (X'X)^-1 of the used terms (... x 3 x 3, 0 elsewhere)
+    '''
+    both = mask[..., :, None] & mask[..., None, :]
+    # unused terms get an identity row and column and a 0 moment, so they solve to 0
+    gram = np.where(both, gram, np.eye(3))
+    inverse = np.linalg.inv(gram)
+    # symmetric to the last bit, so the covariance written out reads back the same
+    inverse = (inverse + np.swapaxes(inverse, -1, -2))/2
+    beta = np.einsum('...ij,...j->...i', inverse, np.where(mask, moment, 0))
+    return [beta, np.where(both, inverse, 0)]
+
+
+# X'X, X'y, y'y and the number of runs of every season
+def _season_sums(runs, weights=None):
+    '''
+    Parameters
+    ----------
+    runs : dataframe
+        output of load_prt_data (or with load_charging_log runs added)
+    weights : np.array, optional
+        replicates x runs, how many times each run is drawn (bootstrap)
+
+    Returns
+    -------
+    list: sums per season (and replicate), seasons first
+    '''
+    grams, moments, yy, n = [], [], [], []
+    for season in seasons:
+        season_runs = runs[runs.Season == season]
+        X = np.column_stack([season_runs.Distance.values, season_runs.timeDelta_minutes.values,
+                             np.ones(len(season_runs))])
+        y = season_runs.Electric_use.values
+        w = np.ones((1, len(y))) if weights is None else weights[:, (runs.Season == season).values]
+        grams.append(np.einsum('bn,ni,nj->bij', w, X, X))
+        moments.append(np.einsum('bn,ni,n->bi', w, X, y))
+        yy.append(w @ (y*y))
+        n.append(w.sum(axis=1))
+    return [np.stack(grams), np.stack(moments), np.stack(yy), np.stack(n)]
+
+
+# fits every model of every season in one batched least squares solve
+def fit_models(runs, models=('distance', 'time', 'distance+time')):
+    '''
+    Parameters
+    ----------
+    runs : dataframe
+        output of load_prt_data, with any load_charging_log runs appended
+    models : list
+        model names from model_terms
+
+    Returns
+    -------
+    list
+        dataframe indexed by (model, season) with DistanceBeta, TimeBeta, Const,
+        Sigma (residual standard deviation per run), Runs, MeanDuration (minutes)
+        and R2, and the covariance of each row's coefficients (rows x 3 x 3, in
+        coefficient_names order, 0 for terms a model doesn't use)
+    '''
+    runs = runs[runs.timeDelta_minutes.notna() & runs.Distance.notna() & runs.Electric_use.notna()]
+    gram, moment, yy, n = [a[:, 0] for a in _season_sums(runs)]
+    mask = _model_masks(models)
+    # models x seasons
+    beta, inverse = _solve(gram[None], moment[None], mask[:, None, :])
+    rss = (yy[None] - 2*np.einsum('msi,si->ms', beta, moment)
+           + np.einsum('msi,sij,msj->ms', beta, gram, beta))
+    dof = n[None] - mask.sum(axis=1)[:, None]
+    sigma2 = rss/dof
+    mean_y = moment[:, 2]/n
+    tss = yy - n*mean_y**2
+    index = pd.MultiIndex.from_tuples(list(itertools.product(models, seasons)), names=['model', 'season'])
+    fit = pd.DataFrame(beta.reshape(-1, 3), index=index, columns=coefficient_names)
+    fit['Sigma'] = np.sqrt(sigma2).ravel()
+    fit['Runs'] = np.broadcast_to(n[None], sigma2.shape).ravel().astype(int)
+    fit['MeanDuration'] = np.broadcast_to((gram[:, 1, 2]/n)[None], sigma2.shape).ravel()
+    fit['R2'] = (1 - rss/tss[None]).ravel()
+    covariance = (sigma2[..., None, None]*inverse).reshape(-1, 3, 3)
+    return [fit, covariance]
+
+
+# coefficients of one batch of bootstrap replicates
+def _bootstrap_batch(runs, models, n_replicates, seed):
+    rng = np.random.default_rng(seed)
+    weights = np.zeros((n_replicates, len(runs)))
+    for season in seasons:
+        rows = np.flatnonzero((runs.Season == season).values)
+        weights[:, rows] = rng.multinomial(len(rows), np.full(len(rows), 1/len(rows)), n_replicates)
+    gram, moment, _, _ = _season_sums(runs, weights)
+    mask = _model_masks(models)
+    # models x seasons x replicates
+    beta, _ = _solve(gram[None], moment[None], mask[:, None, None, :])
+    return beta
+
+
+# bootstrap confidence intervals of every coefficient, batches run across processes
+def bootstrap_intervals(runs, models=('distance', 'time', 'distance+time'), n_replicates=2000,
+                        level=0.95, seed=0, max_workers=None):
+    '''
+    Parameters
+    ----------
+    runs : dataframe
+        see fit_models
+    n_replicates : int
+        bootstrap replicates, runs are resampled within each season
+    level : float
+        confidence level of the percentile intervals
+    seed : int
+        random seed, each batch of BOOTSTRAP_BATCH replicates gets its own stream
+        so results don't depend on max_workers
+    max_workers : int, optional
+        number of processes, defaults to the number of CPUs, 1 runs in this process
+
+    Returns
+    -------
+    dataframe: indexed like fit_models, lower and upper bound of each
+    coefficient (e.g. DistanceBeta_lower, DistanceBeta_upper)
+    '''
+    runs = runs[runs.timeDelta_minutes.notna() & runs.Distance.notna() & runs.Electric_use.notna()]
+    runs = runs.reset_index(drop = True)
+    sizes = [min(BOOTSTRAP_BATCH, n_replicates - s) for s in range(0, n_replicates, BOOTSTRAP_BATCH)]
+    seeds = [s.generate_state(1)[0] for s in np.random.SeedSequence(seed).spawn(len(sizes))]
+    if max_workers == 1:
+        batches = list(map(_bootstrap_batch, itertools.repeat(runs), itertools.repeat(models), sizes, seeds))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            batches = list(executor.map(_bootstrap_batch, itertools.repeat(runs), itertools.repeat(models),
+                                        sizes, seeds))
+    beta = np.concatenate(batches, axis=2)
+    alpha = (1 - level)/2
+    lower = np.quantile(beta, alpha, axis=2).reshape(-1, 3)
+    upper = np.quantile(beta, 1 - alpha, axis=2).reshape(-1, 3)
+    index = pd.MultiIndex.from_tuples(list(itertools.product(models, seasons)), names=['model', 'season'])
+    intervals = pd.DataFrame(index=index)
+    for i, c in enumerate(coefficient_names):
+        intervals[c+'_lower'] = lower[:, i]
+        intervals[c+'_upper'] = upper[:, i]
+    return intervals
+
+
+# sha256 of the input files, recorded in the coefficient file
+def data_hash(paths):
+    sha = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+# version number of an existing coefficient file, 0 if it has none
+def file_version(path):
+    if not os.path.exists(path):
+        return 0
+    return load_coefficients(path).attrs.get('version', 0)
+
+
+# writes the fits in the BusMileageRegressionParams.txt layout
+def write_coefficients(fit, covariance, path, sources, intervals=None, worst_case=None, version=None):
+    '''
+    Parameters
+    ----------
+    fit, covariance :
+        output of fit_models
+    path : str
+        output file
+    sources : list
+        input data files, their names and sha256 go in the header
+    intervals : dataframe, optional
+        output of bootstrap_intervals
+    worst_case : dataframe, optional
+        coefficient table with the 'worst case' models to carry over (not
+        fitted), defaults to the file being replaced
+    version : int, optional
+        defaults to one more than the version of the file being replaced
+
+    Purpose
+    --------
+    ClimbBeta/DescentBeta terms (see grade_energy.py) aren't fitted here, they
+    are carried over from the file being replaced (or worst_case) per model and season.
+
+    Returns
+    -------
+    int: version written
+    '''
+    previous = load_coefficients(path) if os.path.exists(path) else None
+    if worst_case is None:
+        worst_case = previous
+    version = file_version(path) + 1 if version is None else version
+    lines = ['Regression Parameter Settings', '',
+             'Version\t' + str(version),
+             'Fitted\t' + datetime.date.today().isoformat(),
+             'Data\t' + ' '.join(os.path.basename(p) for p in sources) + '\t' + data_hash(sources), '']
+    for model, header in model_headers.items():
+        if model in fit.index.get_level_values('model'):
+            rows = fit.loc[model]
+        elif worst_case is not None and model in worst_case.index.get_level_values('model'):
+            rows = worst_case.loc[model]
+        else:
+            continue
+        lines.append(header)
+        for season in rows.index:
+            lines.append(season)
+            for c in coefficient_names:
+                lines.append('\t' + c + '\t' + repr(float(rows.loc[season, c])))
+            for table in [worst_case, previous]:
+                if table is not None and (model, season) in table.index:
+                    for c in grade_coefficient_names:
+                        if table.loc[(model, season), c] != 0:
+                            lines.append('\t' + c + '\t' + repr(float(table.loc[(model, season), c])))
+                    break
+            if model not in fit.index.get_level_values('model'):
+                continue
+            row = fit.index.get_loc((model, season))
+            for c in ['Sigma', 'Runs', 'MeanDuration', 'R2']:
+                lines.append('\t' + c + '\t' + repr(rows.loc[season, c].item()))
+            for i, j in itertools.combinations_with_replacement(range(3), 2):
+                lines.append('\tCov ' + coefficient_names[i] + ' ' + coefficient_names[j] + '\t'
+                             + repr(float(covariance[row, i, j])))
+            if intervals is not None:
+                for c in coefficient_names:
+                    lines.append('\t' + c + ' CI\t' + repr(float(intervals.loc[(model, season), c+'_lower']))
+                                 + '\t' + repr(float(intervals.loc[(model, season), c+'_upper'])))
+        lines.append('')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    return version
+
+
+# residual spread and covariance written by write_coefficients
+def load_uncertainty(path=params_path):
+    '''
+    Returns
+    -------
+    dict: (model, season) to [covariance (3 x 3, coefficient_names order),
+    Sigma, MeanDuration], for the fitted models of the file (empty for files
+    without them, e.g. the hand-copied tables)
+    '''
+    uncertainty = {}
+    model = None
+    season = None
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            tokens = [t.replace('\ufeff', '').strip() for t in line.split('\t')]
+            tokens = [t for t in tokens if t != '']
+            if len(tokens) == 0:
+                continue
+            if tokens[0].endswith('MODELS'):
+                model = tokens[0][:-len('MODELS')].strip().lower()
+                continue
+            if tokens[0] in seasons:
+                season = tokens[0]
+                tokens = tokens[1:]
+            if len(tokens) != 2 or model is None:
+                continue
+            entry = uncertainty.setdefault((model, season), [np.zeros((3, 3)), None, None])
+            name = tokens[0].split(' ')
+            if name[0] == 'Cov':
+                i, j = coefficient_names.index(name[1]), coefficient_names.index(name[2])
+                entry[0][i, j] = entry[0][j, i] = float(tokens[1])
+            elif name[0] == 'Sigma':
+                entry[1] = float(tokens[1])
+            elif name[0] == 'MeanDuration':
+                entry[2] = float(tokens[1])
+    return {k: v for k, v in uncertainty.items() if v[1] is not None}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Fit the charge depletion models and write the coefficient file.')
+    parser.add_argument('--prt', default=prt_path, help='path to PRT_data.csv')
+    parser.add_argument('--log', nargs=2, action='append', default=[], metavar=('PATH', 'SEASON'),
+                        help='charging log (Date, Duration, Distance, Battery Change) and its season')
+    parser.add_argument('--bootstrap', type=int, default=2000, help='bootstrap replicates, 0 for none')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser.add_argument('--output', default=params_path, help='coefficient file to write')
+    args = parser.parse_args()
+
+    runs = pd.concat([load_prt_data(args.prt)] + [load_charging_log(p, s) for p, s in args.log],
+                     ignore_index = True)
+    fit, covariance = fit_models(runs)
+    intervals = None
+    if args.bootstrap > 0:
+        intervals = bootstrap_intervals(runs, n_replicates=args.bootstrap, seed=args.seed,
+                                        max_workers=args.workers)
+    print(fit if intervals is None else fit.join(intervals))
+    version = write_coefficients(fit, covariance, args.output, [args.prt] + [p for p, _ in args.log], intervals)
+    print('Wrote version ', version, ' to ', args.output)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Scenario Sweep
+
+Runs the charger assessment in BusMileage.py (failed blocks, failed_block_loop
+charger assessment and the final re-check with charging) for every combination
+of a grid of scenario settings, in parallel across processes. Writes one row
+per scenario.
+
+Usage example:
+    python scenario_sweep.py --data brt allRoutes --start-charge-pct 90 80 \
+        --time-of-year Winter Summer --bus-type jumbo 40ft --output sweep_results.csv
+
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from BusMileage import load_travel_time_matrix, run_charging_assessment
+from block_rechaining import trip_services
+from block_simulation import block_charge_required
+from depot_charging import block_pull_in, schedule_depots
+from getLastRoutes import last_routes
+from layover_index import load_reach_matrix
+from multiday_simulation import Garage
+from trips_cache import load_block_table, load_trips_frame
+
+
+repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+travel_time_path = os.path.join(repo_path, 'dataGenerated', 'stop_to_layover_travelTime.csv')
+
+# scenario settings, in the order used for the grid and the results table
+scenario_params = ['data', 'start_charge_pct', 'min_charge_threshold', 'min_charge_time',
+                   'time_of_year', 'eval_type', 'bus_type']
+
+# datasets are loaded from the trips cache once per worker process and reused across scenarios
+_trips_cache = {}
+_block_table_cache = {}
+_travel_time_cache = {}
+
+
+# every combination of the given settings
+def scenario_grid(data, start_charge_pct, min_charge_threshold, min_charge_time,
+                  time_of_year, eval_type, bus_type):
+    '''
+    Parameters
+    ----------
+    Lists of values for each scenario setting, see run_charging_assessment in BusMileage.py.
+    data : list of str, choose from 'eastLib', 'brt', 'allRoutes'
+
+    Returns
+    -------
+    list of dict: one dict of settings per scenario
+    '''
+    grid = itertools.product(data, start_charge_pct, min_charge_threshold, min_charge_time,
+                             time_of_year, eval_type, bus_type)
+    return [dict(zip(scenario_params, values)) for values in grid]
+
+
+def load_trips(data, data_path=repo_path):
+    '''
+    Returns
+    -------
+    dataframe: trips_flattened_<data>.csv columns rebuilt from the trips cache
+    (see trips_cache.load_trips_frame), cached per process
+    '''
+    key = (data_path, data)
+    if key not in _trips_cache:
+        _trips_cache[key] = load_trips_frame(os.path.join(data_path, data, 'trips_flattened_'+data+'.csv'))
+    return _trips_cache[key]
+
+
+def load_trips_block_table(data, data_path=repo_path):
+    '''
+    Returns
+    -------
+    BlockTable: trips_flattened_<data>.csv as arrays, loaded from the trips cache
+    (see trips_cache.py) and cached per process
+    '''
+    key = (data_path, data)
+    if key not in _block_table_cache:
+        _block_table_cache[key] = load_block_table(os.path.join(data_path, data, 'trips_flattened_'+data+'.csv'))
+    return _block_table_cache[key]
+
+
+def load_travel_time(path=travel_time_path, layover_candidates=False):
+    '''
+    Returns
+    -------
+    dataframe: output of load_travel_time_matrix, extended with the candidate
+    sites of every end stop if layover_candidates (see layover_index.load_reach_matrix),
+    cached per process
+    '''
+    key = (path, layover_candidates)
+    if key not in _travel_time_cache:
+        _travel_time_cache[key] = load_reach_matrix(path) if layover_candidates else load_travel_time_matrix(path)
+    return _travel_time_cache[key]
+
+
+# run one scenario and summarize it as one row of the results table
+def run_scenario(scenario, data_path=repo_path, travel_time_path=travel_time_path, depot=None, battery_kwh=440,
+                 failed_stops=False, layover_candidates=False, depot_service_id=None):
+    '''
+    Parameters
+    ----------
+    scenario : dict
+        settings for the scenario, see scenario_grid
+    data_path : str
+        folder containing the eastLib/brt/allRoutes data folders
+    travel_time_path : str
+        path to stop_to_layover_travelTime.csv
+    depot : Garage, optional
+        depot charger inventory, every block of depot_service_id charges overnight at this garage
+    battery_kwh : float
+        usable battery capacity, for depot charging
+    failed_stops : bool
+        also count the failed stops (route, end stop and direction of the last
+        layover before each failure, see getLastRoutes.py)
+    layover_candidates : bool
+        give stops missing from the travel time matrix their nearest candidate
+        sites (see layover_index.py), so they can reach a charger
+    depot_service_id : int
+        service_id of the night scheduled at the depot, required with depot
+
+    Returns
+    -------
+    dict: scenario settings plus failed_blocks, charge_stops, chargers_needed,
+    failed_blocks_with_charging and error (empty unless the scenario could not run).
+    With a depot, also depot_peak_kw, depot_energy_kwh and depot_unmet_kwh, and
+    with failed_stops, failed_stops.
+    '''
+    row = dict(scenario)
+    block_table = load_trips_block_table(scenario['data'], data_path)
+    travel_time_matrix = load_travel_time(travel_time_path, layover_candidates)
+    try:
+        # the simulation prints every failed trip, keep worker output quiet
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = run_charging_assessment(None, scenario['start_charge_pct'], scenario['min_charge_threshold'],
+                                              scenario['min_charge_time'], scenario['time_of_year'],
+                                              scenario['eval_type'], scenario['bus_type'], travel_time_matrix,
+                                              block_table=block_table)
+    except Exception as e:
+        row['error'] = repr(e)
+        return row
+
+    numberOchargers = results['numberOchargers']
+    row['failed_blocks'] = len(results['blockID_needing_charge'])
+    row['charge_stops'] = len(numberOchargers)
+    row['chargers_needed'] = numberOchargers['# needed'].sum()
+    row['failed_blocks_with_charging'] = len(results['final_blockID_needing_charge'])
+    if depot is not None:
+        if depot_service_id is None:
+            raise ValueError('depot charging needs depot_service_id, one day type per night')
+        charge_required = block_charge_required(block_table, scenario['time_of_year'],
+                                                scenario['bus_type'], scenario['eval_type'])
+        service = trip_services(block_table, load_trips(scenario['data'], data_path))
+        pull_in = block_pull_in(block_table, scenario['start_charge_pct'], charge_required, default_garage=depot.name,
+                                service=service, service_id=depot_service_id)
+        _, _, summary = schedule_depots(pull_in, {depot.name: depot}, scenario['start_charge_pct'], battery_kwh)
+        row['depot_peak_kw'] = summary.peak_kw.iloc[0]
+        row['depot_energy_kwh'] = summary.energy_kwh.iloc[0]
+        row['depot_unmet_kwh'] = summary.unmet_kwh.iloc[0]
+    if failed_stops:
+        df = load_trips(scenario['data'], data_path)
+        last_route_per_block = last_routes(df, results['tripFails'], results['blockID_needing_charge'])
+        row['failed_stops'] = len(last_route_per_block.groupby(['route_id', 'end_stop_id', 'trip_headsign']))
+    row['error'] = ''
+    return row
+
+
+# run every scenario across a process pool
+def run_sweep(scenarios, max_workers=None, data_path=repo_path, travel_time_path=travel_time_path,
+              depot=None, battery_kwh=440, failed_stops=False, layover_candidates=False, depot_service_id=None):
+    '''
+    Parameters
+    ----------
+    scenarios : list of dict
+        output of scenario_grid
+    max_workers : int, optional
+        number of processes, defaults to the number of CPUs
+    depot, battery_kwh, depot_service_id :
+        depot charging settings, see run_scenario
+    failed_stops : bool
+        count the failed stops of every scenario, see run_scenario
+    layover_candidates : bool
+        extend the travel time matrix with candidate sites, see run_scenario
+
+    Returns
+    -------
+    dataframe: one row per scenario, in the order of scenarios
+    '''
+    # build any stale trips caches once before the workers read them
+    for data in sorted({s['data'] for s in scenarios}):
+        load_block_table(os.path.join(data_path, data, 'trips_flattened_'+data+'.csv'))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        rows = list(executor.map(run_scenario, scenarios,
+                                 itertools.repeat(data_path), itertools.repeat(travel_time_path),
+                                 itertools.repeat(depot), itertools.repeat(battery_kwh),
+                                 itertools.repeat(failed_stops), itertools.repeat(layover_candidates),
+                                 itertools.repeat(depot_service_id)))
+    columns = scenario_params + ['failed_blocks', 'charge_stops', 'chargers_needed',
+                                 'failed_blocks_with_charging']
+    if depot is not None:
+        columns = columns + ['depot_peak_kw', 'depot_energy_kwh', 'depot_unmet_kwh']
+    if failed_stops:
+        columns = columns + ['failed_stops']
+    columns = columns + ['error']
+    return pd.DataFrame(rows, columns=columns)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Run the charger assessment over a grid of scenarios.')
+    parser.add_argument('--data', nargs='+', default=['brt'], help="'eastLib', 'brt' or 'allRoutes'")
+    parser.add_argument('--start-charge-pct', nargs='+', type=float, default=[90])
+    parser.add_argument('--min-charge-threshold', nargs='+', type=float, default=[30])
+    parser.add_argument('--min-charge-time', nargs='+', type=float, default=[5])
+    parser.add_argument('--time-of-year', nargs='+', default=['Winter'], help="'Winter' or 'Summer'")
+    parser.add_argument('--eval-type', nargs='+', default=['reg'], help="'reg', 'wc', 'distance', 'time' or 'distance+time'")
+    parser.add_argument('--bus-type', nargs='+', default=['jumbo'], help="'jumbo' for 60ft, anything else means 40'")
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser.add_argument('--data-path', default=repo_path, help='folder containing the data folders')
+    parser.add_argument('--travel-time', default=travel_time_path, help='path to stop_to_layover_travelTime.csv')
+    parser.add_argument('--depot-chargers', type=int, default=None, help='depot chargers, no depot charging if not set')
+    parser.add_argument('--depot-charger-kw', type=float, default=150)
+    parser.add_argument('--depot-power-limit-kw', type=float, default=None)
+    parser.add_argument('--depot-service-id', type=int, default=None,
+                        help='service_id of the night scheduled at the depot, required with --depot-chargers')
+    parser.add_argument('--battery-kwh', type=float, default=440)
+    parser.add_argument('--failed-stops', action='store_true', help='count the failed stops of every scenario')
+    parser.add_argument('--layover-candidates', action='store_true',
+                        help='add the nearest candidate sites of stops missing from the travel time matrix')
+    parser.add_argument('--output', default='sweep_results.csv')
+    args = parser.parse_args()
+
+    scenarios = scenario_grid(args.data, args.start_charge_pct, args.min_charge_threshold,
+                              args.min_charge_time, args.time_of_year, args.eval_type, args.bus_type)
+    print('Running ', len(scenarios), ' scenarios')
+    depot = None
+    if args.depot_chargers is not None:
+        if args.depot_service_id is None:
+            parser.error('--depot-chargers needs --depot-service-id, one day type per night')
+        depot = Garage('depot', args.depot_chargers, args.depot_charger_kw, args.depot_power_limit_kw)
+    results = run_sweep(scenarios, args.workers, args.data_path, args.travel_time, depot, args.battery_kwh,
+                        args.failed_stops, args.layover_candidates, args.depot_service_id)
+    results.to_csv(args.output, index=False)
+    print(results)
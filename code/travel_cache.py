@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Travel Cache
+
+Persistent SQLite cache of origin/destination driving distance and travel time
+lookups, keyed on rounded coordinates and travel mode. Each lookup stores both
+the distance and the duration from the same response. Matrix lookups only send
+the pairs missing from the cache to the provider (the Google Distance Matrix
+API, or a local stand-in such as travel_time_engine.py), in batches.
+
+Entries older than the TTL are treated as missing, and the least recently used
+entries are evicted once the cache is larger than its maximum size.
+
+"""
+
+import sqlite3
+import time
+
+import numpy as np
+
+from travel_time_engine import METERS_PER_MILE, haversine_travel_matrices, network_travel_matrices
+
+# decimal places kept in the cache key, 5 places is about 1 meter
+COORDINATE_DECIMALS = 5
+
+# Google Distance Matrix limits: 25 origins, 25 destinations, 100 elements per request
+BATCH_ORIGINS = 25
+BATCH_DESTINATIONS = 25
+BATCH_ELEMENTS = 100
+
+
+class TravelCache:
+    '''
+    SQLite cache of travel lookups.
+
+    Attributes of the class include:
+        path: str, SQLite database file (':memory:' for a cache that isn't kept)
+        ttl: float or None, seconds an entry stays valid, None to keep entries forever
+        max_entries: int or None, least recently used entries past this size are evicted
+        hits, misses: int, lookups answered from the cache and sent to the provider
+    '''
+    def __init__(self, path, ttl=None, max_entries=None, decimals=COORDINATE_DECIMALS):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.decimals = decimals
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS travel (
+                                       origin_lat REAL, origin_lon REAL, dest_lat REAL, dest_lon REAL,
+                                       mode TEXT, distance_miles REAL, duration_seconds REAL,
+                                       created REAL, last_used REAL,
+                                       PRIMARY KEY (origin_lat, origin_lon, dest_lat, dest_lon, mode))''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS travel_last_used ON travel (last_used)')
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM travel').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def key(self, origin, destination, mode):
+        return (round(float(origin[0]), self.decimals), round(float(origin[1]), self.decimals),
+                round(float(destination[0]), self.decimals), round(float(destination[1]), self.decimals), mode)
+
+    # removes expired entries, then least recently used entries past max_entries
+    def evict(self):
+        if self.ttl is not None:
+            self.connection.execute('DELETE FROM travel WHERE created < ?', (time.time() - self.ttl,))
+        if self.max_entries is not None:
+            self.connection.execute('''DELETE FROM travel WHERE rowid IN (
+                                           SELECT rowid FROM travel ORDER BY last_used DESC LIMIT -1 OFFSET ?)''',
+                                    (self.max_entries,))
+        self.connection.commit()
+
+    def get(self, keys):
+        '''
+        Parameters
+        ----------
+        keys : list of tuple
+            see key
+
+        Returns
+        -------
+        dict: key -> (distance_miles, duration_seconds) for the keys in the cache
+        '''
+        now = time.time()
+        oldest = -np.inf if self.ttl is None else now - self.ttl
+        found = {}
+        for key in set(keys):
+            row = self.connection.execute('''SELECT distance_miles, duration_seconds FROM travel
+                                             WHERE origin_lat = ? AND origin_lon = ? AND dest_lat = ?
+                                             AND dest_lon = ? AND mode = ? AND created >= ?''',
+                                          key + (oldest,)).fetchone()
+            if row is not None:
+                found[key] = row
+        self.connection.executemany('''UPDATE travel SET last_used = ? WHERE origin_lat = ? AND origin_lon = ?
+                                       AND dest_lat = ? AND dest_lon = ? AND mode = ?''',
+                                    [(now,) + key for key in found])
+        self.connection.commit()
+        return found
+
+    def put(self, entries):
+        '''
+        Parameters
+        ----------
+        entries : dict
+            key -> (distance_miles, duration_seconds)
+        '''
+        now = time.time()
+        self.connection.executemany('INSERT OR REPLACE INTO travel VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                    [key + (float(d), float(t), now, now) for key, (d, t) in entries.items()])
+        self.connection.commit()
+        self.evict()
+
+    # distance and travel time for every origin/destination pair, filling misses from the provider
+    def lookup_matrix(self, origins, destinations, provider, mode='driving',
+                      batch_origins=BATCH_ORIGINS, batch_destinations=BATCH_DESTINATIONS,
+                      batch_elements=BATCH_ELEMENTS):
+        '''
+        Parameters
+        ----------
+        origins, destinations : list of (lat, lon)
+        provider : function
+            provider(origins, destinations, mode) -> [distance (miles), duration (seconds)],
+            arrays of origins x destinations, see google_provider and engine_provider
+        mode : str
+            travel mode, part of the cache key
+        batch_origins, batch_destinations, batch_elements : int
+            most origins, destinations and pairs sent to the provider at once
+
+        Returns
+        -------
+        list: distance (miles) and duration (seconds) arrays, origins x destinations
+        '''
+        keys = [[self.key(o, d, mode) for d in destinations] for o in origins]
+        found = self.get([k for row in keys for k in row])
+        missing = [[j for j, k in enumerate(row) if k not in found] for row in keys]
+        self.hits += sum(len(row) - len(m) for row, m in zip(keys, missing))
+        self.misses += sum(len(m) for m in missing)
+
+        # origins with the same missing destinations (e.g. new stops against every layover) share requests
+        groups = {}
+        for i, m in enumerate(missing):
+            if len(m) > 0:
+                groups.setdefault(tuple(m), []).append(i)
+        dest_step = min(batch_destinations, batch_elements)
+        for dest_idx, origin_idx in groups.items():
+            origin_step = max(1, min(batch_origins, batch_elements // min(dest_step, len(dest_idx))))
+            for a in range(0, len(origin_idx), origin_step):
+                batch_o = origin_idx[a:a+origin_step]
+                for b in range(0, len(dest_idx), dest_step):
+                    batch_d = dest_idx[b:b+dest_step]
+                    distance, duration = provider([origins[i] for i in batch_o],
+                                                  [destinations[j] for j in batch_d], mode)
+                    entries = {}
+                    for x, i in enumerate(batch_o):
+                        for y, j in enumerate(batch_d):
+                            entries[keys[i][j]] = (distance[x][y], duration[x][y])
+                    self.put(entries)
+                    found.update(entries)
+
+        distance = np.array([[found[k][0] for k in row] for row in keys], dtype=float).reshape(len(origins), len(destinations))
+        duration = np.array([[found[k][1] for k in row] for row in keys], dtype=float).reshape(len(origins), len(destinations))
+        return [distance, duration]
+
+
+# provider for lookup_matrix using the Google Distance Matrix API
+def google_provider(client):
+    '''
+    Parameters
+    ----------
+    client : googlemaps.Client
+
+    Returns
+    -------
+    function: provider for TravelCache.lookup_matrix, one distance_matrix request
+    per batch. Pairs without a route are inf.
+    '''
+    def provider(origins, destinations, mode):
+        result = client.distance_matrix(origins, destinations, mode=mode, units='imperial')
+        distance = np.full((len(origins), len(destinations)), np.inf)
+        duration = np.full((len(origins), len(destinations)), np.inf)
+        for i, row in enumerate(result['rows']):
+            for j, element in enumerate(row['elements']):
+                if element['status'] == 'OK':
+                    distance[i, j] = element['distance']['value'] / METERS_PER_MILE
+                    duration[i, j] = element['duration']['value']
+        return [distance, duration]
+    return provider
+
+
+# local stand-in provider, see travel_time_engine.py
+def engine_provider(graph=None, **kwargs):
+    '''
+    Parameters
+    ----------
+    graph : RoadGraph, optional
+        road graph, haversine screening estimate if None
+    kwargs :
+        passed to network_travel_matrices or haversine_travel_matrices
+
+    Returns
+    -------
+    function: provider for TravelCache.lookup_matrix
+    '''
+    def provider(origins, destinations, mode):
+        origins = np.asarray(origins, dtype=float)
+        destinations = np.asarray(destinations, dtype=float)
+        points = (origins[:, 0], origins[:, 1], destinations[:, 0], destinations[:, 1])
+        if graph is None:
+            return haversine_travel_matrices(*points, **kwargs)
+        return network_travel_matrices(graph, *points, **kwargs)
+    return provider
@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Travel Time Engine
+
+Offline replacement for the Google Distance Matrix calls in
+endStop_layover_distances.py. Computes the driving distance and travel time
+from every end stop to every layover location in one batch:
+
+- on a local road graph (nodes and edges csv files, or an OSM extract saved as
+  graphml by osmnx), with one Dijkstra run per layover over the reversed graph,
+  giving the fastest path from every node to that layover at once, and the
+  distance driven along that same path
+- or, for quick screening without a road graph, from the straight-line
+  (haversine) distance times a detour factor
+
+Travel times are computed in seconds. stop_to_layover_travelTime.csv is
+written in minutes, the unit BusMileage.py reads it in.
+
+Usage examples:
+    python travel_time_engine.py --stops GTFS_2022/stops.csv --output stop_to_layover_travelTime.csv
+    python travel_time_engine.py --stops GTFS_2022/stops.csv --nodes nodes.csv --edges edges.csv
+    python travel_time_engine.py --stops GTFS_2022/stops.csv --graphml pittsburgh_drive.graphml
+
+"""
+
+import argparse
+import heapq
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import dijkstra
+    from scipy.spatial import cKDTree
+except ImportError:
+    dijkstra = None
+    cKDTree = None
+
+try:
+    import osmnx
+except ImportError:
+    osmnx = None
+
+
+repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+EARTH_RADIUS_MILES = 3958.8
+METERS_PER_MILE = 1609.34
+
+# straight-line estimate, fit to the Google travel times in stop_to_layover_travelTime.csv
+DETOUR_FACTOR = 1.3
+SCREENING_SPEED_MPH = 26
+SCREENING_OVERHEAD_SECONDS = 0
+
+# speed used on the leg between a stop and its nearest road graph node
+CONNECTOR_SPEED_MPH = 15
+
+# speed for edges without a travel time or speed, km/h
+DEFAULT_SPEED_KPH = 40
+
+
+# great circle distance, arrays broadcast against each other
+def haversine_miles(lat1, lon1, lat2, lon2):
+    '''
+    Returns
+    -------
+    np.array: distance in miles between (lat1, lon1) and (lat2, lon2)
+    '''
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(x, dtype=float)) for x in (lat1, lon1, lat2, lon2)]
+    a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2)**2
+    return 2*EARTH_RADIUS_MILES*np.arcsin(np.sqrt(a))
+
+
+# points on the unit sphere, the chord between two points grows with their great circle distance
+def unit_vectors(lat, lon):
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    return np.column_stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)])
+
+
+class RoadGraph:
+    '''
+    Directed road graph as sparse adjacency arrays.
+
+    Attributes of the class include:
+        node_ids: np.array, id of each node
+        lat, lon: np.array, coordinates of each node
+        indptr, indices: np.array, csr adjacency (edges out of node i are
+            indices[indptr[i]:indptr[i+1]])
+        travel_time: np.array, seconds per edge
+        length: np.array, meters per edge
+        tree: cKDTree over the nodes' unit vectors, None without scipy
+    '''
+    def __init__(self, node_ids, lat, lon, u, v, length, travel_time):
+        self.node_ids = np.asarray(node_ids)
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        position = pd.Series(np.arange(len(self.node_ids)), index=self.node_ids)
+        u = position.loc[np.asarray(u)].values
+        v = position.loc[np.asarray(v)].values
+        # parallel edges keep the fastest one
+        edges = pd.DataFrame({'u': u, 'v': v, 'length': np.asarray(length, dtype=float),
+                              'travel_time': np.asarray(travel_time, dtype=float)})
+        edges = edges.sort_values(['u', 'v', 'travel_time']).drop_duplicates(['u', 'v'])
+        self.indptr = np.searchsorted(edges.u.values, np.arange(len(self.node_ids) + 1))
+        self.indices = edges.v.values
+        self.length = edges.length.values
+        self.travel_time = edges.travel_time.values
+        self.tree = None if cKDTree is None else cKDTree(unit_vectors(self.lat, self.lon))
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def reversed(self):
+        '''
+        Returns
+        -------
+        RoadGraph: same graph with every edge pointing the other way
+        '''
+        u = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+        return RoadGraph(np.arange(len(self)), self.lat, self.lon, self.indices, u,
+                         self.length, self.travel_time)
+
+    # index of the closest node to each point, straight-line
+    def nearest_nodes(self, lat, lon, chunksize=256):
+        '''
+        Returns
+        -------
+        list: node position and distance in miles to it, for each point
+        '''
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        if self.tree is not None:
+            _, nearest = self.tree.query(unit_vectors(lat, lon))
+            nearest = np.asarray(nearest, dtype=int).reshape(len(lat))
+            return [nearest, haversine_miles(lat, lon, self.lat[nearest], self.lon[nearest])]
+        # brute force without scipy
+        nearest = np.zeros(len(lat), dtype=int)
+        distance = np.zeros(len(lat))
+        for start in range(0, len(lat), chunksize):
+            d = haversine_miles(lat[start:start+chunksize, None], lon[start:start+chunksize, None],
+                                self.lat[None, :], self.lon[None, :])
+            nearest[start:start+chunksize] = np.argmin(d, axis=1)
+            distance[start:start+chunksize] = d[np.arange(len(d)), nearest[start:start+chunksize]]
+        return [nearest, distance]
+
+
+# road graph from a node csv (node_id, lat, lon) and an edge csv (u, v, length in meters,
+# and travel_time in seconds or speed_kph)
+def load_road_graph(nodes_path, edges_path, bidirectional=False):
+    '''
+    Parameters
+    ----------
+    nodes_path, edges_path : str
+        paths to the node and edge csv files
+    bidirectional : bool
+        add the reverse of every edge, for edge lists that list each road once
+
+    Returns
+    -------
+    RoadGraph
+    '''
+    nodes = pd.read_csv(nodes_path)
+    edges = pd.read_csv(edges_path)
+    if 'travel_time' not in edges.columns:
+        speed = edges.speed_kph.fillna(DEFAULT_SPEED_KPH) if 'speed_kph' in edges.columns else DEFAULT_SPEED_KPH
+        edges['travel_time'] = edges.length / (speed/3.6)
+    if bidirectional:
+        edges = pd.concat([edges, edges.rename(columns={'u': 'v', 'v': 'u'})])
+    return RoadGraph(nodes.node_id.values, nodes.lat.values, nodes.lon.values,
+                     edges.u.values, edges.v.values, edges.length.values, edges.travel_time.values)
+
+
+# road graph from an OSM extract saved with osmnx.save_graphml
+def load_osm_graph(path):
+    '''
+    Returns
+    -------
+    RoadGraph: osmnx graph, with edge speeds and travel times imputed by osmnx
+    '''
+    if osmnx is None:
+        raise ImportError('osmnx is needed to read graphml road graphs, or use load_road_graph with csv files')
+    G = osmnx.load_graphml(path)
+    G = osmnx.add_edge_travel_times(osmnx.add_edge_speeds(G))
+    nodes, edges = osmnx.graph_to_gdfs(G)
+    edges = edges.reset_index()
+    return RoadGraph(nodes.index.values, nodes.y.values, nodes.x.values,
+                     edges.u.values, edges.v.values, edges.length.values, edges.travel_time.values)
+
+
+# single source Dijkstra over csr arrays, used when scipy isn't installed
+def _dijkstra_heap(indptr, indices, weights, source):
+    dist = np.full(len(indptr) - 1, np.inf)
+    predecessors = np.full(len(indptr) - 1, -9999)
+    dist[source] = 0
+    heap = [(0.0, source)]
+    while heap:
+        d, i = heapq.heappop(heap)
+        if d > dist[i]:
+            continue
+        for k in range(indptr[i], indptr[i+1]):
+            j = indices[k]
+            nd = d + weights[k]
+            if nd < dist[j]:
+                dist[j] = nd
+                predecessors[j] = i
+                heapq.heappush(heap, (nd, j))
+    return [dist, predecessors]
+
+
+# sum of an edge attribute along each node's path in a shortest path tree
+def _sum_along_tree(graph, predecessors, values):
+    '''
+    Parameters
+    ----------
+    graph : RoadGraph
+        graph the search ran on
+    predecessors : np.array
+        trees x nodes, previous node on the path from the root (negative for the
+        root and unreached nodes)
+    values : np.array
+        per edge attribute of graph
+
+    Returns
+    -------
+    np.array: trees x nodes, values summed from the root to each node (inf where
+    the node is unreached)
+    '''
+    n = len(graph)
+    # edges are sorted by (u, v), so u*n + v is sorted and finds the edge u -> v
+    edge_key = np.repeat(np.arange(n), np.diff(graph.indptr))*n + graph.indices
+    reached = predecessors >= 0
+    node = np.broadcast_to(np.arange(n), predecessors.shape)
+    total = np.zeros(predecessors.shape)
+    total[reached] = values[np.searchsorted(edge_key, predecessors[reached]*n + node[reached])]
+    # pointer jumping, each pass doubles the length of path summed
+    pointer = np.where(reached, predecessors, -1)
+    rows = np.broadcast_to(np.arange(len(pointer))[:, None], pointer.shape)
+    while (pointer >= 0).any():
+        step = pointer >= 0
+        total[step] += total[rows[step], pointer[step]]
+        next_pointer = np.full(pointer.shape, -1)
+        next_pointer[step] = pointer[rows[step], pointer[step]]
+        pointer = next_pointer
+    return total
+
+
+# shortest path cost from every node to each target node
+def shortest_paths_to(graph, targets, weight='travel_time', along=None):
+    '''
+    Parameters
+    ----------
+    graph : RoadGraph
+    targets : np.array
+        node positions
+    weight : str
+        'travel_time' or 'length', the cost the paths minimize
+    along : str
+        optional second edge attribute summed along the same paths, so a
+        distance goes with the route of the fastest path
+
+    Returns
+    -------
+    np.array: targets x nodes, cost of the shortest path from each node to each
+    target (inf if there is none). With along, a list of that array and the
+    along attribute summed over the same paths.
+    '''
+    reverse = graph.reversed()
+    weights = getattr(reverse, weight)
+    if dijkstra is not None:
+        # explicit zeros are dropped by csr_matrix, keep zero cost edges as tiny costs
+        adjacency = csr_matrix((np.maximum(weights, 1e-9), reverse.indices, reverse.indptr),
+                               shape=(len(graph), len(graph)))
+        cost, predecessors = dijkstra(adjacency, directed=True, indices=targets, return_predecessors=True)
+    else:
+        searches = [_dijkstra_heap(reverse.indptr, reverse.indices, weights, t) for t in targets]
+        cost = np.vstack([search[0] for search in searches])
+        predecessors = np.vstack([search[1] for search in searches])
+    if along is None:
+        return cost
+    total = _sum_along_tree(reverse, predecessors, getattr(reverse, along))
+    total[np.isinf(cost)] = np.inf
+    return [cost, total]
+
+
+# distance and travel time on the road graph from every origin to every destination
+def network_travel_matrices(graph, origin_lat, origin_lon, dest_lat, dest_lon,
+                            connector_speed_mph=CONNECTOR_SPEED_MPH):
+    '''
+    Parameters
+    ----------
+    graph : RoadGraph
+    origin_lat, origin_lon, dest_lat, dest_lon : np.array
+        coordinates, snapped to the nearest graph node
+    connector_speed_mph : float
+        speed for the straight-line legs between each point and its graph node
+
+    Returns
+    -------
+    list: distance (miles) and travel time (seconds), origins x destinations.
+    Pairs with no path are inf.
+    '''
+    origin_nodes, origin_snap = graph.nearest_nodes(origin_lat, origin_lon)
+    dest_nodes, dest_snap = graph.nearest_nodes(dest_lat, dest_lon)
+    # one Dijkstra run per distinct destination node
+    targets, target_position = np.unique(dest_nodes, return_inverse=True)
+    # one search on travel time, with the length summed along the fastest path
+    time, length = shortest_paths_to(graph, targets, 'travel_time', along='length')
+    time = time[target_position][:, origin_nodes].T
+    length = length[target_position][:, origin_nodes].T
+
+    snap = origin_snap[:, None] + dest_snap[None, :]
+    distance = length/METERS_PER_MILE + snap
+    time = time + snap/connector_speed_mph*3600
+    return [distance, time]
+
+
+# straight-line screening estimate of distance and travel time
+def haversine_travel_matrices(origin_lat, origin_lon, dest_lat, dest_lon, detour_factor=DETOUR_FACTOR,
+                              speed_mph=SCREENING_SPEED_MPH, overhead_seconds=SCREENING_OVERHEAD_SECONDS):
+    '''
+    Returns
+    -------
+    list: distance (miles, haversine x detour_factor) and travel time (seconds,
+    distance at speed_mph plus overhead_seconds), origins x destinations
+    '''
+    distance = haversine_miles(np.asarray(origin_lat)[:, None], np.asarray(origin_lon)[:, None],
+                               np.asarray(dest_lat)[None, :], np.asarray(dest_lon)[None, :]) * detour_factor
+    time = distance/speed_mph*3600 + overhead_seconds
+    return [distance, time]
+
+
+# layover locations with a stop id, same rows and order as endStop_layover_distances.py
+def load_layovers(path=os.path.join(repo_path, 'dataGenerated', 'LayoverLocations.csv')):
+    layovers = pd.read_csv(path)
+    layovers = layovers[['StopID', 'CleverID', 'Latitude', 'Longitude']]
+    layovers = layovers[~pd.isna(layovers.StopID)].reset_index(drop = True)
+    layovers.Latitude = layovers.Latitude.astype(float)
+    layovers.Longitude = layovers.Longitude.astype(float)
+    return layovers
+
+
+# coordinates of every end stop in the flattened trips datasets
+def load_end_stops(stops, trips):
+    '''
+    Parameters
+    ----------
+    stops : dataframe
+        GTFS stops, with stop_id, stop_lat and stop_lon
+    trips : list of dataframe
+        flattened trips datasets (output of create_trips_flattened.py)
+
+    Returns
+    -------
+    dataframe: stop_id, stop_lat, stop_lon, one row per end stop, sorted by stop_id
+    '''
+    end_stop_ids = set()
+    for df in trips:
+        end_stop_ids.update(df.end_stop_id.astype(str))
+    stops = stops.assign(stop_id = stops.stop_id.astype(str)).drop_duplicates('stop_id')
+    end_stops = stops[stops.stop_id.isin(end_stop_ids)][['stop_id', 'stop_lat', 'stop_lon']]
+    missing = end_stop_ids - set(end_stops.stop_id)
+    if len(missing) > 0:
+        print('End stops missing from stops: ', sorted(missing))
+    return end_stops.sort_values('stop_id').reset_index(drop = True)
+
+
+# end stop x layover travel times, in seconds
+def build_travel_time_matrix(end_stops, layovers, graph=None, **kwargs):
+    '''
+    Parameters
+    ----------
+    end_stops : dataframe
+        see load_end_stops
+    layovers : dataframe
+        see load_layovers
+    graph : RoadGraph, optional
+        road graph for network travel times, haversine screening estimate if None
+    kwargs :
+        passed to network_travel_matrices or haversine_travel_matrices
+
+    Returns
+    -------
+    list: dataframes of travel time (seconds) and distance (miles), indexed by
+    end stop, one column per layover (StopID)
+    '''
+    points = (end_stops.stop_lat.values, end_stops.stop_lon.values,
+              layovers.Latitude.values, layovers.Longitude.values)
+    if graph is None:
+        distance, time = haversine_travel_matrices(*points, **kwargs)
+    else:
+        distance, time = network_travel_matrices(graph, *points, **kwargs)
+    index = pd.Index(end_stops.stop_id.values, name='index')
+    columns = layovers.StopID.values
+    return [pd.DataFrame(time, index=index, columns=columns),
+            pd.DataFrame(distance, index=index, columns=columns)]
+
+
+# writes the matrix in the stop_to_layover_travelTime.csv layout read by load_travel_time_matrix
+def write_travel_time_csv(travel_seconds, path, active_chargers=None):
+    '''
+    Parameters
+    ----------
+    travel_seconds : dataframe
+        end stop x layover travel times in seconds, see build_travel_time_matrix
+    path : str
+        output csv
+    active_chargers : array like, optional
+        0/1 flag per layover column for an active charger, written as row 0.
+        All 0 if None.
+
+    Returns
+    -------
+    dataframe: what was written, travel times in minutes, unreachable pairs empty
+    '''
+    travel_minutes = travel_seconds.replace(np.inf, np.nan)/60
+    flags = np.zeros(travel_minutes.shape[1], dtype=int) if active_chargers is None else np.asarray(active_chargers)
+    travel_minutes.loc[0] = flags
+    travel_minutes.index.name = 'index'
+    travel_minutes.to_csv(path)
+    return travel_minutes
+
+
+# active charger flags from an existing stop_to_layover_travelTime.csv
+def read_active_chargers(path, layovers):
+    '''
+    Returns
+    -------
+    np.array: flag per layover row, 0 for layovers not in the file
+    '''
+    existing = pd.read_csv(path).set_index('index')
+    flags = existing.loc[0].values
+    # duplicated layover ids are read back as E70451.1 etc., in order
+    flags = pd.Series(flags, index=[c.split('.')[0] for c in existing.columns])
+    flags = flags.groupby(level=0).apply(list).to_dict()
+    seen = {}
+    active = []
+    for stop in layovers.StopID.values:
+        k = seen.get(stop, 0)
+        seen[stop] = k + 1
+        active.append(flags[stop][k] if stop in flags and k < len(flags[stop]) else 0)
+    return np.array(active, dtype=int)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='End stop to layover travel time matrix without the Google API.')
+    parser.add_argument('--stops', required=True, help='GTFS stops.csv')
+    parser.add_argument('--trips', nargs='+', default=[os.path.join(repo_path, 'allRoutes', 'trips_flattened_allRoutes.csv')],
+                        help='flattened trips datasets, their end stops are the matrix rows')
+    parser.add_argument('--layovers', default=os.path.join(repo_path, 'dataGenerated', 'LayoverLocations.csv'))
+    parser.add_argument('--nodes', help='road graph node csv (node_id, lat, lon)')
+    parser.add_argument('--edges', help='road graph edge csv (u, v, length, travel_time or speed_kph)')
+    parser.add_argument('--bidirectional', action='store_true', help='edges in the edge csv are two way')
+    parser.add_argument('--graphml', help='OSM road graph saved by osmnx, instead of --nodes/--edges')
+    parser.add_argument('--detour-factor', type=float, default=DETOUR_FACTOR, help='haversine screening only')
+    parser.add_argument('--active-chargers-from', default=os.path.join(repo_path, 'dataGenerated', 'stop_to_layover_travelTime.csv'),
+                        help='copy the active charger row from this csv, if it exists')
+    parser.add_argument('--output', default='stop_to_layover_travelTime.csv')
+    args = parser.parse_args()
+
+    layovers = load_layovers(args.layovers)
+    end_stops = load_end_stops(pd.read_csv(args.stops), [pd.read_csv(p) for p in args.trips])
+
+    if args.graphml is not None:
+        graph = load_osm_graph(args.graphml)
+    elif args.nodes is not None:
+        graph = load_road_graph(args.nodes, args.edges, args.bidirectional)
+    else:
+        graph = None
+    if graph is None:
+        print('No road graph given, using the haversine screening estimate')
+        travel_seconds, distance = build_travel_time_matrix(end_stops, layovers, detour_factor=args.detour_factor)
+    else:
+        travel_seconds, distance = build_travel_time_matrix(end_stops, layovers, graph)
+    print('End stops: ', len(end_stops), ' Layovers: ', len(layovers),
+          ' Unreachable pairs: ', int(np.isinf(travel_seconds.values).sum()))
+
+    active_chargers = None
+    if args.active_chargers_from is not None and os.path.exists(args.active_chargers_from):
+        active_chargers = read_active_chargers(args.active_chargers_from, layovers)
+    write_travel_time_csv(travel_seconds, args.output, active_chargers)
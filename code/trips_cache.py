@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Trips Cache
+
+Converts a trips_flattened_<data>.csv file into a typed columnar cache of NumPy
+arrays (one .npy file per column, loaded memory-mapped) so simulation runs don't
+re-parse the CSV and its 'H:MM:SS' time strings. Times are stored as integer
+seconds after midnight, route and stop ids as categorical codes.
+
+The cache sits next to the CSV in .trips_cache/<file name>/ and is rebuilt when
+the SHA-256 hash of the CSV changes.
+
+Usage: python trips_cache.py path/to/trips_flattened_<data>.csv [...]
+
+"""
+
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+
+CACHE_VERSION = 3
+
+# columns stored as categorical codes, with the categories in the manifest
+categorical_columns = ['route_id', 'trip_headsign', 'start_stop_id', 'end_stop_id']
+
+
+def file_hash(path):
+    '''
+    Returns
+    -------
+    str: SHA-256 hex digest of the file
+    '''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def default_cache_dir(csv_path):
+    folder, name = os.path.split(os.path.abspath(csv_path))
+    return os.path.join(folder, '.trips_cache', os.path.splitext(name)[0])
+
+
+# 'H:MM:SS' time strings (hours can be >= 24) to integer seconds after midnight
+def time_to_seconds(times):
+    hms = times.astype(str).str.split(':', expand=True).astype(int).values.reshape(-1, 3)
+    return (hms[:, 0]*3600 + hms[:, 1]*60 + hms[:, 2]).astype(np.int32)
+
+
+# integer seconds to minutes, same value as int(h)*60 + int(m) + int(s)/60 in BusMileage.py
+def seconds_to_minutes(seconds):
+    seconds = np.asarray(seconds, dtype=np.int64)
+    return seconds // 60 + (seconds % 60)/60
+
+
+# writes the typed columns of a trips_flattened CSV to the cache
+def build_trips_cache(csv_path, cache_dir=None):
+    '''
+    Parameters
+    ----------
+    csv_path : str
+        path to trips_flattened_<data>.csv (output of create_trips_flattened.py)
+    cache_dir : str, optional
+        folder for the cache, see default_cache_dir
+
+    Returns
+    -------
+    dict: the cache manifest
+    '''
+    cache_dir = default_cache_dir(csv_path) if cache_dir is None else cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+    source_hash = file_hash(csv_path)
+    df = pd.read_csv(csv_path)
+
+    columns = {'trip_id': df.trip_id.values.astype(np.int64),
+               'block_id': df.block_id.values,
+               'start_sec': time_to_seconds(df.trip_start_time),
+               'end_sec': time_to_seconds(df.trip_end_time),
+               'distance': df.total_distance_traveled.values.astype(np.float64),
+               'duration': df.timeDelta_minutes.values.astype(np.float64),
+               'service_id_start': df.service_id_start.values.astype(np.int64)}
+    categories = {}
+    for column in categorical_columns:
+        codes, uniques = pd.factorize(df[column], sort=True)
+        columns[column] = codes.astype(np.int32)
+        categories[column] = uniques.tolist()
+
+    for column, values in columns.items():
+        np.save(os.path.join(cache_dir, column + '.npy'), values)
+    manifest = {'version': CACHE_VERSION,
+                'source': os.path.abspath(csv_path),
+                'sha256': source_hash,
+                'rows': len(df),
+                'dtypes': {c: str(v.dtype) for c, v in columns.items()},
+                'categories': categories}
+    # manifest is written last, an interrupted build is rebuilt on the next load
+    with open(os.path.join(cache_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def read_manifest(cache_dir):
+    path = os.path.join(cache_dir, 'manifest.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+# typed trip columns for a trips_flattened CSV, rebuilding the cache if it is stale
+def load_trips_cache(csv_path, cache_dir=None):
+    '''
+    Parameters
+    ----------
+    csv_path : str
+        path to trips_flattened_<data>.csv
+    cache_dir : str, optional
+        folder for the cache, see default_cache_dir
+
+    Returns
+    -------
+    dict: column name -> memory-mapped array. Categorical columns are returned
+    as their values (categories[codes]).
+    '''
+    cache_dir = default_cache_dir(csv_path) if cache_dir is None else cache_dir
+    manifest = read_manifest(cache_dir)
+    if (manifest is None or manifest['version'] != CACHE_VERSION
+            or manifest['sha256'] != file_hash(csv_path)):
+        manifest = build_trips_cache(csv_path, cache_dir)
+
+    columns = {c: np.load(os.path.join(cache_dir, c + '.npy'), mmap_mode='r')
+               for c in manifest['dtypes']}
+    for column in categorical_columns:
+        columns[column] = np.asarray(manifest['categories'][column])[columns[column]]
+    return columns
+
+
+# integer seconds after midnight to 'H:MM:SS' time strings, the inverse of time_to_seconds
+def seconds_to_time(seconds):
+    seconds = pd.Series(np.asarray(seconds, dtype=np.int64))
+    return (seconds // 3600).astype(str) + ':' + (seconds // 60 % 60).map('{:02d}'.format) + ':' \
+        + (seconds % 60).map('{:02d}'.format)
+
+
+# flattened trips dataframe rebuilt from the cache, for code that needs the csv columns
+def load_trips_frame(csv_path, cache_dir=None):
+    '''
+    Returns
+    -------
+    dataframe: the cached columns of trips_flattened_<data>.csv, in file order,
+    under their csv names (trip_id, block_id, route_id, trip_headsign,
+    start_stop_id, end_stop_id, trip_start_time, trip_end_time,
+    total_distance_traveled, timeDelta_minutes, service_id_start)
+    '''
+    columns = load_trips_cache(csv_path, cache_dir)
+    df = pd.DataFrame({c: np.asarray(columns[c]) for c in ['trip_id', 'block_id'] + categorical_columns})
+    df['trip_start_time'] = seconds_to_time(columns['start_sec'])
+    df['trip_end_time'] = seconds_to_time(columns['end_sec'])
+    df['total_distance_traveled'] = np.asarray(columns['distance'])
+    df['timeDelta_minutes'] = np.asarray(columns['duration'])
+    df['service_id_start'] = np.asarray(columns['service_id_start'])
+    return df
+
+
+# block table for the simulation straight from the cache
+def load_block_table(csv_path, cache_dir=None):
+    '''
+    Returns
+    -------
+    BlockTable: same as build_block_table(pd.read_csv(csv_path)) in block_simulation.py,
+    expanded from the trips' PatternTable so charge required is evaluated per pattern
+    '''
+    # pattern_table.py imports this module for its time conversions
+    from pattern_table import pattern_table_from_columns
+    return pattern_table_from_columns(load_trips_cache(csv_path, cache_dir)).to_block_table()
+
+
+if __name__ == '__main__':
+
+    for csv_path in sys.argv[1:]:
+        manifest = build_trips_cache(csv_path)
+        print('Cached ', manifest['rows'], ' trips from ', csv_path)